@@ -0,0 +1,103 @@
+"""Micro-batching of concurrent vector queries.
+
+Every search needs one embedding of its query and one scan of the vector index. Under load, the
+queries which arrive within a few milliseconds of each other are collected and run as one batched
+call (one model call for all query texts, one collection.query with all embeddings), the results are
+fanned back out to the waiting requests. A query waits at most VECTOR_QUERY_WINDOW_MS for others,
+a batch is sent right away once it has VECTOR_QUERY_MAX_BATCH queries.
+
+Example:
+    coalescer = QueryCoalescer(run_queries, window=0.005, max_batch=32)
+    results = await coalescer.query("climate crisis", n_results=40, where=None)
+"""
+
+import asyncio
+import contextvars
+import logging
+import os
+
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from app.metrics import VECTOR_BATCH_SIZE
+from app.vectorstore import where_key
+
+
+# 0 disables the batching, every query is run on its own
+VECTOR_QUERY_WINDOW_MS = float(os.getenv("VECTOR_QUERY_WINDOW_MS", "5"))
+VECTOR_QUERY_MAX_BATCH = int(os.getenv("VECTOR_QUERY_MAX_BATCH", "32"))
+
+# the per query lists of a chromaDB query result
+RESULT_FIELDS = ("ids", "distances", "metadatas", "documents")
+
+
+class _Batch():
+    """The queries (with the same where filter) which wait for the same call."""
+
+    def __init__(self, where: Optional[Dict[str, Any]]):
+        self.where = where
+        self.queries: List[Tuple[str, int, asyncio.Future]] = []
+        self.timer: Optional[asyncio.TimerHandle] = None
+
+
+class QueryCoalescer():
+    """Collects the vector queries arriving within a window and runs them as one batched (blocking) call in a worker thread."""
+
+    def __init__(self, run_batch: Callable[[List[str], int, Optional[Dict[str, Any]]], Dict[str, Any]],
+                 window: float = VECTOR_QUERY_WINDOW_MS / 1000, max_batch: int = VECTOR_QUERY_MAX_BATCH):
+        """
+        Args:
+          run_batch -- runs (query texts, n_results, where filter) and returns the chromaDB query result
+            with one list per query text
+          window -- the seconds a query waits for others, 0 disables the batching
+          max_batch -- the maximum number of queries per call
+        """
+        self.run_batch = run_batch
+        self.window = window
+        self.max_batch = max(max_batch, 1)
+        # where_key() of the filter -> the batch which is collecting queries
+        self._pending: Dict[str, _Batch] = {}
+
+    async def query(self, text: str, n_results: int, where: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """The n_results nearest chunks of a query text (in the shape of a chromaDB query result for one query)."""
+        if self.window <= 0 or self.max_batch == 1:
+            return await asyncio.to_thread(self.run_batch, [text], n_results, where)
+        loop = asyncio.get_running_loop()
+        key = where_key(where)
+        batch = self._pending.get(key)
+        if batch is None:
+            batch = self._pending[key] = _Batch(where)
+            # the batch runs outside of the context of the request which opened it, its spans belong to no request
+            batch.timer = loop.call_later(self.window, self._flush, key, batch, context=contextvars.Context())
+        future = loop.create_future()
+        batch.queries.append((text, n_results, future))
+        if len(batch.queries) >= self.max_batch:
+            self._flush(key, batch)
+        return await future
+
+    def _flush(self, key: str, batch: _Batch):
+        """Stop collecting queries for a batch and run it."""
+        if self._pending.get(key) is batch:
+            del self._pending[key]
+        batch.timer.cancel()
+        # (the task copies the context it is created in, an empty one: create_task(context=...) needs python 3.11)
+        contextvars.Context().run(asyncio.get_running_loop().create_task, self._run(batch))
+
+    async def _run(self, batch: _Batch):
+        """Run the queries of a batch with one call, and hand every query its part of the result."""
+        texts = list(dict.fromkeys(text for text, _n_results, _future in batch.queries))
+        n_results = max(n for _text, n, _future in batch.queries)
+        VECTOR_BATCH_SIZE.observe(len(batch.queries))
+        try:
+            results = await asyncio.to_thread(self.run_batch, texts, n_results, batch.where)
+        except Exception as e:
+            logging.error(f"Batched vector query of {len(texts)} queries failed: {e}")
+            for _text, _n_results, future in batch.queries:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        index = {text: i for i, text in enumerate(texts)}
+        for text, n, future in batch.queries:
+            if not future.done():       # the request might be gone (cancelled)
+                # the hits of a query are sorted by distance, so the first n are the ones of a query for n
+                future.set_result({field: [results[field][index[text]][:n]] if results.get(field) is not None else None
+                                   for field in RESULT_FIELDS})
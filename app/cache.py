@@ -0,0 +1,359 @@
+"""Small two-tier (memory + disk) cache used to avoid paying twice for the same work.
+
+The in-process tier is an LRU dict with an optional TTL. The persistent tier is a
+SQLite file which survives restarts and can be shared between several processes
+(uvicorn workers, the ingest script, ...). Values must be JSON serializable.
+Reads of the disk tier never write: the access times (for the LRU eviction) are
+collected and written together with the next writes. Async code uses aget()/aset(),
+which run the disk tier in a worker thread.
+
+Example:
+    cache = TieredCache(DiskCache("./cache.db", namespace="translation"))
+    key = make_key("deepl", "Hallo Welt", "de", "EN-US")
+    if (value := cache.get(key)) is None:
+        value = expensive_call()
+        cache.set(key, value)
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+from app.vectorstore import DATA_DIR
+
+
+TRANSLATION_CACHE_PATH = os.getenv("TRANSLATION_CACHE_PATH", os.path.join(DATA_DIR, "translation_cache.db"))
+TRANSLATION_CACHE_MAX_ENTRIES = int(os.getenv("TRANSLATION_CACHE_MAX_ENTRIES", "500000"))
+TRANSLATION_CACHE_TTL = float(os.getenv("TRANSLATION_CACHE_TTL", "0"))     # seconds, 0 means: never expire
+TRANSLATION_CACHE_MEMORY_ENTRIES = int(os.getenv("TRANSLATION_CACHE_MEMORY_ENTRIES", "10000"))
+# the /search response cache, by default in memory only (set a path, e.g. the one of the translation cache, to share it between workers)
+SEARCH_CACHE_PATH = os.getenv("SEARCH_CACHE_PATH", "")
+SEARCH_CACHE_MAX_ENTRIES = int(os.getenv("SEARCH_CACHE_MAX_ENTRIES", "10000"))
+SEARCH_CACHE_TTL = float(os.getenv("SEARCH_CACHE_TTL", "3600"))     # seconds, 0 means: never expire
+SEARCH_CACHE_MEMORY_ENTRIES = int(os.getenv("SEARCH_CACHE_MEMORY_ENTRIES", "1000"))
+# the vectors of the embedded chunks (see app.embeddings), so a re-ingest only embeds what changed
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", os.path.join(DATA_DIR, "embedding_cache.db"))
+EMBEDDING_CACHE_MAX_ENTRIES = int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", "5000000"))
+EMBEDDING_CACHE_MEMORY_ENTRIES = int(os.getenv("EMBEDDING_CACHE_MEMORY_ENTRIES", "10000"))
+# the access times of this many disk cache hits are collected before they are written
+ACCESS_FLUSH_ENTRIES = 1000
+
+
+def text_hash(text: str) -> str:
+    """Return the sha256 hex digest of a text."""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def make_key(*parts: Any) -> str:
+    """Build a content addressed cache key out of its parts.
+
+    Long parts (the source texts) are hashed, so the key stays short, no matter how big the input was.
+    """
+    return text_hash("\x1f".join("" if p is None else str(p) for p in parts))
+
+
+class MemoryCache():
+    """In-process LRU cache with an optional TTL."""
+
+    def __init__(self, max_entries: int = 10000, ttl: float = 0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[Any]:
+        """Return the cached value or None."""
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            value, created = item
+            if self.ttl and time.time() - created > self.ttl:
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: Any):
+        """Store a value, evicting the least recently used entries if needed."""
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._data[key] = (value, time.time())
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        """Drop all entries."""
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class DiskCache():
+    """Persistent cache in a SQLite file with size (LRU) and TTL eviction.
+
+    Several caches can share one file, each gets its own namespace.
+    """
+
+    def __init__(self, path: str, namespace: str = "default", max_entries: int = 0, ttl: float = 0):
+        self.path = path
+        self.namespace = namespace
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._writes = 0
+        # key -> time of the last hit, not written yet (see get())
+        self._accessed: Dict[str, float] = {}
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS cache (
+                namespace TEXT NOT NULL,
+                key TEXT NOT NULL,
+                value TEXT NOT NULL,
+                created REAL NOT NULL,
+                accessed REAL NOT NULL,
+                PRIMARY KEY (namespace, key)
+            )""")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS cache_accessed ON cache (namespace, accessed)")
+
+    def get(self, key: str) -> Optional[Any]:
+        """Return the cached value or None.
+
+        A lookup only reads, so it doesn't wait for the write lock of other processes. The access time is
+        remembered and written later (by set() or the eviction), expired entries are left to the eviction.
+        """
+        now = time.time()
+        with self._lock:
+            row = self.conn.execute("SELECT value, created FROM cache WHERE namespace = ? AND key = ?",
+                                    (self.namespace, key)).fetchone()
+            if row is None or (self.ttl and now - row[1] > self.ttl):
+                return None
+            self._accessed[key] = now
+        return json.loads(row[0])
+
+    def set(self, key: str, value: Any):
+        """Store a value."""
+        now = time.time()
+        with self._lock:
+            self.conn.execute("INSERT OR REPLACE INTO cache (namespace, key, value, created, accessed) VALUES (?, ?, ?, ?, ?)",
+                              (self.namespace, key, json.dumps(value), now, now))
+            self._accessed.pop(key, None)
+            self._writes += 1
+            if len(self._accessed) >= ACCESS_FLUSH_ENTRIES:
+                self._write_accessed()
+            if self._writes % 1000 == 0:
+                self._evict()
+
+    def _write_accessed(self):
+        """Write the collected access times in one transaction."""
+        if not self._accessed:
+            return
+        accessed, self._accessed = self._accessed, {}
+        with self.conn:
+            self.conn.execute("BEGIN")
+            self.conn.executemany("UPDATE cache SET accessed = MAX(accessed, ?) WHERE namespace = ? AND key = ?",
+                                  [(when, self.namespace, key) for key, when in accessed.items()])
+
+    def _evict(self):
+        """Remove expired entries and, if the namespace is too big, the least recently used ones."""
+        self._write_accessed()
+        if self.ttl:
+            self.conn.execute("DELETE FROM cache WHERE namespace = ? AND created < ?", (self.namespace, time.time() - self.ttl))
+        if self.max_entries:
+            self.conn.execute("""
+                DELETE FROM cache WHERE namespace = ? AND key IN (
+                    SELECT key FROM cache WHERE namespace = ? ORDER BY accessed DESC LIMIT -1 OFFSET ?
+                )""", (self.namespace, self.namespace, self.max_entries))
+
+    def evict(self):
+        """Run the eviction now (normally it runs every 1000 writes)."""
+        with self._lock:
+            self._evict()
+
+    def clear(self):
+        """Drop all entries of this namespace."""
+        with self._lock:
+            self.conn.execute("DELETE FROM cache WHERE namespace = ?", (self.namespace,))
+
+    def __len__(self):
+        with self._lock:
+            return self.conn.execute("SELECT COUNT(*) FROM cache WHERE namespace = ?", (self.namespace,)).fetchone()[0]
+
+    def close(self):
+        """Write the collected access times and close the SQLite connection."""
+        with self._lock:
+            self._write_accessed()
+        self.conn.close()
+
+
+class TieredCache():
+    """A MemoryCache in front of an (optional) DiskCache, with hit/miss counters."""
+
+    def __init__(self, disk: Optional[DiskCache] = None, memory_entries: int = 10000, ttl: float = 0):
+        self.memory = MemoryCache(max_entries=memory_entries, ttl=ttl)
+        self.disk = disk
+        self.hits_memory = 0
+        self.hits_disk = 0
+        self.misses = 0
+
+    def get(self, key: str, disk: bool = True) -> Optional[Any]:
+        """Look up the memory tier first, then the disk tier (disk=False: only the memory tier)."""
+        value = self.memory.get(key)
+        if value is not None:
+            self.hits_memory += 1
+            return value
+        if not disk:
+            self.misses += 1
+            return None
+        return self._get_disk(key)
+
+    async def aget(self, key: str) -> Optional[Any]:
+        """Async version of get(), the disk tier is looked up in a worker thread, so it never blocks the event loop."""
+        value = self.memory.get(key)
+        if value is not None:
+            self.hits_memory += 1
+            return value
+        if self.disk is None:
+            self.misses += 1
+            return None
+        return await asyncio.to_thread(self._get_disk, key)
+
+    def _get_disk(self, key: str) -> Optional[Any]:
+        if self.disk is not None:
+            try:
+                value = self.disk.get(key)
+            except sqlite3.Error as e:
+                logging.warning(f"Cache lookup failed: {e}")
+                value = None
+            if value is not None:
+                self.hits_disk += 1
+                self.memory.set(key, value)
+                return value
+        self.misses += 1
+        return None
+
+    def set(self, key: str, value: Any, disk: bool = True):
+        """Store a value in both tiers (disk=False: only in the memory tier)."""
+        self.memory.set(key, value)
+        if disk:
+            self._set_disk(key, value)
+
+    async def aset(self, key: str, value: Any):
+        """Async version of set(), the disk tier is written in a worker thread."""
+        self.memory.set(key, value)
+        if self.disk is not None:
+            await asyncio.to_thread(self._set_disk, key, value)
+
+    def _set_disk(self, key: str, value: Any):
+        if self.disk is not None:
+            try:
+                self.disk.set(key, value)
+            except sqlite3.Error as e:
+                logging.warning(f"Cache write failed: {e}")
+
+    def clear(self):
+        """Drop all entries of both tiers."""
+        self.memory.clear()
+        if self.disk is not None:
+            self.disk.clear()
+
+    def stats(self) -> dict:
+        """Return the hit/miss counters."""
+        lookups = self.hits_memory + self.hits_disk + self.misses
+        return {"hits_memory": self.hits_memory,
+                "hits_disk": self.hits_disk,
+                "misses": self.misses,
+                "hit_ratio": (self.hits_memory + self.hits_disk) / lookups if lookups else 0.0,
+                "memory_entries": len(self.memory)}
+
+
+_translation_cache = None
+_search_cache = None
+_embedding_cache = None
+_caches_lock = threading.Lock()
+
+
+def open_cache(path: str, namespace: str, max_entries: int, memory_entries: int, ttl: float) -> TieredCache:
+    """Build a TieredCache, with a disk tier in path (if path is not empty and the file can be opened)."""
+    disk = None
+    if path:
+        try:
+            disk = DiskCache(path, namespace=namespace, max_entries=max_entries, ttl=ttl)
+        except sqlite3.Error as e:
+            logging.error(f"Could not open the {namespace} cache {path}: {e}")
+    return TieredCache(disk, memory_entries=memory_entries, ttl=ttl)
+
+
+def get_translation_cache() -> TieredCache:
+    """Return the process wide translation cache (created on first use).
+
+    Set TRANSLATION_CACHE_PATH to an empty string to disable the disk tier.
+    """
+    global _translation_cache       # pylint: disable=global-statement
+    with _caches_lock:
+        if _translation_cache is None:
+            _translation_cache = open_cache(TRANSLATION_CACHE_PATH, "translation", TRANSLATION_CACHE_MAX_ENTRIES,
+                                            TRANSLATION_CACHE_MEMORY_ENTRIES, TRANSLATION_CACHE_TTL)
+        return _translation_cache
+
+
+def get_search_cache() -> TieredCache:
+    """Return the process wide cache of /search responses (created on first use).
+
+    Set SEARCH_CACHE_PATH to share it between several uvicorn workers.
+    """
+    global _search_cache       # pylint: disable=global-statement
+    with _caches_lock:
+        if _search_cache is None:
+            _search_cache = open_cache(SEARCH_CACHE_PATH, "search", SEARCH_CACHE_MAX_ENTRIES, SEARCH_CACHE_MEMORY_ENTRIES, SEARCH_CACHE_TTL)
+        return _search_cache
+
+
+def get_embedding_cache() -> TieredCache:
+    """Return the process wide cache of embedding vectors (created on first use, they never expire).
+
+    Set EMBEDDING_CACHE_PATH to an empty string to disable the disk tier.
+    """
+    global _embedding_cache       # pylint: disable=global-statement
+    with _caches_lock:
+        if _embedding_cache is None:
+            _embedding_cache = open_cache(EMBEDDING_CACHE_PATH, "embedding", EMBEDDING_CACHE_MAX_ENTRIES, EMBEDDING_CACHE_MEMORY_ENTRIES, 0)
+        return _embedding_cache
+
+
+def translation_cache_key(backend: str, src_text: str, src_language: Optional[str], dst_language: str, version: str = "") -> str:
+    """Key for a translation: (backend, hash of the source text, src/dst language, model/prompt version)."""
+    return make_key(backend, text_hash(src_text), (src_language or "").lower(), dst_language.lower(), version)
+
+
+def embedding_cache_key(model: str, text: str) -> str:
+    """Key for an embedding: (model and variant, hash of the text)."""
+    return make_key("embedding", model, text_hash(text))
+
+
+def normalize_query(query: str) -> str:
+    """Case and whitespace insensitive form of a search query."""
+    return " ".join(query.casefold().split())
+
+
+def search_cache_key(query: str, language: str, count: int, generation: str = "", offset: int = 0, filters: str = "") -> str:
+    """Key for a search response: (normalized query, detected language, number of answers, index generation, offset, filters).
+
+    The generation changes whenever the vector database is written to (see app.vectorstore.index_generation()),
+    so a re-ingest invalidates all cached responses. count -1 stands for the whole ranked list of a query.
+    """
+    return make_key("search", normalize_query(query), language, count, generation, offset or "", filters)
@@ -0,0 +1,100 @@
+"""Split texts into chunks which fit into a token budget.
+
+We need two kinds of chunks:
+  - for translating: big chunks (the LLM's context and output limits), without overlap,
+    because the translated chunks get joined again
+  - for embedding: small chunks (the embedding model only looks at the first few hundred tokens),
+    with some overlap, so that a sentence at the border of a chunk is still found with its context
+
+The text is cut at line and sentence boundaries, only a single sentence which is too long
+on its own is cut between words.
+"""
+
+import os
+import re
+
+from typing import Callable, Iterator, List, Optional
+
+from tokens import calc_tokens
+
+
+TRANSLATION_CHUNK_TOKENS = int(os.getenv("TRANSLATION_CHUNK_TOKENS", "2000"))
+EMBEDDING_CHUNK_TOKENS = int(os.getenv("EMBEDDING_CHUNK_TOKENS", "200"))
+EMBEDDING_CHUNK_OVERLAP_TOKENS = int(os.getenv("EMBEDDING_CHUNK_OVERLAP_TOKENS", "30"))
+
+# a sentence (up to ., ! or ? followed by whitespace) or a line, including the whitespace after it
+_UNIT_RE = re.compile(r'.*?(?:[.!?](?=\s)|\n|$)\s*', re.S)
+
+
+def count_tokens(text: str) -> int:
+    """Default token counter for chunking (tiktoken)."""
+    return calc_tokens(text, method='tiktoken')
+
+
+def split_units(text: str) -> List[str]:
+    """Split a text into sentences / lines. Each unit keeps its trailing whitespace, so "".join(units) == text."""
+    return [unit for unit in _UNIT_RE.findall(text) if unit]
+
+
+def _split_words(unit: str, max_tokens: int, count: Callable[[str], int]) -> Iterator[str]:
+    """Cut a unit which is too big on its own between words.
+
+    Every word is counted once and the counts are summed up (an upper bound of the tokens of the piece),
+    re-counting the growing piece would be quadratic on the long unpunctuated segments of transcripts.
+    """
+    piece, piece_tokens = "", 0
+    for word in re.findall(r'\S+\s*', unit):
+        tokens = count(word)
+        if piece and piece_tokens + tokens > max_tokens:
+            yield piece
+            piece, piece_tokens = "", 0
+        piece += word
+        piece_tokens += tokens
+    if piece:
+        yield piece
+
+
+def chunk_text(text: str, max_tokens: int, overlap_tokens: int = 0,
+               count: Optional[Callable[[str], int]] = None) -> Iterator[str]:
+    """Pack the sentences / lines of a text into chunks of at most max_tokens tokens.
+
+    Args:
+      text -- the text to split up
+      max_tokens -- the token budget of a chunk
+      overlap_tokens -- repeat up to this many tokens (whole sentences) of the end of a chunk at the start of the next one
+      count -- the token counter, by default tiktoken (see count_tokens())
+
+    Yields:
+      str -- the chunks (stripped, empty ones are skipped)
+    """
+    count = count or count_tokens
+    chunk, chunk_tokens = [], []
+    for unit in split_units(text):
+        tokens = count(unit)
+        pieces = [(unit, tokens)] if tokens <= max_tokens else [(p, count(p)) for p in _split_words(unit, max_tokens, count)]
+        for piece, tokens in pieces:
+            if chunk and sum(chunk_tokens) + tokens > max_tokens:
+                if "".join(chunk).strip():
+                    yield "".join(chunk).strip()
+                # keep the last units of the chunk as overlap, as long as they fit
+                budget = min(overlap_tokens, max_tokens - tokens)
+                keep, kept_tokens = 0, 0
+                while keep < len(chunk) and kept_tokens + chunk_tokens[-1 - keep] <= budget:
+                    kept_tokens += chunk_tokens[-1 - keep]
+                    keep += 1
+                chunk, chunk_tokens = chunk[len(chunk) - keep:], chunk_tokens[len(chunk) - keep:]
+            chunk.append(piece)
+            chunk_tokens.append(tokens)
+    if chunk and "".join(chunk).strip():
+        yield "".join(chunk).strip()
+
+
+def translation_chunks(text: str, max_tokens: int = TRANSLATION_CHUNK_TOKENS, count: Optional[Callable[[str], int]] = None) -> Iterator[str]:
+    """Chunks of a text for translating (no overlap)."""
+    return chunk_text(text, max_tokens, 0, count)
+
+
+def embedding_chunks(text: str, max_tokens: int = EMBEDDING_CHUNK_TOKENS, overlap_tokens: int = EMBEDDING_CHUNK_OVERLAP_TOKENS,
+                     count: Optional[Callable[[str], int]] = None) -> Iterator[str]:
+    """Chunks of a (translated) text for the embedding model / vector database."""
+    return chunk_text(text, max_tokens, overlap_tokens, count)
@@ -77,30 +77,34 @@ Concept
 
 """
 
+import asyncio
 import logging
 import sys
 import os
 
-from pprint import pprint
-from typing import List
+from datetime import datetime
+from typing import TYPE_CHECKING, Dict, Iterator, List, Optional, Tuple
 
-from tqdm import tqdm
-import pandas as pd
 import psycopg
+from psycopg_pool import AsyncConnectionPool, ConnectionPool, PoolTimeout
 from pydantic import BaseModel
 
-from app.misc import cleanup_text, convert_html_to_text
-from app.translation import translate
+from app.misc import convert_html_to_text
+
+if TYPE_CHECKING:
+    import pandas as pd     # only the stats need it, and it takes a while to import
 
 # this is an ugly hack to make chromaDB work with the sqlite3 module
 # see also https://stackoverflow.com/questions/77004853/chromadb-langchain-with-sentencetransformerembeddingfunction-throwing-sqlite3
 __import__('pysqlite3')
 sys.modules['sqlite3'] = sys.modules.pop('pysqlite3')
-import chromadb     # noqa:
 
 # Postgresql stuff for the repco database
 DEFAULT_DSN = "dbname=repco user=repco password=repco host=localhost"
 DSN = os.getenv("DSN", DEFAULT_DSN)
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "1"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
 
 
 class Concept(BaseModel):
@@ -144,6 +148,14 @@ class Transcript(BaseModel):
 
 CONTENTITEM_FIELDS = 'uid, "revisionId", subtitle, "pubDate", "contentFormat", "primaryGroupingUid", "licenseUid", "publicationServiceUid", title, summary, content, "contentUrl", "originalLanguages"'
 #                     0     1            2          3          4                5                     6             7                       8      9        10        11            12
+# sort key for streaming the table, see DB.iter_content_items() and content_item_key()
+# (an index on this expression makes the pagination cheap)
+CONTENTITEM_KEY = 'COALESCE("pubDate", \'0001-01-01\'::timestamp), uid'
+# transcripts belong to a media asset, which is linked to content items by the (prisma) relation table
+TRANSCRIPT_FIELDS = 't.uid, t."revisionId", t.language, t.text, t."mediaAssetUid", ci.uid, ci."pubDate", ci.title, ci."contentUrl", ci."primaryGroupingUid"'
+#                    0      1               2           3       4                  5       6             7         8               9
+TRANSCRIPT_JOIN = '"Transcript" t LEFT JOIN "_ContentItemToMediaAsset" cm ON cm."B" = t."mediaAssetUid" LEFT JOIN "ContentItem" ci ON ci.uid = cm."A"'
+CONTENT_BY_UIDS_SQL = 'SELECT uid, content FROM "ContentItem" WHERE uid = ANY(%s)'
 
 
 class ContentItem(BaseModel):
@@ -163,30 +175,45 @@ class ContentItem(BaseModel):
     originalLanguages: dict
 
 
+def content_item_key(row: tuple) -> Tuple[datetime, str]:
+    """Return the (pubDate, uid) sort key of a content item row, as used by DB.iter_content_items()."""
+    return (row[3] or datetime.min, row[0])
+
+
 class DB():
-    """Slim wrapper around psycopg."""
+    """Slim wrapper around a psycopg connection pool.
+
+    Every query borrows a connection from the pool and gets its own cursor,
+    so one DB object can be shared by concurrent threads.
+    """
 
     def __init__(self):
-        self.conn = self.connect_to_db()
-        self.cursor = self.conn.cursor()
+        self.pool = self.connect_to_db()
 
-    def query(self, sql: str, kwargs):
-        """Execute a query."""
-        self.cursor.execute(sql, kwargs)
-        return self.cursor.fetchall()
+    def query(self, sql: str, kwargs, prepare: bool = None):
+        """Execute a query.
+
+        prepare=True makes the server prepare the statement right away (instead of after a few executions).
+        """
+        with self.pool.connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(sql, kwargs, prepare=prepare)
+                return cursor.fetchall()
 
     def close(self):
-        """Close the connection."""
-        self.conn.close()
+        """Close the connection pool."""
+        self.pool.close()
 
-    def connect_to_db(self):
+    def connect_to_db(self) -> ConnectionPool:
         """Connect to the database."""
         try:
-            conn = psycopg.connect(conninfo=DSN)
-        except psycopg.Error as e:
+            pool = ConnectionPool(conninfo=DSN, min_size=DB_POOL_MIN_SIZE, max_size=DB_POOL_MAX_SIZE,
+                                  kwargs={"autocommit": True}, check=ConnectionPool.check_connection, open=True)
+            pool.wait(timeout=DB_POOL_TIMEOUT)
+        except (psycopg.Error, PoolTimeout) as e:
             logging.error(f"Error connecting to the database: {e}")
             sys.exit(1)
-        return conn
+        return pool
 
     def fetch_content_item_by_uid(self, uid) -> ContentItem:
         """Fetch a content item by its uid."""
@@ -196,33 +223,122 @@ class DB():
     def fetch_content_item_content_by_uid(self, uid: str) -> str:
         """Fetch the content of a content item by its uid."""
         sql = 'SELECT content FROM "ContentItem" WHERE uid = %s'
-        result = self.query(sql, (uid,))
+        result = self.query(sql, (uid,), prepare=True)
         if not result:
             logging.warning(f"Content item with uid {uid} not found.")
             return ""
         return result[0][0]
 
+    def fetch_content_items_by_uids(self, uids: List[str]) -> Dict[str, dict]:
+        """Fetch the content of many content items with one query.
+
+        Returns:
+          dict -- uid -> content column. Unknown uids are missing from the dict.
+        """
+        if not uids:
+            return {}
+        result = self.query(CONTENT_BY_UIDS_SQL, (list(uids),), prepare=True)
+        return dict(result)
+
     def fetch_all_content_items(self, limit: int = 0) -> List[ContentItem]:
         """Fetch all content items."""
         if limit > 0:
             sql = f'SELECT {CONTENTITEM_FIELDS} FROM "ContentItem" ORDER BY "pubDate" DESC LIMIT %s'
             return self.query(sql, (limit,))
-        sql = 'SELECT * FROM "ContentItem" ORDER BY pubDate DESC'
+        sql = f'SELECT {CONTENTITEM_FIELDS} FROM "ContentItem" ORDER BY "pubDate" DESC'
         return self.query(sql, {})
 
     def fetch_random_content_items(self, limit: int = 0, seed: float = None) -> List[ContentItem]:
         """Fetch random content items."""
-        if seed:
-            sql = f'SELECT setseed({seed});'
-            _result = self.query(sql, seed)
         if limit > 0:
-            sql = f'SELECT {CONTENTITEM_FIELDS} FROM "ContentItem" ORDER BY RANDOM() LIMIT %s'''
-            return self.query(sql, (limit,))
-        sql = f'SELECT {CONTENTITEM_FIELDS} FROM "ContentItem" ORDER BY RANDOM()'
-        return self.query(sql, {})
-
-    def stats_content_items(self) -> pd.DataFrame:
+            sql = f'SELECT {CONTENTITEM_FIELDS} FROM "ContentItem" ORDER BY RANDOM() LIMIT %s'
+            params = (limit,)
+        else:
+            sql = f'SELECT {CONTENTITEM_FIELDS} FROM "ContentItem" ORDER BY RANDOM()'
+            params = {}
+        # setseed() only affects the session it runs in, so both statements need the same connection
+        with self.pool.connection() as conn:
+            with conn.cursor() as cursor:
+                if seed:
+                    cursor.execute('SELECT setseed(%s)', (seed,))
+                cursor.execute(sql, params)
+                return cursor.fetchall()
+
+    def iter_content_items(self, after: Optional[Tuple[datetime, str]] = None, page_size: int = 1000) -> Iterator[tuple]:
+        """Stream all content items, ordered by (pubDate, uid).
+
+        The rows are read page by page (keyset pagination: every page continues after the
+        (pubDate, uid) of the previous one) through a server side cursor, so this process
+        never holds more than one page. Rows without a pubDate come first.
+
+        Args:
+          after -- only return rows after this (pubDate, uid) key, see content_item_key()
+          page_size -- the number of rows per page
+
+        Yields:
+          tuple -- the CONTENTITEM_FIELDS of a content item
+        """
+        while True:
+            if after is None:
+                sql = f'SELECT {CONTENTITEM_FIELDS} FROM "ContentItem" ORDER BY {CONTENTITEM_KEY} LIMIT %s'
+                params = (page_size,)
+            else:
+                sql = f'SELECT {CONTENTITEM_FIELDS} FROM "ContentItem" WHERE ({CONTENTITEM_KEY}) > (%s, %s) ORDER BY {CONTENTITEM_KEY} LIMIT %s'
+                params = (after[0], after[1], page_size)
+            page = self._read_page(sql, params, page_size)
+            yield from page
+            if len(page) < page_size:
+                return
+            after = content_item_key(page[-1])
+
+    def iter_transcripts(self, after: Optional[str] = None, page_size: int = 10) -> Iterator[tuple]:
+        """Stream all transcripts with their content item, ordered by the uid of the transcript.
+
+        Works like iter_content_items(), but transcripts are big (up to ~27k tokens), so the pages are small.
+
+        Args:
+          after -- only return transcripts with a uid after this one
+          page_size -- the number of rows per page
+
+        Yields:
+          tuple -- the TRANSCRIPT_FIELDS of a transcript (the content item fields are None if there is no content item)
+        """
+        while True:
+            sql = f'SELECT DISTINCT ON (t.uid) {TRANSCRIPT_FIELDS} FROM {TRANSCRIPT_JOIN} WHERE t.uid > %s ORDER BY t.uid LIMIT %s'
+            page = self._read_page(sql, (after or "", page_size), page_size)
+            yield from page
+            if len(page) < page_size:
+                return
+            after = page[-1][0]
+
+    def _read_page(self, sql: str, params, page_size: int) -> List[tuple]:
+        """Read one page of rows through a server side cursor."""
+        # the page is read completely before it is handed out: the consumer might take
+        # a long time per row and we don't want to keep a transaction open meanwhile
+        with self.pool.connection() as conn:
+            # named (server side) cursors need a transaction, the pool connections are in autocommit mode
+            with conn.transaction():
+                with conn.cursor(name="read_page") as cursor:
+                    cursor.itersize = min(page_size, 500)
+                    cursor.execute(sql, params)
+                    return list(cursor)
+
+    def stream_query(self, sql: str, kwargs=None, itersize: int = 2000) -> Iterator[tuple]:
+        """Execute a query and stream the rows through a server side cursor (itersize rows at a time).
+
+        The connection and its transaction stay open until the iterator is exhausted or closed,
+        so this is meant for quick consumers (like counting), not for long running ingests.
+        """
+        with self.pool.connection() as conn:
+            with conn.transaction():
+                with conn.cursor(name="stream_query") as cursor:
+                    cursor.itersize = itersize
+                    cursor.execute(sql, kwargs)
+                    yield from cursor
+
+    def stats_content_items(self) -> "pd.DataFrame":
         """Get stats on content items."""
+        import pandas as pd     # pylint: disable=import-outside-toplevel,redefined-outer-name
         sql = """
                 SELECT each_entry.key, COUNT(each_entry.key) as key_count
                 FROM "ContentItem",
@@ -234,6 +350,63 @@ class DB():
         return df
 
 
+class AsyncDB():
+    """Slim async wrapper around a psycopg connection pool, for the FastAPI app.
+
+    The pool is opened on first use. Every query gets its own connection and cursor.
+    """
+
+    def __init__(self):
+        self.pool = None
+        self._connect_lock = None
+
+    async def connect_to_db(self) -> AsyncConnectionPool:
+        """Open the connection pool (if it is not open yet)."""
+        if self._connect_lock is None:
+            self._connect_lock = asyncio.Lock()
+        async with self._connect_lock:
+            if self.pool is None:
+                pool = AsyncConnectionPool(conninfo=DSN, min_size=DB_POOL_MIN_SIZE, max_size=DB_POOL_MAX_SIZE,
+                                           kwargs={"autocommit": True}, check=AsyncConnectionPool.check_connection, open=False)
+                try:
+                    await pool.open(wait=True, timeout=DB_POOL_TIMEOUT)
+                except (psycopg.Error, PoolTimeout) as e:
+                    logging.error(f"Error connecting to the database: {e}")
+                    await pool.close()
+                    raise
+                self.pool = pool
+        return self.pool
+
+    async def query(self, sql: str, kwargs, prepare: bool = None):
+        """Execute a query."""
+        pool = await self.connect_to_db()
+        async with pool.connection() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute(sql, kwargs, prepare=prepare)
+                return await cursor.fetchall()
+
+    async def close(self):
+        """Close the connection pool."""
+        if self.pool is not None:
+            await self.pool.close()
+
+    async def fetch_content_item_content_by_uid(self, uid: str) -> str:
+        """Fetch the content of a content item by its uid."""
+        sql = 'SELECT content FROM "ContentItem" WHERE uid = %s'
+        result = await self.query(sql, (uid,), prepare=True)
+        if not result:
+            logging.warning(f"Content item with uid {uid} not found.")
+            return ""
+        return result[0][0]
+
+    async def fetch_content_items_by_uids(self, uids: List[str]) -> Dict[str, dict]:
+        """Fetch the content of many content items with one query (see DB.fetch_content_items_by_uids)."""
+        if not uids:
+            return {}
+        result = await self.query(CONTENT_BY_UIDS_SQL, (list(uids),), prepare=True)
+        return dict(result)
+
+
 def combine_content_item_colums(content_item: ContentItem) -> str:
     """Combine the columns of a content item into a single string.
     This combines the title, subtitle, summary, and content columns into a single string and
@@ -255,82 +428,3 @@ def combine_content_item_colums(content_item: ContentItem) -> str:
             # FIXME: here we might escape any existing '|' in the text
             combined += f"{text} "   # we don't need a separator here, \n is already in the text
     return combined
-
-
-if __name__ == "__main__":
-    chroma_client = chromadb.PersistentClient(path="./chroma.db")
-    collection = chroma_client.get_or_create_collection(name="ContentItems")
-    logging.info(f"{collection.count()=}")
-
-    # make a pandas df for collecting all the data which gets stored into the vector database
-    df_content_items = pd.DataFrame(columns=["id", "url", "pubDate", "title", "text", "dst_text"])
-
-    db = DB()   # the postgresql DB
-    df = db.stats_content_items()
-    print(df.head())
-    row = db.fetch_content_item_by_uid(('eaykah2ikjffarfaszdfxedk5fq',))
-    row2 = db.fetch_content_item_by_uid(('eayj634lmufeqr65fkcgymtcsgs',))
-    rows = [row[0], row2[0]]
-
-    rows = db.fetch_random_content_items(4500)
-    # pprint(rows)
-    # XXX NOTE: this is a list of https://en.wikipedia.org/wiki/List_of_ISO_639_language_codes .
-    # But it would be better to get them from the official source
-    LANGUAGES = ['de', 'en', 'pl', 'sl', 'fa', 'hu', 'es', 'ar', 'fr', 'ru', 'it', 'sv', 'sq', 'lt', 'bs', 'zh', 'tr', 'bg', 'ku', 'cs', 'hr', 'pt', 'az', 'no', 'da', 'et',
-                 'el', 'so', 'sk', 'sr', 'nl', 'uk', 'ro', 'ca', 'lv', 'an', 'be', 'mk', 'fi', 'th', 'ce', 'am', 'is', 'cy', 'mC', 'rm', 'ur', 'si', 'he', 'ko', 'yi', 'tu', 'ja']
-
-    logging.info("Starting to translate the content items")
-    for row in tqdm(rows):
-        for language in LANGUAGES:
-            if language in row[9]:      # example: row[9] is {'de': {'value': 'text in German'}}
-                text = combine_content_item_colums(row)
-                text = cleanup_text(text)
-                src_language = language
-                dst_language = 'en'
-                id = row[0]             # pylint: disable=redifined-builtin
-                url = row[11]
-                pubDate = str(row[3].date())
-                title = row[8]
-                parsed_title = ''       # pylint: disable=invalid-name
-                for _language in LANGUAGES:     # FIXME: this should be more elegant
-                    if _language in title and 'value' in title[_language]:
-                        parsed_title = cleanup_text(title[_language]['value'])
-                        break   # we found it
-                pprint(f"{text=}, {src_language=}, {dst_language=}, {id=}, {url=}, {pubDate=}, {parsed_title=}", indent=2)
-                if src_language != dst_language:
-                    try:
-                        dst_text = translate(src_text=text, dst_language=dst_language, _src_language=src_language)
-                    except Exception as e:
-                        logging.error(f"Translation failed for {id}: {e}")
-                        logging.debug(f"Dump of the row: {row}")
-                        dst_text = None
-                        continue
-                    if not dst_text:
-                        logging.warning("Translation failed for ID %s" % id)
-                else:
-                    dst_text = text
-                    # now add the document to the vector database
-
-                # now we split the text into sentences and add them to the vector database
-                # split by \n
-                sentences = dst_text.split("\n")    # might want to explore other chunking methods here
-                for sentence in sentences:
-                    sentence = sentence.strip()
-                    if not sentence:
-                        continue
-                    print(f"Adding sentence: {sentence}")
-                    collection.add(documents=[sentence],
-                                   metadatas=[{"title": parsed_title, "date": pubDate, "language": src_language, "url": url}],
-                                   ids=[row[0]])
-                # append the whole row (translated & original) to the pandas df_content_items
-                df2 = pd.DataFrame({"id": id, "url": url,
-                                    "pubDate": pubDate, "title": parsed_title, "text": text,
-                                    "dst_text": dst_text}, index=[0])
-                df_content_items = pd.concat([df_content_items, df2], ignore_index=True)
-                break
-    db.close()
-
-    # finally write the df_content_items to an XLSX file via pandas:
-    df_content_items.to_excel("content_items.xlsx", index=False)
-    print("Data written to content_items.xksx")
-    print(df_content_items.head())
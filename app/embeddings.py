@@ -0,0 +1,229 @@
+"""Embedding backends for the vector database, with a persistent cache of the vectors.
+
+The ingest (see app.ingest) and the search (see app.main) embed with the same backend, chromaDB
+only stores and searches the vectors. The backend is pluggable (EMBEDDING_BACKEND, see
+register_embedding_backend()):
+
+  - onnx (default): all-MiniLM-L6-v2 with onnxruntime, the model chromaDB uses by default, so an
+    existing chroma.db stays valid. EMBEDDING_VARIANT picks model_fp16.onnx or model_int8.onnx out of
+    EMBEDDING_MODEL_DIR instead of model.onnx (int8 is quantized on first use if the onnx package is there),
+    EMBEDDING_THREADS sets the onnxruntime threads
+  - sentence-transformers: any sentence-transformers model (EMBEDDING_MODEL), fp16 / int8 with torch
+
+Vectors are cached by (model and variant, hash of the text), so a re-ingest only embeds chunks whose
+text changed. A new model or variant gives different vectors: rebuild the chroma.db after changing it.
+
+Example:
+    vectors = get_embedder().embed(["what is the climate crisis"])
+"""
+
+import logging
+import os
+import threading
+
+from array import array
+from base64 import b64decode, b64encode
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from app.cache import TieredCache, embedding_cache_key, get_embedding_cache
+
+
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "onnx")
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "all-MiniLM-L6-v2")
+# fp32, fp16 or int8
+EMBEDDING_VARIANT = os.getenv("EMBEDDING_VARIANT", "fp32")
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "32"))
+# threads per model call, 0 means: the runtime's default (all cores)
+EMBEDDING_THREADS = int(os.getenv("EMBEDDING_THREADS", "0"))
+# for the onnx backend: the directory with tokenizer.json and the model files, empty means: chromaDB's download of all-MiniLM-L6-v2
+EMBEDDING_MODEL_DIR = os.getenv("EMBEDDING_MODEL_DIR", "")
+# all-MiniLM-L6-v2 is trained on up to 256 tokens
+EMBEDDING_MAX_TOKENS = 256
+
+EMBEDDING_VARIANTS = ("fp32", "fp16", "int8")
+
+# EMBEDDING_BACKEND -> factory returning (model name, function which embeds a batch of texts)
+EMBEDDING_BACKENDS: Dict[str, Callable[[], Tuple[str, Callable[[Sequence[str]], List[List[float]]]]]] = {}
+_embedder = None
+_embedder_lock = threading.Lock()
+
+
+def register_embedding_backend(name: str):
+    """Decorator to register an embedding backend for EMBEDDING_BACKEND=name."""
+    def _register(factory: Callable[[], Tuple[str, Callable[[Sequence[str]], List[List[float]]]]]):
+        EMBEDDING_BACKENDS[name] = factory
+        return factory
+    return _register
+
+
+class OnnxEmbedder():
+    """A sentence-transformers style model (mean pooling, normalized) exported to ONNX, run with onnxruntime."""
+
+    def __init__(self, model_dir: str = "", variant: str = EMBEDDING_VARIANT, threads: int = EMBEDDING_THREADS,
+                 batch_size: int = EMBEDDING_BATCH_SIZE, max_tokens: int = EMBEDDING_MAX_TOKENS):
+        """
+        Args:
+          model_dir -- the directory with tokenizer.json and model.onnx (and model_fp16.onnx / model_int8.onnx),
+            empty means: chromaDB's all-MiniLM-L6-v2 (downloaded if needed)
+          variant -- fp32, fp16 or int8
+          threads -- the intra op threads of onnxruntime, 0 means: its default
+          batch_size -- the number of texts per model call
+          max_tokens -- longer texts are truncated
+        """
+        import numpy as np      # pylint: disable=import-outside-toplevel
+        import onnxruntime as ort       # pylint: disable=import-outside-toplevel
+        from tokenizers import Tokenizer        # pylint: disable=import-outside-toplevel
+        self.np = np
+        if variant not in EMBEDDING_VARIANTS:
+            raise ValueError(f"Unknown EMBEDDING_VARIANT {variant}, choose one of {EMBEDDING_VARIANTS}")
+        self.model_dir = model_dir or self.default_model_dir()
+        self.batch_size = batch_size
+        self.tokenizer = Tokenizer.from_file(os.path.join(self.model_dir, "tokenizer.json"))
+        self.tokenizer.enable_truncation(max_length=max_tokens)
+        # pad to the longest text of a batch (not to max_tokens), short queries are much faster that way
+        self.tokenizer.enable_padding(pad_id=0, pad_token="[PAD]")
+        options = ort.SessionOptions()
+        options.log_severity_level = 3
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads > 0:
+            options.intra_op_num_threads = threads
+            options.inter_op_num_threads = 1
+        self.session = ort.InferenceSession(self.model_path(variant), sess_options=options, providers=["CPUExecutionProvider"])
+        self.input_names = {i.name for i in self.session.get_inputs()}
+        logging.info(f"Loaded the {variant} embedding model out of {self.model_dir}")
+
+    @staticmethod
+    def default_model_dir() -> str:
+        """chromaDB's all-MiniLM-L6-v2, downloaded on first use."""
+        import app.db       # noqa: pylint: disable=import-outside-toplevel,unused-import  # the sqlite3 hack for chromaDB
+        from chromadb.utils.embedding_functions.onnx_mini_lm_l6_v2 import ONNXMiniLM_L6_V2  # pylint: disable=import-outside-toplevel
+        model = ONNXMiniLM_L6_V2()
+        model._download_model_if_not_exists()       # pylint: disable=protected-access
+        return os.path.join(model.DOWNLOAD_PATH, model.EXTRACTED_FOLDER_NAME)
+
+    def model_path(self, variant: str) -> str:
+        """The model file of a variant, int8 models are quantized out of the fp32 one if needed."""
+        path = os.path.join(self.model_dir, "model.onnx" if variant == "fp32" else f"model_{variant}.onnx")
+        if variant == "int8" and not os.path.exists(path):
+            from onnxruntime.quantization import QuantType, quantize_dynamic       # pylint: disable=import-outside-toplevel
+            logging.info(f"Quantizing the embedding model to {path}")
+            quantize_dynamic(os.path.join(self.model_dir, "model.onnx"), path, weight_type=QuantType.QInt8)
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"No {variant} embedding model {path} (e.g. onnx/{os.path.basename(path)} of Xenova/all-MiniLM-L6-v2)")
+        return path
+
+    def embed(self, texts: Sequence[str]) -> List[List[float]]:
+        """The normalized embeddings of texts."""
+        np = self.np
+        vectors = []
+        for start in range(0, len(texts), self.batch_size):
+            encoded = self.tokenizer.encode_batch(list(texts[start:start + self.batch_size]))
+            input_ids = np.array([e.ids for e in encoded], dtype=np.int64)
+            attention_mask = np.array([e.attention_mask for e in encoded], dtype=np.int64)
+            inputs = {"input_ids": input_ids, "attention_mask": attention_mask, "token_type_ids": np.zeros_like(input_ids)}
+            hidden = self.session.run(None, {name: value for name, value in inputs.items() if name in self.input_names})[0].astype(np.float32)
+            # mean pooling over the (not padded) tokens
+            mask = attention_mask[:, :, None].astype(np.float32)
+            pooled = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+            norms = np.linalg.norm(pooled, axis=1, keepdims=True)
+            vectors.extend((pooled / np.clip(norms, 1e-12, None)).tolist())
+        return vectors
+
+
+@register_embedding_backend('onnx')
+def _onnx_backend() -> Tuple[str, Callable[[Sequence[str]], List[List[float]]]]:
+    embedder = OnnxEmbedder(EMBEDDING_MODEL_DIR, EMBEDDING_VARIANT, EMBEDDING_THREADS, EMBEDDING_BATCH_SIZE)
+    # without a model directory, it's chromaDB's all-MiniLM-L6-v2
+    model = EMBEDDING_MODEL if EMBEDDING_MODEL_DIR else "all-MiniLM-L6-v2"
+    return f"onnx:{model}:{EMBEDDING_VARIANT}", embedder.embed
+
+
+@register_embedding_backend('sentence-transformers')
+def _sentence_transformers_backend() -> Tuple[str, Callable[[Sequence[str]], List[List[float]]]]:
+    import torch        # pylint: disable=import-outside-toplevel
+    from sentence_transformers import SentenceTransformer      # pylint: disable=import-outside-toplevel
+    if EMBEDDING_VARIANT not in EMBEDDING_VARIANTS:
+        raise ValueError(f"Unknown EMBEDDING_VARIANT {EMBEDDING_VARIANT}, choose one of {EMBEDDING_VARIANTS}")
+    if EMBEDDING_THREADS > 0:
+        torch.set_num_threads(EMBEDDING_THREADS)
+    model = SentenceTransformer(EMBEDDING_MODEL, device="cpu" if EMBEDDING_VARIANT == "int8" else None)
+    if EMBEDDING_VARIANT == "fp16":
+        model = model.half()
+    elif EMBEDDING_VARIANT == "int8":
+        model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+    def embed(texts: Sequence[str]) -> List[List[float]]:
+        return model.encode(list(texts), batch_size=EMBEDDING_BATCH_SIZE, normalize_embeddings=True).astype("float32").tolist()
+    return f"sentence-transformers:{EMBEDDING_MODEL}:{EMBEDDING_VARIANT}", embed
+
+
+def encode_vector(vector: Sequence[float]) -> str:
+    """A compact (float32, base64) form of a vector for the cache."""
+    return b64encode(array("f", vector).tobytes()).decode("ascii")
+
+
+def decode_vector(encoded: str) -> List[float]:
+    """The vector of encode_vector()."""
+    vector = array("f")
+    vector.frombytes(b64decode(encoded))
+    return vector.tolist()
+
+
+class Embedder():
+    """Embeds texts with a backend, the vectors are cached. Build it once (see get_embedder()), the model is reused.
+
+    An Embedder can be used as the embedding_function of app.vectorstore.ChunkWriter.
+    """
+
+    def __init__(self, backend: Optional[str] = None, cache: Optional[TieredCache] = None):
+        """
+        Args:
+          backend -- the name of a registered backend, by default EMBEDDING_BACKEND
+          cache -- the cache of the vectors, by default the process wide one (see app.cache.get_embedding_cache())
+        """
+        self.backend = backend or EMBEDDING_BACKEND
+        if self.backend not in EMBEDDING_BACKENDS:
+            raise ValueError(f"Unknown EMBEDDING_BACKEND {self.backend}, choose one of {sorted(EMBEDDING_BACKENDS)}")
+        self.model_name, self._embed = EMBEDDING_BACKENDS[self.backend]()
+        self.cache = cache if cache is not None else get_embedding_cache()
+        self.texts_embedded = 0
+        self.texts_cached = 0
+
+    def embed(self, texts: Sequence[str], persist: bool = True) -> List[List[float]]:
+        """The embeddings of texts, only the texts which are not cached (and each of them once) go to the model.
+
+        persist=False only uses the memory tier of the cache, e.g. for search queries: they are seldom
+        embedded again, and must neither fill up the disk cache nor wait for the lock of an ingest writing to it.
+        """
+        vectors = [None] * len(texts)
+        todo: Dict[str, List[int]] = {}
+        for i, text in enumerate(texts):
+            cached = self.cache.get(embedding_cache_key(self.model_name, text), disk=persist)
+            if cached is not None:
+                vectors[i] = decode_vector(cached)
+            else:
+                todo.setdefault(text, []).append(i)
+        self.texts_cached += len(texts) - sum(len(indices) for indices in todo.values())
+        if todo:
+            for text, vector in zip(todo, self._embed(list(todo))):
+                self.cache.set(embedding_cache_key(self.model_name, text), encode_vector(vector), disk=persist)
+                for i in todo[text]:
+                    vectors[i] = vector
+            self.texts_embedded += len(todo)
+        return vectors
+
+    def __call__(self, texts: Sequence[str]) -> List[List[float]]:
+        return self.embed(texts)
+
+    def warm_up(self):
+        """Run the model once (bypassing the cache), so the first real call doesn't pay for the lazy initialization."""
+        self._embed(["warm-up"])
+
+
+def get_embedder() -> Embedder:
+    """Return the process wide Embedder for EMBEDDING_BACKEND (built on first use, this loads the model)."""
+    global _embedder      # pylint: disable=global-statement
+    with _embedder_lock:
+        if _embedder is None:
+            _embedder = Embedder()
+        return _embedder
@@ -0,0 +1,200 @@
+"""Streaming export of the ingested content items (id, url, pubDate, title, text, dst_text).
+
+The ingest hands every content item to an export, which buffers the rows and writes them out while
+the ingest runs, so the memory stays flat and a killed run keeps what it exported:
+
+    JSONL (default, INGEST_EXPORT_FILE=$DATA_DIR/content_items.jsonl): one JSON object per line, appended
+    Parquet (INGEST_EXPORT_FILE=$DATA_DIR/content_items.parquet, needs pyarrow): a directory of part files,
+        one row group of INGEST_EXPORT_ROW_GROUP_SIZE rows each, every part is written atomically
+
+A resumed ingest appends to the export of the previous run. The ingest checkpoint only moves forward
+once the rows of its items are exported (see flush()), so after a crash some items might be exported
+twice, but none are missing. Readers keep the last row per id (see iter_export()).
+
+The XLSX file is made on demand out of the export:
+
+    python -m app.export --xlsx content_items.xlsx
+"""
+
+import abc
+import argparse
+import glob
+import json
+import logging
+import os
+import shutil
+
+from typing import TYPE_CHECKING, Dict, Iterator, List
+
+from app.vectorstore import DATA_DIR
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+
+EXPORT_FILE = os.getenv("INGEST_EXPORT_FILE", os.path.join(DATA_DIR, "content_items.jsonl"))
+# rows per Parquet part file (JSONL rows are written at every flush)
+EXPORT_ROW_GROUP_SIZE = int(os.getenv("INGEST_EXPORT_ROW_GROUP_SIZE", "1000"))
+
+EXPORT_COLUMNS = ("id", "url", "pubDate", "title", "text", "dst_text")
+
+
+def export_row(record: dict) -> Dict[str, str]:
+    """The export columns of a record (see app.ingest.write_content_item), as strings."""
+    return {column: "" if record.get(column) is None else str(record[column]) for column in EXPORT_COLUMNS}
+
+
+class Export(abc.ABC):
+    """Buffers the rows of the content items and writes them out in chunks (the subclasses write them into a format)."""
+
+    def __init__(self, path: str, resume: bool = True, min_rows: int = 0):
+        """
+        Args:
+          path -- the export file (or directory)
+          resume -- append to an existing export, otherwise it is replaced
+          min_rows -- flush(force=False) only writes once that many rows are buffered
+        """
+        self.path = path
+        self.resume = resume
+        self.min_rows = min_rows
+        self.rows: List[Dict[str, str]] = []
+        self.rows_written = 0
+
+    def write(self, record: dict):
+        """Add the row of a content item."""
+        self.rows.append(export_row(record))
+
+    def flush(self, force: bool = True) -> bool:
+        """Write the buffered rows, returns whether everything added so far is written."""
+        if not force and len(self.rows) < self.min_rows:
+            return not self.rows
+        if self.rows:
+            self._write_rows(self.rows)
+            self.rows_written += len(self.rows)
+            self.rows = []
+        return True
+
+    @abc.abstractmethod
+    def _write_rows(self, rows: List[Dict[str, str]]):
+        """Write rows (they are not buffered again)."""
+
+    def close(self):
+        """Write the rest."""
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class JsonlExport(Export):
+    """An export into a JSON lines file."""
+
+    def __init__(self, path: str, resume: bool = True):
+        super().__init__(path, resume)
+        if resume:
+            _drop_partial_line(path)
+        self._file = open(path, "a" if resume else "w", encoding="utf-8")     # pylint: disable=consider-using-with
+
+    def _write_rows(self, rows: List[Dict[str, str]]):
+        self._file.write("".join(json.dumps(row, ensure_ascii=False) + "\n" for row in rows))
+        self._file.flush()
+
+    def close(self):
+        super().close()
+        self._file.close()
+
+
+def _drop_partial_line(path: str):
+    """Cut off the unfinished last line a killed run might have left behind."""
+    if not os.path.exists(path):
+        return
+    with open(path, "rb+") as f:
+        size = end = f.seek(0, os.SEEK_END)
+        while end > 0:
+            start = max(end - 65536, 0)
+            f.seek(start)
+            newline = f.read(end - start).rfind(b"\n")
+            if newline >= 0:
+                end = start + newline + 1
+                break
+            end = start
+        if end < size:
+            logging.warning(f"Dropping the incomplete last line of {path}")
+            f.truncate(end)
+
+
+class ParquetExport(Export):
+    """An export into a directory of Parquet part files, one row group of row_group_size rows each."""
+
+    def __init__(self, path: str, resume: bool = True, row_group_size: int = EXPORT_ROW_GROUP_SIZE):
+        import pyarrow as pa     # pylint: disable=import-outside-toplevel
+        super().__init__(path, resume, min_rows=max(row_group_size, 1))
+        if not resume and os.path.isdir(path):
+            shutil.rmtree(path)
+        os.makedirs(path, exist_ok=True)
+        self.schema = pa.schema([(column, pa.string()) for column in EXPORT_COLUMNS])
+        self.parts = len(_parquet_parts(path))
+
+    def _write_rows(self, rows: List[Dict[str, str]]):
+        import pyarrow as pa     # pylint: disable=import-outside-toplevel
+        import pyarrow.parquet as pq     # pylint: disable=import-outside-toplevel
+        part = os.path.join(self.path, f"part-{self.parts:06d}.parquet")
+        pq.write_table(pa.Table.from_pylist(rows, schema=self.schema), f"{part}.tmp", row_group_size=len(rows))
+        os.replace(f"{part}.tmp", part)
+        self.parts += 1
+
+
+def _parquet_parts(path: str) -> List[str]:
+    return sorted(glob.glob(os.path.join(path, "part-*.parquet")))
+
+
+def open_export(path: str = EXPORT_FILE, resume: bool = True) -> Export:
+    """The export for a path, Parquet for *.parquet, JSON lines otherwise."""
+    if path.endswith(".parquet"):
+        return ParquetExport(path, resume)
+    return JsonlExport(path, resume)
+
+
+def iter_export(path: str = EXPORT_FILE) -> Iterator[Dict[str, str]]:
+    """The rows of an export in the order they were written (including the duplicates of a resumed run)."""
+    if path.endswith(".parquet"):
+        import pyarrow.parquet as pq     # pylint: disable=import-outside-toplevel
+        for part in _parquet_parts(path):
+            for batch in pq.ParquetFile(part).iter_batches():
+                yield from batch.to_pylist()
+        return
+    with open(path, "r", encoding="utf-8") as f:
+        for number, line in enumerate(f, 1):
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                logging.warning(f"Skipping the broken line {number} of {path}")
+
+
+def read_export(path: str = EXPORT_FILE) -> "pd.DataFrame":
+    """The export as a pandas DataFrame, with the last row per content item id."""
+    import pandas as pd     # pylint: disable=import-outside-toplevel
+    rows = {}
+    for row in iter_export(path):
+        rows.pop(row["id"], None)
+        rows[row["id"]] = row
+    return pd.DataFrame.from_records(list(rows.values()), columns=list(EXPORT_COLUMNS))
+
+
+def main():
+    """Command line entry point (make xlsx)."""
+    parser = argparse.ArgumentParser(description="Convert the export of the ingest into an XLSX file")
+    parser.add_argument("--input", default=EXPORT_FILE, help="the export file (*.jsonl) or directory (*.parquet)")
+    parser.add_argument("--xlsx", default="content_items.xlsx", help="the XLSX file to write")
+    args = parser.parse_args()
+
+    df = read_export(args.input)
+    df.to_excel(args.xlsx, index=False)
+    print(f"{len(df)} content items written to {args.xlsx}")
+
+
+if __name__ == "__main__":
+    main()
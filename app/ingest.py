@@ -0,0 +1,431 @@
+"""Ingest content items from the repco DB into the chromaDB vector database.
+
+Every content item (and, with --table transcripts, every transcript) is translated to english,
+split up and added to the "ContentItems" collection.
+
+Usage:
+    python -m app.ingest                    # stream the whole ContentItem table, resume where the last run stopped
+    python -m app.ingest --restart          # stream the whole table again, from the start
+    python -m app.ingest --mode random --limit 4500     # a random sample (not resumable)
+    python -m app.ingest --table transcripts            # stream all transcripts, resumable
+
+The content items are also exported to INGEST_EXPORT_FILE (JSONL or Parquet, see app.export).
+"""
+
+import argparse
+import json
+import logging
+import os
+
+from collections import deque
+from concurrent.futures import Executor, ThreadPoolExecutor
+from datetime import datetime
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from tqdm import tqdm
+
+from app.chunking import embedding_chunks, translation_chunks
+from app.db import DB, combine_content_item_colums, content_item_key
+from app.embeddings import get_embedder
+from app.export import EXPORT_FILE, Export, open_export
+from app.langid import detect_language
+from app.lexical import get_lexical_index
+from app.misc import cleanup_text
+from app.ratelimit import RateLimiter
+from app.snippets import SNIPPET_BATCH_ITEMS, SNIPPET_LANGUAGES, SnippetStore, get_snippet_store, make_snippet, pick_original_text
+from app.translation import OPENAI_MODEL, get_engine, translate, translate_batch_via_deepl
+from app.vectorstore import CHROMA_DB_PATH, DATA_DIR, VECTORSTORE_BATCH_SIZE, ChunkWriter, bump_index_generation, typed_metadata
+
+from tokens import calc_tokens
+
+import chromadb     # noqa: the sqlite3 hack for chromaDB lives in app.db, which must be imported first
+
+
+CHECKPOINT_FILE = os.getenv("INGEST_CHECKPOINT_FILE", os.path.join(DATA_DIR, "ingest_checkpoint.json"))
+INGEST_PAGE_SIZE = int(os.getenv("INGEST_PAGE_SIZE", "1000"))
+TRANSCRIPT_CHECKPOINT_FILE = os.getenv("INGEST_TRANSCRIPT_CHECKPOINT_FILE", os.path.join(DATA_DIR, "ingest_transcripts_checkpoint.json"))
+TRANSCRIPT_PAGE_SIZE = int(os.getenv("INGEST_TRANSCRIPT_PAGE_SIZE", "10"))
+# parallel translation: number of workers and the budget of the LLM provider (0 means: no limit)
+TRANSLATION_WORKERS = int(os.getenv("TRANSLATION_WORKERS", "8"))
+TRANSLATION_RPM = float(os.getenv("TRANSLATION_RPM", "500"))
+TRANSLATION_TPM = float(os.getenv("TRANSLATION_TPM", "200000"))
+
+# XXX NOTE: this is a list of https://en.wikipedia.org/wiki/List_of_ISO_639_language_codes .
+# But it would be better to get them from the official source
+LANGUAGES = ['de', 'en', 'pl', 'sl', 'fa', 'hu', 'es', 'ar', 'fr', 'ru', 'it', 'sv', 'sq', 'lt', 'bs', 'zh', 'tr', 'bg', 'ku', 'cs', 'hr', 'pt', 'az', 'no', 'da', 'et',
+             'el', 'so', 'sk', 'sr', 'nl', 'uk', 'ro', 'ca', 'lv', 'an', 'be', 'mk', 'fi', 'th', 'ce', 'am', 'is', 'cy', 'mC', 'rm', 'ur', 'si', 'he', 'ko', 'yi', 'tu', 'ja']
+
+
+class Checkpoint():
+    """The (pubDate, uid) watermark of the last content item which was completely ingested.
+
+    It is stored in a small JSON file, which is replaced atomically, so a killed run never leaves a broken file behind.
+    """
+
+    def __init__(self, path: str = CHECKPOINT_FILE):
+        self.path = path
+        self.count = 0
+
+    def load(self) -> Optional[Tuple[datetime, str]]:
+        """Return the watermark of the previous run (or None)."""
+        if not self.path or not os.path.exists(self.path):
+            return None
+        with open(self.path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        self.count = data.get("count", 0)
+        logging.info(f"Resuming after {data['uid']} ({data['pubDate']}), {self.count} items done")
+        return (datetime.fromisoformat(data["pubDate"]), data["uid"])
+
+    def save(self, key: Tuple[datetime, str], done: int = 1):
+        """Remember that everything up to (and including) key is done (done: the number of items since the last save)."""
+        if not self.path:
+            return
+        self.count += done
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({"pubDate": key[0].isoformat(), "uid": key[1], "count": self.count}, f)
+        os.replace(tmp_path, self.path)
+
+    def reset(self):
+        """Forget the watermark."""
+        self.count = 0
+        if self.path and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def declared_languages(row: tuple) -> List[str]:
+    """The languages of the summary of a content item row, items without any are skipped."""
+    # example: row[9] is {'de': {'value': 'text in German'}}
+    return [language for language in (row[9] or {}) if 'value' in row[9][language]]
+
+
+def prepare_content_item(row: tuple) -> Optional[dict]:
+    """Collect what we need from a content item row: the cleaned up text, its language and the metadata.
+
+    Returns:
+      dict -- id, revision, url, pubDate, title, text, src_language or None if the item is skipped
+    """
+    declared = declared_languages(row)
+    if not declared:
+        return None
+    text = combine_content_item_colums(row)
+    text = cleanup_text(text)
+    # the declared language is not always right, we only trust it if the text itself is inconclusive
+    language = detect_language(text, default=declared[0])
+    if language != declared[0]:
+        logging.info(f"Content item {row[0]} is declared as {declared[0]}, but looks like {language}")
+    title = [row[8][lang]['value'] for lang in (row[8] or {}) if 'value' in row[8][lang]]
+    return {"id": row[0], "revision": row[1], "url": row[11], "pubDate": str(row[3].date()) if row[3] else "",
+            "title": parse_title(row[8]), "text": text, "src_language": language, "pub_datetime": row[3], "grouping_uid": row[5],
+            # for the pre-translated snippets (see translate_snippets()), out of the same text as the live translation of the search
+            "snippet_title": make_snippet(title[0]) if title else "", "snippet": make_snippet(pick_original_text(row[10], language))}
+
+
+def parse_title(title: dict) -> str:
+    """Pick a title out of the title column of a content item ({'de': {'value': 'Titel'}, ...})."""
+    for _language in LANGUAGES:     # FIXME: this should be more elegant
+        if title and _language in title and 'value' in title[_language]:
+            return cleanup_text(title[_language]['value'])
+    return ''
+
+
+def translate_content_item(item: dict, rate_limiter: Optional[RateLimiter] = None) -> Optional[dict]:
+    """Translate the text of a prepared content item to english (adds dst_text), None if the translation failed.
+
+    Texts longer than TRANSLATION_CHUNK_TOKENS are translated chunk by chunk.
+    """
+    dst_language = 'en'
+    logging.debug(f"{item['text']=}, {item['src_language']=}, {dst_language=}, {item['id']=}, {item['url']=}, {item['pubDate']=}, {item['title']=}")
+    if item['src_language'] == dst_language:
+        return {**item, "dst_text": item['text']}
+    try:
+        # long texts are translated in parts which fit into the LLM's limits
+        dst_text = "\n".join(translate(src_text=chunk, dst_language=dst_language, _src_language=item['src_language'], rate_limiter=rate_limiter)
+                             for chunk in translation_chunks(item['text']))
+    except Exception as e:
+        logging.error(f"Translation failed for {item['id']}: {e}")
+        return None
+    if not dst_text:
+        logging.warning("Translation failed for ID %s" % item['id'])
+        return None
+    return {**item, "dst_text": dst_text}
+
+
+def translate_snippets(items: List[dict], languages: List[str] = SNIPPET_LANGUAGES,
+                       store: Optional[SnippetStore] = None) -> List[Dict[str, Tuple[str, str]]]:
+    """Translate the titles and the snippets of prepared content items into the languages (which are not in the store yet).
+
+    The texts of all items are sent with one batched DeepL call per language (see translate_batch_via_deepl()).
+
+    Returns:
+      list -- per item {language: (title, snippet)}, languages whose translation failed are left out
+    """
+    done = [set(store.languages(item['id'], item['revision'])) if store is not None else set() for item in items]
+    snippets = [{} for _item in items]
+    for language in languages:
+        todo = []
+        for i, item in enumerate(items):
+            if language in done[i]:
+                continue
+            if language == item['src_language']:
+                snippets[i][language] = (item['snippet_title'], item['snippet'])
+            else:
+                todo.append(i)
+        if not todo:
+            continue
+        translated = translate_batch_via_deepl([text for i in todo for text in (items[i]['snippet_title'], items[i]['snippet'])], dst_language=language)
+        for n, i in enumerate(todo):
+            title, snippet = translated[2 * n], translated[2 * n + 1]
+            if snippet or not items[i]['snippet']:
+                snippets[i][language] = (title or items[i]['snippet_title'], snippet)
+    return snippets
+
+
+def add_snippets(batch: List[Tuple[tuple, Optional[dict]]], snippet_store: SnippetStore) -> List[Tuple[tuple, Optional[dict]]]:
+    """Add the pre-translated snippets (item['snippets'], see translate_snippets()) to a batch of translated items."""
+    items = [item for _row, item in batch if item is not None]
+    try:
+        for item, snippets in zip(items, translate_snippets(items, SNIPPET_LANGUAGES, snippet_store)):
+            item["snippets"] = snippets
+    except Exception as e:
+        logging.error(f"Translating the snippets of {len(items)} content items failed: {e}")
+    return batch
+
+
+def batched(iterable: Iterable, size: int) -> Iterator[list]:
+    """Lists of size items out of an iterable (the last one may be shorter)."""
+    batch = []
+    for x in iterable:
+        batch.append(x)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def write_content_item(item: dict, writer: ChunkWriter) -> dict:
+    """Split up the translated text of a content item (see embedding_chunks()) and hand the parts to the vector database writer.
+
+    Returns:
+      dict -- the row for the export (id, url, pubDate, title, text, dst_text)
+    """
+    # now we split the text into chunks (of EMBEDDING_CHUNK_TOKENS) and add them to the vector database
+    chunks = list(embedding_chunks(item['dst_text']))
+    writer.add_item(item['id'], item['revision'], chunks,
+                    {"title": item['title'], "date": item['pubDate'], "language": item['src_language'], "url": item['url'], "kind": "contentitem",
+                     **typed_metadata(item.get('pub_datetime'), item.get('grouping_uid'))})
+    return {key: item[key] for key in ["id", "url", "pubDate", "title", "text", "dst_text"]}
+
+
+def translate_in_parallel(rows: Iterable[tuple], workers: int = TRANSLATION_WORKERS, rate_limiter: Optional[RateLimiter] = None,
+                          snippet_store: Optional[SnippetStore] = None) -> Iterator[Tuple[tuple, Optional[dict]]]:
+    """Translate content items (and their snippets, see add_snippets()) with a pool of worker threads.
+
+    At most 2 * workers items are in flight, the results come out in the order of the rows. The snippets
+    are translated for SNIPPET_BATCH_ITEMS items at once, while the next items are translated.
+
+    Yields:
+      (row, translated item or None)
+    """
+    def _translate(pair: Tuple[tuple, Optional[dict]]) -> Tuple[tuple, Optional[dict]]:
+        row, item = pair
+        return row, translate_content_item(item, rate_limiter) if item else None
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        translated = ordered_map(executor, _translate, ((row, prepare_content_item(row)) for row in rows), 2 * workers)
+        if snippet_store is None:
+            yield from translated
+            return
+        for batch in ordered_map(executor, lambda batch: add_snippets(batch, snippet_store), batched(translated, SNIPPET_BATCH_ITEMS), 2):
+            yield from batch
+
+
+def ingest_content_items(rows: Iterable[tuple], writer: ChunkWriter, export: Optional[Export] = None, snippet_store: Optional[SnippetStore] = None,
+                         workers: int = TRANSLATION_WORKERS, rate_limiter: Optional[RateLimiter] = None) -> List[str]:
+    """Translate content items (see translate_in_parallel()) and write them into the vector database, the snippet store and the export.
+
+    If the translation of a content item fails, the checkpoint stops before it, so a resumed run retries it.
+    The items after it are still ingested (a resumed run gets their translations out of the cache).
+
+    Returns:
+      list -- the uids of the failed content items
+    """
+    failed = []
+    for row, item in tqdm(translate_in_parallel(rows, workers, rate_limiter, snippet_store)):
+        if item:
+            record = write_content_item(item, writer)
+            if item.get("snippets"):
+                snippet_store.put(item['id'], item['revision'], item['snippets'])
+            if export is not None:
+                export.write(record)
+        elif declared_languages(row):
+            failed.append(row[0])
+        if not failed:
+            writer.mark(content_item_key(row))
+    if failed:
+        logging.error(f"{len(failed)} content items failed, the checkpoint stays before {failed[0]}: {failed}")
+    return failed
+
+
+def ordered_map(executor: Executor, fn: Callable, iterable: Iterable, window: int) -> Iterator:
+    """Like executor.map(), but only takes window items out of the iterable ahead of the results (so it can stream)."""
+    pending = deque()
+    for x in iterable:
+        pending.append(executor.submit(fn, x))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def transcript_chunks(row: tuple, executor: Executor, window: int, rate_limiter: Optional[RateLimiter] = None) -> Iterator[str]:
+    """The embedding chunks of a transcript, as a generator pipeline.
+
+    clean up -> translation chunks -> translate (up to window chunks concurrently) -> embedding chunks.
+    The source text is never held in memory as a whole translated copy, only the embedding chunks of it
+    (ingest_transcripts() collects them, so a failed transcript is not written in part).
+    """
+    src_language = row[2]
+    pieces = translation_chunks(cleanup_text(row[3]))
+    if src_language != 'en':
+        pieces = ordered_map(executor, lambda piece: translate(src_text=piece, dst_language='en', _src_language=src_language, rate_limiter=rate_limiter),
+                             pieces, window)
+    for piece in pieces:
+        yield from embedding_chunks(piece)
+
+
+def ingest_transcripts(db: DB, writer: ChunkWriter, checkpoint: Checkpoint, limit: int = 0,
+                       workers: int = TRANSLATION_WORKERS, rate_limiter: Optional[RateLimiter] = None):
+    """Stream all transcripts (resumable, in uid order) through transcript_chunks() into the vector database.
+
+    The chunks are linked to their media asset and content item, so they are found together with the content item.
+    Transcripts which don't belong to a content item are skipped.
+
+    If a transcript fails (e.g. its translation), the checkpoint stops before it, so a resumed run retries it.
+    The transcripts after it are still ingested (a resumed run gets their translations and embeddings out of the caches).
+
+    Returns:
+      list -- the uids of the failed transcripts
+    """
+    failed = []
+    # the checkpoint keeps (pubDate, uid) keys, transcripts are ordered by their uid only
+    after = checkpoint.load()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for i, row in enumerate(tqdm(db.iter_transcripts(after=after[1] if after else None, page_size=TRANSCRIPT_PAGE_SIZE))):
+            if limit and i >= limit:
+                break
+            if row[5] is None:
+                logging.warning(f"Transcript {row[0]} (media asset {row[4]}) has no content item, skipping it")
+            else:
+                metadata = {"title": parse_title(row[7]), "date": str(row[6].date()) if row[6] else "", "language": row[2],
+                            "url": row[8] or "", "kind": "transcript", "content_item_uid": row[5], "media_asset_uid": row[4],
+                            **typed_metadata(row[6], row[9])}
+                try:
+                    # all chunks first, so a failed translation doesn't leave a part of the transcript in the vector database
+                    chunks = list(transcript_chunks(row, executor, 2 * workers, rate_limiter))
+                    writer.add_item(row[0], row[1], chunks, metadata)
+                except Exception as e:
+                    logging.error(f"Ingesting transcript {row[0]} failed: {e}")
+                    failed.append(row[0])
+            if not failed:
+                writer.mark((datetime.min, row[0]))
+    if failed:
+        logging.error(f"{len(failed)} transcripts failed, the checkpoint stays before {failed[0]}: {failed}")
+    return failed
+
+
+def make_rate_limiter(requests_per_minute: float = TRANSLATION_RPM, tokens_per_minute: float = TRANSLATION_TPM) -> RateLimiter:
+    """Rate limiter for the translation LLM. A translation uses up about twice the tokens of its input (input + output)."""
+    return RateLimiter(requests_per_minute, tokens_per_minute,
+                       count_tokens=lambda text: 2 * calc_tokens(text, method='tiktoken', model=OPENAI_MODEL))
+
+
+def content_items(db: DB, mode: str, limit: int, checkpoint: Checkpoint) -> Iterator[tuple]:
+    """The content items to ingest, either streamed in (pubDate, uid) order (resumable) or a random sample."""
+    if mode == "random":
+        yield from db.fetch_random_content_items(limit)
+        return
+    for i, row in enumerate(db.iter_content_items(after=checkpoint.load(), page_size=INGEST_PAGE_SIZE)):
+        if limit and i >= limit:
+            return
+        yield row
+
+
+def main():
+    """Command line entry point (make chromadb)."""
+    parser = argparse.ArgumentParser(description="Ingest repco content items into the chromaDB vector database")
+    parser.add_argument("--table", choices=["contentitems", "transcripts"], default="contentitems", help="what to ingest")
+    parser.add_argument("--mode", choices=["stream", "random"], default="stream",
+                        help="stream: the whole table in (pubDate, uid) order, resumable. random: a random sample (content items only)")
+    parser.add_argument("--limit", type=int, default=0, help="the maximum number of items to ingest (0: no limit)")
+    parser.add_argument("--checkpoint", help="the checkpoint file for resuming (stream mode), there is a default per table")
+    parser.add_argument("--restart", action="store_true", help="ignore the checkpoint and start from the beginning")
+    parser.add_argument("--workers", type=int, default=TRANSLATION_WORKERS, help="the number of parallel translations")
+    parser.add_argument("--rpm", type=float, default=TRANSLATION_RPM, help="requests per minute budget for the translation LLM (0: no limit)")
+    parser.add_argument("--tpm", type=float, default=TRANSLATION_TPM, help="tokens per minute budget for the translation LLM (0: no limit)")
+    parser.add_argument("--no-snippets", action="store_true", help="don't pre-translate the snippets of the content items (see app.snippets)")
+    parser.add_argument("--export", default=EXPORT_FILE, help="the export of the content items, *.jsonl or *.parquet (empty: no export)")
+    parser.add_argument("--batch-size", type=int, default=VECTORSTORE_BATCH_SIZE, help="the number of chunks per write to the vector database")
+    args = parser.parse_args()
+
+    chroma_client = chromadb.PersistentClient(path=CHROMA_DB_PATH)
+    collection = chroma_client.get_or_create_collection(name="ContentItems")
+    logging.info(f"{collection.count()=}")
+
+    if args.mode == "stream":
+        checkpoint = Checkpoint(args.checkpoint or (TRANSCRIPT_CHECKPOINT_FILE if args.table == "transcripts" else CHECKPOINT_FILE))
+    else:
+        checkpoint = Checkpoint("")
+    if args.restart:
+        checkpoint.reset()
+    rate_limiter = make_rate_limiter(args.rpm, args.tpm)
+
+    # the items whose chunks are written, but whose rows are not exported yet (a Parquet export writes whole row groups)
+    pending = []
+    export = None
+
+    def on_flush(keys):
+        """The chunks of the items up to keys[-1] are written: move the checkpoint, invalidate cached search responses."""
+        pending.extend(keys)
+        # the checkpoint must not get ahead of the export, so a resumed run never misses rows of the export
+        if export is None or export.flush(force=False):
+            checkpoint.save(pending[-1], len(pending))
+            pending.clear()
+        bump_index_generation()
+
+    db = DB()   # the postgresql DB
+    get_engine()    # fail early if LLM_PROVIDER is not usable
+    embedder = get_embedder()   # the same embeddings as the search, unchanged chunks come out of the embedding cache
+    if args.table == "transcripts":
+        logging.info("Starting to translate the transcripts")
+        with ChunkWriter(collection, batch_size=args.batch_size, on_flush=on_flush, embedding_function=embedder,
+                         lexical_index=get_lexical_index()) as writer:
+            ingest_transcripts(db, writer, checkpoint, args.limit, args.workers, rate_limiter)
+        # after a failed transcript nothing is marked any more, so on_flush() is not called
+        bump_index_generation()
+        db.close()
+        return
+
+    if args.export:
+        # a resumed run appends to the export of the previous runs
+        export = open_export(args.export, resume=bool(checkpoint.path) and os.path.exists(checkpoint.path))
+    logging.info("Starting to translate the content items")
+    # the checkpoint only moves forward once the chunks of the items are written
+    with ChunkWriter(collection, batch_size=args.batch_size, on_flush=on_flush, embedding_function=embedder,
+                     lexical_index=get_lexical_index()) as writer:
+        rows = content_items(db, args.mode, args.limit, checkpoint)
+        ingest_content_items(rows, writer, export, None if args.no_snippets else get_snippet_store(), args.workers, rate_limiter)
+    # after a failed content item nothing is marked any more, so on_flush() is not called
+    bump_index_generation()
+    db.close()
+
+    if export is not None:
+        export.close()
+        if pending:
+            checkpoint.save(pending[-1], len(pending))
+        logging.info(f"{export.rows_written} content items exported to {args.export} (make xlsx converts it)")
+
+
+if __name__ == "__main__":
+    main()
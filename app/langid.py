@@ -0,0 +1,177 @@
+"""Language identification for search queries and ingested texts.
+
+The backend is pluggable (LANGID_BACKEND, see register_langid_backend()), the default is
+langdetect with a fixed seed, so the same text always gets the same answer. On top of it:
+
+  - a memo cache, popular queries are only classified once
+  - a short cut for short ASCII queries with english stopwords (langdetect is unreliable on 2-3 words)
+  - a minimum length: texts with fewer than LANGID_MIN_CHARS letters get the caller's default language,
+    langdetect is sure about its (wrong) guesses on them ("Klimawandel" -> 'sw', "Radio Helsinki" -> 'fi')
+  - a confidence threshold: below it, the caller's default language is used instead of a guess
+
+The search passes an empty default, so an unsure query is translated with the source language left to the translator.
+
+Example:
+    detect_language("wie funktioniert die energiewende")     # 'de'
+    detect_languages(["what is the climate crisis", "Klimawandel"], default="")     # ['en', '']
+"""
+
+import logging
+import os
+import re
+import threading
+
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from app.cache import MemoryCache, text_hash
+
+
+LANGID_BACKEND = os.getenv("LANGID_BACKEND", "langdetect")
+LANGID_MIN_CONFIDENCE = float(os.getenv("LANGID_MIN_CONFIDENCE", "0.7"))
+LANGID_DEFAULT_LANGUAGE = os.getenv("LANGID_DEFAULT_LANGUAGE", "en")
+# texts with fewer letters are too short for a guess of the backend
+LANGID_MIN_CHARS = int(os.getenv("LANGID_MIN_CHARS", "15"))
+LANGID_MEMO_ENTRIES = int(os.getenv("LANGID_MEMO_ENTRIES", "10000"))
+# only the start of long texts is looked at, that is plenty for telling the language
+LANGID_MAX_CHARS = int(os.getenv("LANGID_MAX_CHARS", "2000"))
+# for the fasttext backend: the path of the lid.176.bin / lid.176.ftz model
+FASTTEXT_LID_MODEL = os.getenv("FASTTEXT_LID_MODEL", "./lid.176.ftz")
+
+# english function words which are not (common) words in the other languages of the repco content
+# (not "will": german "ich will", not "has": spanish "has visto")
+EN_STOPWORDS = {
+    "the", "and", "what", "how", "why", "who", "which", "with", "about", "from", "for", "are", "this", "that",
+    "does", "where", "when", "there", "their", "they", "been", "have", "would", "should", "could",
+    "into", "than", "these", "those", "your", "our", "its", "it's", "isn't", "don't", "can't",
+}
+# a text with at most this many words counts as a short query, see LanguageIdentifier.heuristic()
+SHORT_QUERY_WORDS = 8
+
+# LANGID_BACKEND -> factory returning a function which classifies a batch of texts into [(language, confidence), ...]
+LANGID_BACKENDS: Dict[str, Callable[[], Callable[[Sequence[str]], List[Tuple[str, float]]]]] = {}
+_identifier = None
+_identifier_lock = threading.Lock()
+
+
+def register_langid_backend(name: str):
+    """Decorator to register a language identification backend for LANGID_BACKEND=name."""
+    def _register(factory: Callable[[], Callable[[Sequence[str]], List[Tuple[str, float]]]]):
+        LANGID_BACKENDS[name] = factory
+        return factory
+    return _register
+
+
+@register_langid_backend('langdetect')
+def _langdetect_backend() -> Callable[[Sequence[str]], List[Tuple[str, float]]]:
+    from langdetect import DetectorFactory, detect_langs     # pylint: disable=import-outside-toplevel
+    from langdetect.lang_detect_exception import LangDetectException     # pylint: disable=import-outside-toplevel
+    DetectorFactory.seed = 0        # langdetect is random, unless seeded
+
+    def classify(texts: Sequence[str]) -> List[Tuple[str, float]]:
+        results = []
+        for text in texts:
+            try:
+                best = detect_langs(text)[0]
+                results.append((best.lang, best.prob))
+            except LangDetectException:     # no features in the text (numbers, punctuation, ...)
+                results.append(("", 0.0))
+        return results
+    return classify
+
+
+@register_langid_backend('fasttext')
+def _fasttext_backend() -> Callable[[Sequence[str]], List[Tuple[str, float]]]:
+    import fasttext      # pylint: disable=import-outside-toplevel
+    model = fasttext.load_model(FASTTEXT_LID_MODEL)
+
+    def classify(texts: Sequence[str]) -> List[Tuple[str, float]]:
+        # fasttext classifies a whole batch at once, but chokes on newlines
+        labels, probs = model.predict([text.replace("\n", " ") for text in texts], k=1)
+        return [(label[0].replace("__label__", ""), float(prob[0])) for label, prob in zip(labels, probs)]
+    return classify
+
+
+def normalize_language(language: str) -> str:
+    """Plain ISO 639-1 code ('zh-cn' -> 'zh')."""
+    return language.split("-")[0].lower()
+
+
+class LanguageIdentifier():
+    """Tells the language of texts, with a memo cache, a short query heuristic and a confidence threshold."""
+
+    def __init__(self, backend: Optional[str] = None, min_confidence: float = LANGID_MIN_CONFIDENCE,
+                 memo_entries: int = LANGID_MEMO_ENTRIES):
+        """
+        Args:
+          backend -- the name of a registered backend, by default LANGID_BACKEND
+          min_confidence -- guesses below this confidence (and of too short texts) are replaced by the default language
+          memo_entries -- the size of the memo cache
+        """
+        self.backend = backend or LANGID_BACKEND
+        if self.backend not in LANGID_BACKENDS:
+            raise ValueError(f"Unknown LANGID_BACKEND {self.backend}, choose one of {sorted(LANGID_BACKENDS)}")
+        self.classify = LANGID_BACKENDS[self.backend]()
+        self.min_confidence = min_confidence
+        self.memo = MemoryCache(max_entries=memo_entries)
+
+    @staticmethod
+    def heuristic(text: str) -> Optional[Tuple[str, float]]:
+        """Answer without the backend where it is unreliable or not needed (None: ask the backend)."""
+        words = re.findall(r"[\w']+", text.lower())
+        if not words or not any(c.isalpha() for c in text):
+            return ("", 0.0)
+        if len(words) <= SHORT_QUERY_WORDS and text.isascii() and EN_STOPWORDS.intersection(words):
+            return ("en", 1.0)
+        if sum(c.isalpha() for c in text) < LANGID_MIN_CHARS:
+            return ("", 0.0)
+        return None
+
+    def detect_batch_with_confidence(self, texts: Sequence[str]) -> List[Tuple[str, float]]:
+        """(language, confidence) of each text. Only the texts which are neither memoized nor covered by the heuristic go to the backend."""
+        results = [None] * len(texts)
+        todo = []
+        for i, text in enumerate(texts):
+            text = text[:LANGID_MAX_CHARS]
+            memoized = self.memo.get(text_hash(text))
+            if memoized is not None:
+                results[i] = tuple(memoized)
+                continue
+            guess = self.heuristic(text)
+            if guess is not None:
+                results[i] = guess
+            else:
+                todo.append((i, text))
+        if todo:
+            for (i, text), (language, confidence) in zip(todo, self.classify([text for _i, text in todo])):
+                results[i] = (normalize_language(language), confidence)
+                self.memo.set(text_hash(text), results[i])
+        return results
+
+    def detect_batch(self, texts: Sequence[str], default: str = LANGID_DEFAULT_LANGUAGE) -> List[str]:
+        """The language of each text, default where the text is too short or the guess is not confident enough."""
+        return [language if language and confidence >= self.min_confidence else default
+                for language, confidence in self.detect_batch_with_confidence(texts)]
+
+    def detect(self, text: str, default: str = LANGID_DEFAULT_LANGUAGE) -> str:
+        """The language of a text, default if the text is too short or the guess is not confident enough."""
+        return self.detect_batch([text], default)[0]
+
+
+def get_language_identifier() -> LanguageIdentifier:
+    """Return the process wide LanguageIdentifier (created on first use, langdetect takes a while to load its profiles)."""
+    global _identifier      # pylint: disable=global-statement
+    with _identifier_lock:
+        if _identifier is None:
+            logging.info(f"Loading the {LANGID_BACKEND} language identification")
+            _identifier = LanguageIdentifier()
+        return _identifier
+
+
+def detect_language(text: str, default: str = LANGID_DEFAULT_LANGUAGE) -> str:
+    """The language of a text, see LanguageIdentifier.detect()."""
+    return get_language_identifier().detect(text, default)
+
+
+def detect_languages(texts: Sequence[str], default: str = LANGID_DEFAULT_LANGUAGE) -> List[str]:
+    """The languages of many texts, see LanguageIdentifier.detect_batch()."""
+    return get_language_identifier().detect_batch(texts, default)
@@ -0,0 +1,246 @@
+"""Local lexical (BM25) index of the chunks in the vector database.
+
+Embeddings are good at meaning, but often miss exact terms: names, places, show titles. The ingest
+therefore also writes every chunk into a SQLite FTS5 table, and the search merges the lexical and
+the vector ranking with reciprocal rank fusion (see fuse_rankings()). Queries which only consist of
+such terms are searched as they are, without translating them first, if the index knows them (see
+query_needs_translation()): German capitalizes all nouns, "Klimawandel" looks like a name, too.
+
+The index can be (re)built out of an existing chromaDB:
+
+    python -m app.lexical --rebuild
+"""
+
+import argparse
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from app.langid import EN_STOPWORDS
+from app.vectorstore import CHROMA_DB_PATH, DATA_DIR
+
+
+LEXICAL_INDEX_PATH = os.getenv("LEXICAL_INDEX_PATH", os.path.join(DATA_DIR, "lexical.db"))
+# the k of reciprocal rank fusion, bigger values give the lower ranks more weight
+RRF_K = int(os.getenv("RRF_K", "60"))
+# queries with at most this many words can be keyword queries
+KEYWORD_QUERY_MAX_WORDS = 3
+
+# the metadata fields of the where filters (see app.vectorstore.build_where()) and their columns
+_FILTER_COLUMNS = {"pubDate": "m.pub_date", "language": "m.language", "grouping_uid": "m.grouping_uid", "uid": "m.uid"}
+_FILTER_OPERATORS = {"$eq": "=", "$ne": "!=", "$gt": ">", "$gte": ">=", "$lt": "<", "$lte": "<="}
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def tokenize(text: str) -> List[str]:
+    """The words of a text (as FTS5's unicode61 tokenizer sees them, roughly)."""
+    return re.findall(r"\w+", text.lower())
+
+
+def is_keyword_query(text: str) -> bool:
+    """Check if a query is a pure keyword query (a "quoted phrase", or a few names / titles / numbers), see query_needs_translation()."""
+    if is_phrase_query(text):
+        return True
+    words = re.findall(r"\w+", text.strip())
+    if not words or len(words) > KEYWORD_QUERY_MAX_WORDS:
+        return False
+    if EN_STOPWORDS.intersection(word.lower() for word in words):
+        return False
+    return all(word[0].isupper() or any(c.isdigit() for c in word) for word in words)
+
+
+def is_phrase_query(text: str) -> bool:
+    """Check if a query is a "quoted phrase"."""
+    text = text.strip()
+    return len(text) > 2 and text[0] == text[-1] == '"'
+
+
+def query_needs_translation(text: str, query_lang: str, index: Optional["LexicalIndex"] = None) -> bool:
+    """Check if a query has to be translated to english for the search.
+
+    Not if it is english or a "quoted phrase", or if it is a keyword query (see is_keyword_query()) and
+    all its words are in the (english) index, e.g. names like "Radio Helsinki".
+    """
+    if query_lang == "en" or is_phrase_query(text):
+        return False
+    if is_keyword_query(text) and index is not None:
+        return not index.has_terms(tokenize(text))
+    return True
+
+
+def match_expression(text: str) -> str:
+    """The FTS5 MATCH expression of a query: any of its words (quoted queries: the phrase)."""
+    if is_phrase_query(text):
+        return '"' + " ".join(tokenize(text)) + '"'
+    return " OR ".join(f'"{word}"' for word in dict.fromkeys(tokenize(text)))
+
+
+def where_sql(where: Optional[Dict[str, Any]]) -> Tuple[str, List[Any]]:
+    """Translate a chromaDB where filter (as made by app.vectorstore.build_where()) into SQL over the chunk_meta table."""
+    if not where:
+        return "1", []
+    if "$and" in where or "$or" in where:
+        operator = "$and" if "$and" in where else "$or"
+        parts = [where_sql(condition) for condition in where[operator]]
+        return "(" + f" {operator[1:].upper()} ".join(sql for sql, _params in parts) + ")", [p for _sql, params in parts for p in params]
+    (field, condition), = where.items()
+    column = _FILTER_COLUMNS[field]
+    if not isinstance(condition, dict):
+        condition = {"$eq": condition}
+    (operator, value), = condition.items()
+    if operator in ("$in", "$nin"):
+        placeholders = ",".join("?" * len(value))
+        return f"{column} {'IN' if operator == '$in' else 'NOT IN'} ({placeholders})", list(value)
+    return f"{column} {_FILTER_OPERATORS[operator]} ?", [value]
+
+
+def fuse_rankings(rankings: Sequence[Sequence[str]], k: int = RRF_K) -> List[Tuple[str, float]]:
+    """Reciprocal rank fusion: every ranking gives an id 1 / (k + rank), the ids are sorted by the sum.
+
+    Returns:
+      list -- (id, score), best first
+    """
+    scores = {}
+    for ranking in rankings:
+        for rank, uid in enumerate(ranking, start=1):
+            scores[uid] = scores.get(uid, 0.0) + 1.0 / (k + rank)
+    return sorted(scores.items(), key=lambda item: -item[1])
+
+
+class LexicalIndex():
+    """SQLite FTS5 index of chunks (id, text and the chunk metadata)."""
+
+    def __init__(self, path: str = LEXICAL_INDEX_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS chunk_meta (
+                rowid INTEGER PRIMARY KEY,
+                id TEXT NOT NULL UNIQUE,
+                uid TEXT NOT NULL,
+                language TEXT,
+                grouping_uid TEXT,
+                pub_date INTEGER,
+                metadata TEXT NOT NULL
+            )""")
+        self.conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS chunks_fts USING fts5(text, tokenize='unicode61 remove_diacritics 2')")
+
+    def upsert(self, ids: Sequence[str], documents: Sequence[str], metadatas: Sequence[Dict[str, Any]]):
+        """Add (or replace) chunks, with the same ids, documents and metadatas as written to chromaDB."""
+        with self._lock:
+            self.conn.execute("BEGIN")
+            for chunk_id, document, metadata in zip(ids, documents, metadatas):
+                row = self.conn.execute("SELECT rowid FROM chunk_meta WHERE id = ?", (chunk_id,)).fetchone()
+                if row:
+                    self.conn.execute("DELETE FROM chunks_fts WHERE rowid = ?", row)
+                    self.conn.execute("DELETE FROM chunk_meta WHERE rowid = ?", row)
+                cursor = self.conn.execute(
+                    "INSERT INTO chunk_meta (id, uid, language, grouping_uid, pub_date, metadata) VALUES (?, ?, ?, ?, ?, ?)",
+                    (chunk_id, metadata.get("uid", chunk_id), metadata.get("language"), metadata.get("grouping_uid"),
+                     metadata.get("pubDate"), json.dumps(metadata)))
+                self.conn.execute("INSERT INTO chunks_fts (rowid, text) VALUES (?, ?)", (cursor.lastrowid, document))
+            self.conn.execute("COMMIT")
+
+    def delete(self, ids: Sequence[str]):
+        """Remove chunks."""
+        with self._lock:
+            self.conn.execute("BEGIN")
+            for chunk_id in ids:
+                row = self.conn.execute("SELECT rowid FROM chunk_meta WHERE id = ?", (chunk_id,)).fetchone()
+                if row:
+                    self.conn.execute("DELETE FROM chunks_fts WHERE rowid = ?", row)
+                    self.conn.execute("DELETE FROM chunk_meta WHERE rowid = ?", row)
+            self.conn.execute("COMMIT")
+
+    def query(self, text: str, n_results: int = 10, where: Optional[Dict[str, Any]] = None) -> Dict[str, List[List[Any]]]:
+        """The n_results best (BM25) chunks for a query, in the shape of a chromaDB query result (see app.vectorstore.group_hits()).
+
+        The "distances" are the BM25 scores of SQLite (smaller is better).
+        """
+        results = {"ids": [[]], "distances": [[]], "metadatas": [[]], "documents": [[]]}
+        expression = match_expression(text)
+        if not expression:
+            return results
+        filters, params = where_sql(where)
+        sql = f"""
+            SELECT m.id, bm25(chunks_fts) AS score, m.metadata, f.text
+            FROM chunks_fts f JOIN chunk_meta m ON m.rowid = f.rowid
+            WHERE chunks_fts MATCH ? AND {filters}
+            ORDER BY score LIMIT ?"""
+        with self._lock:
+            rows = self.conn.execute(sql, [expression, *params, n_results]).fetchall()
+        for chunk_id, score, metadata, document in rows:
+            results["ids"][0].append(chunk_id)
+            results["distances"][0].append(score)
+            results["metadatas"][0].append(json.loads(metadata))
+            results["documents"][0].append(document)
+        return results
+
+    def has_terms(self, words: Sequence[str]) -> bool:
+        """Check if there is a chunk with all the words."""
+        if not words:
+            return False
+        expression = " AND ".join(f'"{word}"' for word in dict.fromkeys(words))
+        with self._lock:
+            return self.conn.execute("SELECT 1 FROM chunks_fts WHERE chunks_fts MATCH ? LIMIT 1", (expression,)).fetchone() is not None
+
+    def __len__(self):
+        with self._lock:
+            return self.conn.execute("SELECT COUNT(*) FROM chunk_meta").fetchone()[0]
+
+    def close(self):
+        """Close the SQLite connection."""
+        self.conn.close()
+
+
+def get_lexical_index() -> Optional[LexicalIndex]:
+    """Return the process wide LexicalIndex (opened on first use), None if LEXICAL_INDEX_PATH is empty or can't be opened."""
+    global _index       # pylint: disable=global-statement
+    with _index_lock:
+        if _index is None and LEXICAL_INDEX_PATH:
+            try:
+                _index = LexicalIndex(LEXICAL_INDEX_PATH)
+            except sqlite3.Error as e:
+                logging.error(f"Could not open the lexical index {LEXICAL_INDEX_PATH}: {e}")
+        return _index
+
+
+def rebuild(collection, index: LexicalIndex, page_size: int = 1000):
+    """Copy all chunks of a chromaDB collection into the lexical index."""
+    offset = 0
+    while True:
+        page = collection.get(limit=page_size, offset=offset, include=["documents", "metadatas"])
+        if not page["ids"]:
+            break
+        index.upsert(page["ids"], page["documents"], [metadata or {} for metadata in page["metadatas"]])
+        offset += len(page["ids"])
+        logging.info(f"{offset} chunks indexed")
+
+
+def main():
+    """Command line entry point."""
+    parser = argparse.ArgumentParser(description="Maintain the lexical index of the chunks in the chromaDB")
+    parser.add_argument("--rebuild", action="store_true", help="copy all chunks of the chromaDB into the lexical index")
+    args = parser.parse_args()
+    import app.db       # noqa: pylint: disable=import-outside-toplevel,unused-import  # the sqlite3 hack for chromaDB
+    import chromadb     # pylint: disable=import-outside-toplevel
+    index = get_lexical_index()
+    if args.rebuild:
+        collection = chromadb.PersistentClient(path=CHROMA_DB_PATH).get_or_create_collection(name="ContentItems")
+        rebuild(collection, index)
+    print(f"{len(index)} chunks in the lexical index {LEXICAL_INDEX_PATH}")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
@@ -1,54 +1,146 @@
 """Main fastapi application."""
 
 
-import sys
+import asyncio
+import base64
+import cProfile
+import json
+import os
 import logging
+import threading
+import time
 
-from pprint import pprint
-from typing import List
-import pandas as pd
+from contextlib import asynccontextmanager
+from datetime import date
+from typing import AsyncIterator, List, Optional, Tuple
 
-from fastapi import FastAPI, Query, Request, HTTPException
-from fastapi.responses import HTMLResponse
+from fastapi import Depends, FastAPI, Query, Request, Response, HTTPException
+from fastapi.responses import HTMLResponse, PlainTextResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
-from langdetect import \
-    detect  # https://www.geeksforgeeks.org/detect-an-unknown-language-using-python/
 from pydantic import BaseModel
 
-from app.translation import translate, translate_via_deepl
-from app.db import DB
+from app.batching import QueryCoalescer
+from app.cache import get_search_cache, get_translation_cache, search_cache_key
+from app.translation import atranslate, atranslate_batch_via_deepl, atranslate_detect, close_async_http_client, get_engine
+from app.db import AsyncDB
+from app.embeddings import get_embedder
+from app.langid import LANGID_DEFAULT_LANGUAGE, detect_language
+from app.lexical import fuse_rankings, get_lexical_index, query_needs_translation
+from app.metrics import METRICS_ENABLED, PROFILING_ENABLED, REQUEST_SECONDS, profile_summary, render_metrics, server_timing, span, start_request
+from app.snippets import get_snippet_store, make_snippet, pick_original_text
+from app.startup import Warmup
+from app.vectorstore import CHROMA_DB_PATH, SEARCH_OVERFETCH, build_where, group_hits, index_generation, where_key
 
 
-app = FastAPI()
+# a handle for the postgresql repco DB
+adb = AsyncDB()
+
+# the ranked list of a query is cut off after this many content items, and a page has at most SEARCH_MAX_PAGE_SIZE of them
+SEARCH_MAX_RESULTS = int(os.getenv("SEARCH_MAX_RESULTS", "200"))
+SEARCH_MAX_PAGE_SIZE = int(os.getenv("SEARCH_MAX_PAGE_SIZE", "50"))
+# the first ranking of a query covers this many content items (at least the first page), deeper pages extend it
+SEARCH_INITIAL_DEPTH = int(os.getenv("SEARCH_INITIAL_DEPTH", "20"))
+# load the heavy parts (see app.startup) in the background right after the startup, instead of on first use
+WARMUP_ENABLED = os.getenv("WARMUP_ENABLED", "true").lower() in ("1", "true", "yes")
+
+# the chromaDB collection, loaded on first use (see get_collection())
+collection = None
+_collection_lock = threading.Lock()
+
+
+def get_collection():
+    """Return the chromaDB collection (opened on first use, this blocks)."""
+    global collection       # pylint: disable=global-statement
+    with _collection_lock:
+        if collection is None:
+            import chromadb     # noqa: pylint: disable=import-outside-toplevel  # app.db, imported above, sets up sqlite3 for it
+            collection = chromadb.PersistentClient(path=CHROMA_DB_PATH).get_or_create_collection(name="ContentItems")
+            logging.info(f"ChromaDB loaded, {collection.count()} chunks")
+        return collection
+
+
+def warm_up_embeddings():
+    """Load the embedding model and run it once."""
+    get_embedder().warm_up()
+
+
+def warm_up_langid():
+    """Load the language profiles, by identifying a text (which the short query heuristic doesn't answer)."""
+    detect_language("Wie funktioniert die Energiewende in Österreich und Slowenien?")
+
+
+def run_vector_queries(texts: List[str], n_results: int, where: Optional[dict] = None) -> dict:
+    """Embed a batch of query texts with one model call and search them with one chromaDB query (this blocks)."""
+    vectors = get_collection()
+    with span("embed_query"):
+        # queries stay in the memory tier of the embedding cache, the disk tier is the one of the ingest
+        embeddings = get_embedder().embed(texts, persist=False)
+    with span("vector_query"):
+        return vectors.query(query_embeddings=embeddings, n_results=n_results, where=where)
+
+
+# concurrent searches share the embedding and index passes, see app.batching
+coalescer = QueryCoalescer(run_vector_queries)
+
+warmup = Warmup([("vectorstore", get_collection), ("embeddings", warm_up_embeddings),
+                 ("langid", warm_up_langid), ("translation", get_engine)],
+                required=["vectorstore"])
+
+
+@asynccontextmanager
+async def lifespan(_app: FastAPI):
+    """Start the warm-up in the background (see app.startup), close the DB connection and the HTTP client on shutdown.
+
+    The app takes requests right away, the repco DB is only connected to on first use.
+    """
+    task = warmup.start() if WARMUP_ENABLED else None
+    yield
+    if task is not None:
+        task.cancel()
+    await adb.close()
+    await close_async_http_client()
+
+
+app = FastAPI(lifespan=lifespan)
 app.mount("/static", StaticFiles(directory="static"), name="static")
 templates = Jinja2Templates(directory="templates")
 
-# a handle for the postgresql repco DB
-db = DB()
 
-# this is an ugly hack to make chromaDB work with the sqlite3 module
-# see also https://stackoverflow.com/questions/77004853/chromadb-langchain-with-sentencetransformerembeddingfunction-throwing-sqlite3
-__import__('pysqlite3')
-sys.modules['sqlite3'] = sys.modules.pop('pysqlite3')
-import chromadb     # noqa:
+@app.middleware("http")
+async def timing(request: Request, call_next):
+    """Time the requests: the request histogram, the Server-Timing header (the spans of the stages) and ?profile=1.
 
-
-# try to load the chromaDB
-try:
-    chroma_client = chromadb.PersistentClient(path="./chroma.db")
-    collection = chroma_client.get_or_create_collection(name="ContentItems")
-    logging.info("ChromaDB loaded")
-    logging.info(f"{collection.count()=}")
-except Exception as e:
-    logging.error(f"Failed to load ChromaDB: {e}")
-    raise e
+    The profile covers everything the event loop did during the request, so profile on an otherwise idle server.
+    """
+    if not METRICS_ENABLED:
+        return await call_next(request)
+    spans = start_request()
+    profiler = cProfile.Profile() if PROFILING_ENABLED and request.query_params.get("profile") == "1" else None
+    start = time.perf_counter()
+    if profiler is not None:
+        profiler.enable()
+    try:
+        response = await call_next(request)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+    elapsed = time.perf_counter() - start
+    route = request.scope.get("route")
+    # unmatched paths (static files, 404s) are lumped together, so they can't blow up the number of series
+    REQUEST_SECONDS.observe(elapsed, method=request.method, path=getattr(route, "path", "other"), status=str(response.status_code))
+    timing_header = server_timing([*spans, ("total", elapsed)])
+    if profiler is not None:
+        return PlainTextResponse(profile_summary(profiler), headers={"Server-Timing": timing_header})
+    response.headers["Server-Timing"] = timing_header
+    return response
 
 
 class SearchResponse(BaseModel):
     """Search response model."""
     id: str
-    distance: float     # the distance of the search result
+    distance: Optional[float] = None    # the distance of the search result (None: only found by the lexical search)
+    score: float = 0.0      # the fused rank score, higher is better
     date: str
     url: str
     title: str
@@ -63,122 +155,387 @@ def read_root(request: Request):
     return templates.TemplateResponse("index.html", {"request": request})
 
 
-def search_in_vectorsearch_db(text: str, count_answers: int = 10) -> List[SearchResponse]:
+async def fetch_originals(search_dicts: List[dict], query_lang: str) -> List[int]:
+    """Fill in 'original_text' of the search_dicts, and 'title' and 'dst_text' where a pre-translated snippet exists.
+
+    The originals of all hits are fetched with one query from the repco DB. The title and snippet in the
+    query language come out of the snippet store if the ingest pre-translated them (see app.snippets).
+
+    Returns:
+      list[int] -- the indices of the search_dicts which still need a live translation
+    """
+    uids = [sd['id'] for sd in search_dicts]
+    with span("db_fetch"):
+        try:
+            contents = await adb.fetch_content_items_by_uids(uids)
+        except Exception as e:
+            logging.error(f"Fetching the content items failed: {e}")
+            contents = {}
+        store = get_snippet_store()
+        materialized = await asyncio.to_thread(store.get_many, uids, query_lang) if store is not None else {}
+    batch = []
+    for i, search_dict in enumerate(search_dicts):
+        if search_dict['id'] not in contents:
+            logging.warning(f"Content item with uid {search_dict['id']} not found.")
+        val = pick_original_text(contents.get(search_dict['id']), search_dict['language'])
+        search_dict['original_text'] = val
+        snippet = materialized.get(search_dict['id'])
+        # a snippet of an older revision is not good enough (transcript hits don't know the revision of the content item)
+        if snippet and search_dict.get('revision') in (None, snippet[0]):
+            search_dict['title'], search_dict['dst_text'] = snippet[1] or search_dict['title'], snippet[2] or search_dict['dst_text']
+        elif val:
+            batch.append(i)
+    logging.info(f"{len(search_dicts) - len(batch)} of {len(search_dicts)} snippets pre-translated to {query_lang}")
+    return batch
+
+
+async def translate_originals(search_dicts: List[dict], query_lang: str):
+    """Translate (a snippet of) the 'original_text' of the search_dicts to the query language, with one (batched) DeepL request."""
+    with span("translate_hits"):
+        translations = await atranslate_batch_via_deepl([make_snippet(sd['original_text']) for sd in search_dicts],
+                                                        dst_language=query_lang.upper())
+    for search_dict, translated_to_query_lang in zip(search_dicts, translations):
+        if translated_to_query_lang:    # if the translation failed, we keep the (english) text of the hit
+            search_dict['dst_text'] = translated_to_query_lang
+
+
+async def fetch_and_translate(search_dicts: List[dict], query_lang: str):
+    """Fill in 'original_text' and 'dst_text' of the search_dicts (see fetch_originals() and translate_originals())."""
+    batch = await fetch_originals(search_dicts, query_lang)
+    if batch:
+        await translate_originals([search_dicts[i] for i in batch], query_lang)
+
+
+def display_language(query_lang: str, reported_lang: str = "") -> str:
+    """The language the hits are shown in: the one of the query, if it is unknown ("") the one the translator
+    reported for the query (see translate_query()), LANGID_DEFAULT_LANGUAGE if there is none either."""
+    return query_lang or reported_lang or LANGID_DEFAULT_LANGUAGE
+
+
+async def translate_query(text: str, query_lang: str) -> Tuple[str, str]:
+    """Translate the query to english (the language of the vector database).
+
+    query_lang "" leaves the source language to the LLM, which reports it.
+
+    Returns:
+      (the translated query, the language of the query: query_lang, or the one the LLM reported ("" if none))
+    """
+    if query_lang == "en":
+        return text, query_lang
+    with span("translate_query"):
+        if query_lang:
+            query = await atranslate(text, dst_language="EN-US")
+        else:
+            query, query_lang = await atranslate_detect(text, dst_language="EN-US")
+    logging.info(f"(Translated) query: {query} (from {query_lang or 'unknown'})")
+    return query, query_lang
+
+
+def hits_to_search_dicts(hits: List[tuple], distances: bool = True) -> List[dict]:
+    """Convert grouped hits (see app.vectorstore.group_hits()) to search dicts (without original_text)."""
+    search_dicts = []
+    for uid, distance, metadata, document in hits:
+        search_dict = {}
+        search_dict['id'] = uid
+        # the revision of the content item (transcript hits only know the one of the transcript)
+        search_dict['revision'] = None if metadata.get('content_item_uid') else metadata.get('revision')
+        search_dict['distance'] = distance if distances else None
+        search_dict['date'] = metadata['date']
+        search_dict['url'] = metadata['url']
+        search_dict['title'] = metadata['title']
+        search_dict['language'] = metadata['language']
+        search_dict['dst_text'] = document
+        search_dict['original_text'] = ""
+        search_dicts.append(search_dict)
+    return search_dicts
+
+
+async def vector_hits(query: str, count_answers: int = 10, where: Optional[dict] = None) -> Tuple[List[dict], bool]:
+    """The best chunk of each of the count_answers nearest content items, as search dicts (without original_text).
+
+    The where filter (see app.vectorstore.build_where()) is applied by chromaDB, so only matching chunks are ranked.
+
+    Returns:
+      (the search dicts, whether chromaDB has no more matching chunks)
+    """
+    # one content item can have many chunks among the nearest ones, so we over-fetch and keep the best chunk per item
+    n_results = count_answers * SEARCH_OVERFETCH
+    # the query is embedded with the same backend as the chunks (see app.embeddings), together with the concurrent queries
+    with span("vector_search"):
+        vs_results = await coalescer.query(query, max(n_results, 1), where)
+    # vs_results.keys()=dict_keys(['ids', 'distances', 'metadatas', 'embeddings', 'documents', 'uris', 'data'])
+    search_dicts = hits_to_search_dicts(group_hits(vs_results, count_answers))
+    logging.info(f"{len(vs_results['ids'][0])} hits, {len(search_dicts)} distinct content items")
+    return search_dicts, len(vs_results['ids'][0]) < n_results
+
+
+async def lexical_hits(text: str, count_answers: int = 10, where: Optional[dict] = None) -> Tuple[List[dict], bool]:
+    """The best chunk of each of the count_answers best (BM25) content items of the lexical index, as search dicts.
+
+    Returns:
+      (the search dicts, whether the index has no more matching chunks)
+    """
+    index = get_lexical_index()
+    if index is None:
+        return [], True
+    with span("lexical_query"):
+        results = await asyncio.to_thread(index.query, text, count_answers * SEARCH_OVERFETCH, where)
+    search_dicts = hits_to_search_dicts(group_hits(results, count_answers), distances=False)
+    logging.info(f"{len(results['ids'][0])} lexical hits, {len(search_dicts)} distinct content items")
+    return search_dicts, len(results['ids'][0]) < count_answers * SEARCH_OVERFETCH
+
+
+def fuse_hits(*rankings: List[dict]) -> List[dict]:
+    """Merge ranked search dicts with reciprocal rank fusion (see app.lexical.fuse_rankings()), the score is in 'score'."""
+    by_uid = {}
+    for ranking in rankings:
+        for search_dict in ranking:
+            by_uid.setdefault(search_dict['id'], search_dict)     # the first ranking (the vector search) has the distances
+    fused = []
+    for uid, score in fuse_rankings([[sd['id'] for sd in ranking] for ranking in rankings]):
+        fused.append({**by_uid[uid], 'score': score})
+    return fused
+
+
+def encode_cursor(text: str, query_lang: str, offset: int, where: Optional[dict] = None) -> str:
+    """The opaque cursor of the page of a query (and its filters) which starts at offset."""
+    data = json.dumps({"q": search_cache_key(text, query_lang, -1, filters=where_key(where))[:16], "o": offset})
+    return base64.urlsafe_b64encode(data.encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor: str, text: str, query_lang: str, where: Optional[dict] = None) -> int:
+    """The offset of a cursor made by encode_cursor(), HTTP 400 if it is broken or belongs to another query."""
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        if data["q"] == search_cache_key(text, query_lang, -1, filters=where_key(where))[:16] and int(data["o"]) >= 0:
+            return int(data["o"])
+    except (ValueError, KeyError, TypeError):
+        pass
+    raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+async def ranked_hits(text: str, query_lang: str, where: Optional[dict] = None, needed: int = SEARCH_MAX_RESULTS) -> Tuple[List[dict], bool, str]:
+    """The ranked hits of a query (at least the first needed ones, up to SEARCH_MAX_RESULTS), without original and translated texts.
+
+    The vector and the lexical rankings (of the query and of its translation) are merged with reciprocal rank fusion.
+    The list is cached, so the pages of the results are slices of it. The first request only ranks SEARCH_INITIAL_DEPTH
+    content items (or the first page). A page beyond them re-runs the vector and the lexical queries twice as deep
+    (the translation of the query comes out of the cache) and appends the content items which are new, so the
+    pages which were served already stay as they were.
+
+    Returns:
+      (the ranked hits, whether there are no more, the language of the query the translator reported ("" if it wasn't translated))
+    """
+    needed = min(needed, SEARCH_MAX_RESULTS)
+    cache = get_search_cache()
+    cache_key = search_cache_key(text, query_lang, -1, index_generation(), filters=where_key(where))
+    ranking = await cache.aget(cache_key)
+    if not isinstance(ranking, dict):       # not cached yet (or a plain list, cached by an older version)
+        ranking = {"hits": [], "depth": 0, "complete": False, "language": ""}
+    if len(ranking["hits"]) < needed and not ranking["complete"]:
+        depth = min(max(needed, SEARCH_INITIAL_DEPTH, 2 * ranking["depth"]), SEARCH_MAX_RESULTS)
+        # the lexical search runs on the query as it is (names, places, titles), while the query is translated and embedded
+        lexical = asyncio.create_task(lexical_hits(text.strip(), depth, where))
+        rankings = []
+        reported_lang = ranking.get("language", "")
+        try:
+            # english queries, "phrases" and names which are in the index don't need a translation
+            if await asyncio.to_thread(query_needs_translation, text, query_lang, get_lexical_index()):
+                query, reported_lang = await translate_query(text, query_lang)
+            else:
+                query = text
+            searches = [vector_hits(query, depth, where)]
+            if query.strip() != text.strip():
+                searches.append(lexical_hits(query.strip(), depth, where))     # the index is english, too
+            rankings = list(await asyncio.gather(*searches))
+        finally:
+            rankings.append(await lexical)
+        served = {hit['id'] for hit in ranking["hits"]}
+        fused = fuse_hits(*(hits for hits, _complete in rankings))[:depth]
+        ranking = {"hits": (ranking["hits"] + [hit for hit in fused if hit['id'] not in served])[:SEARCH_MAX_RESULTS], "depth": depth,
+                   "complete": depth >= SEARCH_MAX_RESULTS or all(complete for _hits, complete in rankings), "language": reported_lang}
+        await cache.aset(cache_key, ranking)
+    return ranking["hits"], ranking["complete"], ranking.get("language", "")
+
+
+def next_page_offset(offset: int, page_size: int, ranked: List[dict], complete: bool) -> Optional[int]:
+    """The offset of the page after the one at offset, None if there is none."""
+    if offset + page_size < len(ranked) or (not complete and offset + page_size < SEARCH_MAX_RESULTS):
+        return offset + page_size
+    return None
+
+
+async def search_page(text: str, page_size: int = 10, cursor: Optional[str] = None,
+                      where: Optional[dict] = None) -> Tuple[List[dict], Optional[str]]:
+    """One page of the results of a query (with the search filters in where, see app.vectorstore.build_where()).
+
+    Only the content items of the page are fetched from the repco DB and translated.
+
+    Returns:
+      (the search dicts of the page, the cursor of the next page or None)
+    """
+    # first detect the input language (CPU bound, so it runs in a worker thread)
+    with span("detect"):
+        query_lang = await asyncio.to_thread(detect_language, text, "")
+    logging.info(f"Detected language: {query_lang or 'unknown'}")
+    offset = decode_cursor(cursor, text, query_lang, where) if cursor else 0
+
+    # popular queries are answered out of the response cache (invalidated whenever the vector database is written to)
+    cache = get_search_cache()
+    cache_key = search_cache_key(text, query_lang, page_size, index_generation(), offset, where_key(where))
+    cached = await cache.aget(cache_key)
+    if cached is not None:
+        logging.info(f"Search response cache hit for {text!r}")
+    else:
+        # one more than the page, to know whether there is a next page
+        ranked, complete, reported_lang = await ranked_hits(text, query_lang, where, offset + page_size + 1)
+        # copies, the cached ranked list must not get the texts of the page
+        hits = [dict(hit) for hit in ranked[offset:offset + page_size]]
+        language = display_language(query_lang, reported_lang)
+        await fetch_and_translate(hits, language)
+        cached = {"hits": hits, "next_offset": next_page_offset(offset, page_size, ranked, complete), "language": language}
+        await cache.aset(cache_key, cached)
+    next_cursor = encode_cursor(text, query_lang, cached["next_offset"], where) if cached["next_offset"] is not None else None
+    return cached["hits"], next_cursor
+
+
+async def search_in_vectorsearch_db(text: str, count_answers: int = 10) -> List[SearchResponse]:
     """Search in the vector search database using langchain and chromaDB.
 
     Arguments:
     text -- the text to search for
-    count_answers -- the number of answers to return. -1 means all
+    count_answers -- the number of answers to return. -1 means all (up to SEARCH_MAX_RESULTS, use search_page() for more)
 
     Returns:
     list[SearchResponse] -- the search results
     """
 
-    print(f"{text=}")
-    # first detect the input language
-    query_lang = detect(text)
-    logging.info(f"Detected language: {query_lang}")
-    if query_lang != "en":
-        query = translate(text, dst_language="EN-US")
-        logging.info(f"(Translated) query: {query}")
-    else:
-        query = text
-
-    # Simulate some search results , in reality this will go to a RAG system
-    # search in the vector search database
-    results = []
+    logging.debug(f"{text=}")
     try:
-        vs_results = collection.query(query_texts=[query], n_results=count_answers)
-        # pprint(vs_results)
-        print(f"{type(vs_results)=}")
-        print(f"{vs_results.keys()=}")
-        # vs_results.keys()=dict_keys(['ids', 'distances', 'metadatas', 'embeddings', 'documents', 'uris', 'data'])
-        ids = vs_results['ids'][0]
-        distances = vs_results['distances'][0]
-        metadatas = vs_results['metadatas'][0]
-        documents = vs_results['documents'][0]
-        data = zip(ids, distances, metadatas, documents)
-        # pprint(list(data))
-        # convert the vs_restults to the SearchResponse model
-        for d in data:
-            print(f"{type(d)=}")
-            pprint(d)
-            print(80 * "-")
-            search_dict = {}
-            id = d[0]
-            distance = d[1]
-            metadata = d[2]
-            search_dict['id'] = id
-            search_dict['distance'] = distance
-            search_dict['date'] = metadata['date']
-            search_dict['url'] = metadata['url']
-            search_dict['title'] = metadata['title']
-            search_dict['language'] = metadata['language']
-            search_dict['dst_text'] = "".join(d[3:])
-            row = db.fetch_content_item_content_by_uid(id)
-            # next, find out the language in the row dict (['de'], 'en', etc.), so that we can access ['value']
-            lang = search_dict['language']
-            if lang in row:
-                val = row[lang]['value']
-            else:
-                _l = list(row.keys())
-                if len(_l) > 0:
-                    lang = _l[0]
-                    val = row[lang]['value']
-            print(120 * "=")
-            print(f"{val=}")
-            print(120 * "=")
-            search_dict['original_text'] = val
-            if val:
-                translated_to_query_lang = translate_via_deepl(val, dst_language=query_lang.upper())
-                search_dict['dst_text'] = translated_to_query_lang
-                pprint(search_dict)
-            # convert to pandas dataframe
-            sd_df = pd.DataFrame(search_dict, index=[0])
-            pd.concat([sd_df, pd.DataFrame([search_dict])], ignore_index=True)
-            sr = SearchResponse(**search_dict)
-            results.append(sr)
-
-        """
-        # now after we collected all search_dicts in a pandas dataframe, we will group by id and select the best match according to the minimum distance
-        results = []
-        for id in sd_df['id'].unique():
-            search_dict = sd_df[sd_df['id'] == id].sort_values(by='distance').iloc[0].to_dict()
-        """
-
-        return results
+        search_dicts, _next_cursor = await search_page(text, SEARCH_MAX_RESULTS if count_answers < 0 else count_answers)
+        return [SearchResponse(**search_dict) for search_dict in search_dicts]
+    except HTTPException:
+        raise
     except Exception as e:
         logging.error(f"Search failed: {e}")
-        raise e
-        raise HTTPException(status_code=500, detail="Search failed")
+        raise HTTPException(status_code=500, detail="Search failed") from e
+
+
+def ndjson(event: str, **data) -> str:
+    """One line of the /search/stream response."""
+    return json.dumps({"event": event, **data}) + "\n"
 
+
+async def stream_search(text: str, page_size: int = 10, cursor: Optional[str] = None, where: Optional[dict] = None) -> AsyncIterator[str]:
+    """A page of the search as a stream of NDJSON events, so the client can show the hits as soon as it has them.
+
+    Events:
+      hits -- the ranked hits, with title, url, date and the (english) text of the best chunk, right after the vector query
+      hit -- one hit (by index), once its original and translated text are there: first the ones with a
+        pre-translated snippet, then the others, after one batched translation of all of them
+      done -- the end of the stream, with the cursor of the next page (next_cursor)
+      error -- the search failed
     """
-    # Simulate some search results , in reality this will go to a RAG system
-    results = [
-        {
-            "url": "https://example.com/article1",
-            "date": "2023/4/1",
-            "title": "Article 1",
-            "original_text": "This is the original text of article 1. Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor incididunt ut labore et dolore magna aliqua. Ut enim ad minim veniam, quis nostrud exercitation ullamco laboris nisi ut aliquip ex ea commodo consequat. Duis aute irure dolor in reprehenderit in voluptate velit esse cillum dolore eu fugiat nulla pariatur. Excepteur sint occaecat cupidatat non proident, sunt in culpa qui officia deserunt mollit anim id est laborum.",
-            "dst_text": "Esto es el texto original del artículo 1."
-        },
-        {
-            "url": "https://example.com/article2",
-            "date": "2023/3/15",
-            "title": "Article 2",
-            "original_text": "This is the original text of article 2.",
-            "dst_text": "Esto es el texto original del artículo 2."
-        }
-    ]
+    try:
+        with span("detect"):
+            query_lang = await asyncio.to_thread(detect_language, text, "")
+        offset = decode_cursor(cursor, text, query_lang, where) if cursor else 0
+        cache = get_search_cache()
+        cache_key = search_cache_key(text, query_lang, page_size, index_generation(), offset, where_key(where))
+        cached = await cache.aget(cache_key)
+        if cached is not None:
+            yield ndjson("hits", language=cached.get("language", display_language(query_lang)), hits=[SearchResponse(**sd).model_dump() for sd in cached["hits"]])
+            next_cursor = encode_cursor(text, query_lang, cached["next_offset"], where) if cached["next_offset"] is not None else None
+            yield ndjson("done", next_cursor=next_cursor)
+            return
+
+        ranked, complete, reported_lang = await ranked_hits(text, query_lang, where, offset + page_size + 1)
+        search_dicts = [dict(hit) for hit in ranked[offset:offset + page_size]]
+        next_offset = next_page_offset(offset, page_size, ranked, complete)
+        language = display_language(query_lang, reported_lang)
+        yield ndjson("hits", language=language, hits=[SearchResponse(**sd).model_dump() for sd in search_dicts])
+
+        batch = await fetch_originals(search_dicts, language)
+        for i, search_dict in enumerate(search_dicts):
+            if i not in batch:
+                yield ndjson("hit", index=i, hit=SearchResponse(**search_dict).model_dump())
+        if batch:
+            # the rest of the page is translated with one (batched) DeepL request, like the page of /search
+            await translate_originals([search_dicts[i] for i in batch], language)
+            for i in batch:
+                yield ndjson("hit", index=i, hit=SearchResponse(**search_dicts[i]).model_dump())
+        await cache.aset(cache_key, {"hits": search_dicts, "next_offset": next_offset, "language": language})
+        yield ndjson("done", next_cursor=encode_cursor(text, query_lang, next_offset, where) if next_offset is not None else None)
+    except HTTPException as e:
+        yield ndjson("error", detail=e.detail)
+    except Exception as e:
+        logging.error(f"Search failed: {e}")
+        yield ndjson("error", detail="Search failed")
+
+
+@app.get("/healthz")
+def healthz() -> dict:
+    """Liveness: the process is up and serves requests (it doesn't depend on the repco DB or the warm-up)."""
+    return {"status": "ok"}
 
+
+@app.get("/readyz")
+def readyz(response: Response) -> dict:
+    """Readiness: the warm-up is done and the vector database is loaded (HTTP 503 until then).
+
+    Also reports the warm-up steps, the cold start timings and if the repco DB pool is connected.
     """
-    return results
+    ready = warmup.ready or not WARMUP_ENABLED     # without the warm-up, everything is loaded on first use
+    if not ready:
+        response.status_code = 503
+    return {"status": "ready" if ready else "starting", "steps": warmup.status, "failed": warmup.failed(),
+            "cold_start": warmup.cold_start(), "db_connected": adb.pool is not None}
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def metrics() -> PlainTextResponse:
+    """The latency histograms of the requests and of the search stages, in the Prometheus text format."""
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/cache/stats")
+def cache_stats() -> dict:
+    """Hit/miss counters of the translation and the search response caches."""
+    return {"translation": get_translation_cache().stats(), "search": get_search_cache().stats()}
+
+
+def search_filters(date_from: Optional[date] = Query(None, description="only items published on this day or later"),
+                   date_to: Optional[date] = Query(None, description="only items published on this day or earlier"),
+                   language: Optional[List[str]] = Query(None, description="only items in these source languages"),
+                   series: Optional[List[str]] = Query(None, description="only items of these series (primary grouping uids)")) -> Optional[dict]:
+    """The search filters of a request, as a chromaDB where filter."""
+    return build_where(date_from, date_to, language, series)
 
 
 @app.get("/search", response_model=List[SearchResponse])
-def search(query: str = Query(..., min_length=1)) -> List[SearchResponse]:
+async def search(response: Response, query: str = Query(..., min_length=1),
+                 page_size: int = Query(10, ge=1, le=SEARCH_MAX_PAGE_SIZE),
+                 cursor: Optional[str] = Query(None, description="the X-Next-Cursor header of the previous page"),
+                 where: Optional[dict] = Depends(search_filters)) -> List[SearchResponse]:
+    """One page of the search results, best first (by the fused vector and lexical rank, see ranked_hits()).
+
+    The X-Next-Cursor response header points to the next page.
+    """
+    logging.debug(f"{query=}")
+    try:
+        search_dicts, next_cursor = await search_page(query, page_size, cursor, where)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logging.error(f"Search failed: {e}")
+        raise HTTPException(status_code=500, detail="Search failed") from e
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return [SearchResponse(**search_dict) for search_dict in search_dicts]
 
-    results = search_in_vectorsearch_db(query)
-    results = sorted(results, key=lambda x: x.distance, reverse=False)
 
-    return results
+@app.get("/search/stream")
+async def search_stream(query: str = Query(..., min_length=1), page_size: int = Query(10, ge=1, le=SEARCH_MAX_PAGE_SIZE),
+                        cursor: Optional[str] = None, where: Optional[dict] = Depends(search_filters)) -> StreamingResponse:
+    """A page of the search results as NDJSON events (see stream_search()), for showing them progressively."""
+    return StreamingResponse(stream_search(query, page_size, cursor, where), media_type="application/x-ndjson")
@@ -0,0 +1,143 @@
+"""Latency metrics of the search: timing spans per stage, Prometheus histograms and the Server-Timing header.
+
+Every stage of a search runs in a span:
+
+    with span("vector_query"):
+        results = await asyncio.to_thread(collection.query, ...)
+
+A span is observed in the histogram of its stage (GET /metrics, in the Prometheus text format) and
+recorded for the current request (see start_request()), the spans of a request become its Server-Timing
+header. The stages of the search are: detect, translate_query, vector_search (the wait for a batched
+vector query, see app.batching), lexical_query, db_fetch and translate_hits. The batched vector queries
+themselves are timed as embed_query and vector_query, they belong to no single request.
+"""
+
+import cProfile
+import io
+import os
+import pstats
+import threading
+import time
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() in ("1", "true", "yes")
+# ?profile=1 answers a request with the cProfile summary of it (instead of its response), off by default: anybody could slow the app down with it
+PROFILING_ENABLED = os.getenv("PROFILING_ENABLED", "false").lower() in ("1", "true", "yes")
+# the number of functions in a profile summary
+PROFILE_TOP = int(os.getenv("PROFILE_TOP", "40"))
+
+# seconds, from a cache hit up to a slow LLM translation
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# the spans (stage, seconds) of the current request, None outside of a request
+_spans: ContextVar[Optional[List[Tuple[str, float]]]] = ContextVar("spans", default=None)
+
+
+class Histogram():
+    """A Prometheus histogram (cumulative buckets, sum and count) per combination of label values."""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        # label values -> [count per bucket (the last one is +Inf), sum]
+        self._series: Dict[Tuple[str, ...], list] = {}
+
+    def observe(self, value: float, **labels: str):
+        """Count one observation."""
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            series = self._series.setdefault(key, [[0] * (len(self.buckets) + 1), 0.0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+                    break
+            else:
+                series[0][-1] += 1
+            series[1] += value
+
+    def render(self) -> List[str]:
+        """The lines of the histogram in the Prometheus text format."""
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = sorted((key, list(counts), total) for key, (counts, total) in self._series.items())
+        for key, counts, total in series:
+            labels = [f'{name}="{_escape(value)}"' for name, value in zip(self.labelnames, key)]
+            cumulative = 0
+            for bound, count in zip([*map(_format_bound, self.buckets), "+Inf"], counts):
+                cumulative += count
+                bucket_labels = ",".join([*labels, f'le="{bound}"'])
+                lines.append(f"{self.name}_bucket{{{bucket_labels}}} {cumulative}")
+            suffix = "{" + ",".join(labels) + "}" if labels else ""
+            lines.append(f"{self.name}_sum{suffix} {total}")
+            lines.append(f"{self.name}_count{suffix} {cumulative}")
+        return lines
+
+    def clear(self):
+        """Drop all observations."""
+        with self._lock:
+            self._series.clear()
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_bound(bound: float) -> str:
+    return repr(float(bound))
+
+
+STAGE_SECONDS = Histogram("search_stage_duration_seconds", "Duration of the stages of a search", ["stage"])
+REQUEST_SECONDS = Histogram("http_request_duration_seconds", "Duration of the HTTP requests (until the response starts)",
+                            ["method", "path", "status"])
+# the number of queries per batched vector query, see app.batching
+VECTOR_BATCH_SIZE = Histogram("vector_query_batch_size", "Number of search queries per batched vector query", buckets=(1, 2, 4, 8, 16, 32, 64, 128))
+REGISTRY = [REQUEST_SECONDS, STAGE_SECONDS, VECTOR_BATCH_SIZE]
+
+
+def start_request() -> List[Tuple[str, float]]:
+    """Start recording the spans of a request (in the current context and the tasks and threads started from it)."""
+    spans = []
+    _spans.set(spans)
+    return spans
+
+
+@contextmanager
+def span(stage: str) -> Iterator[None]:
+    """Time a stage, see the module documentation."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        if METRICS_ENABLED:
+            STAGE_SECONDS.observe(elapsed, stage=stage)
+            spans = _spans.get()
+            if spans is not None:
+                spans.append((stage, elapsed))
+
+
+def server_timing(spans: Sequence[Tuple[str, float]]) -> str:
+    """The Server-Timing header of spans, the spans of a stage which ran several times (per hit) are summed up."""
+    durations = {}
+    for stage, seconds in spans:
+        durations[stage] = durations.get(stage, 0.0) + seconds
+    return ", ".join(f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in durations.items())
+
+
+def render_metrics() -> str:
+    """All metrics in the Prometheus text format."""
+    return "\n".join(line for metric in REGISTRY for line in metric.render()) + "\n"
+
+
+def profile_summary(profiler: cProfile.Profile, top: int = PROFILE_TOP) -> str:
+    """The top functions (by cumulative time) of a profile, as text."""
+    out = io.StringIO()
+    pstats.Stats(profiler, stream=out).sort_stats("cumulative").print_stats(top)
+    return out.getvalue()
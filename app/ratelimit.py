@@ -0,0 +1,93 @@
+"""Client side rate limiting for the LLM / translation providers.
+
+The providers limit us in requests per minute and in tokens per minute. RateLimiter
+keeps us below both budgets (one token bucket each) and call_with_backoff() retries
+whatever still gets rejected with HTTP 429.
+"""
+
+import logging
+import random
+import threading
+import time
+
+from typing import Callable, Optional
+
+
+class TokenBucket():
+    """Thread safe token bucket: holds up to capacity tokens, refilled at rate tokens per second."""
+
+    def __init__(self, capacity: float, rate: float):
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, amount: float = 1):
+        """Take amount tokens out of the bucket, wait until there are enough.
+
+        Requests bigger than the whole bucket are capped to its capacity (otherwise they would wait forever).
+        """
+        amount = min(amount, self.capacity)
+        while True:
+            with self._lock:
+                self._refill()
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                wait = (amount - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class RateLimiter():
+    """Budget in requests per minute and tokens per minute (0 means: no limit).
+
+    count_tokens estimates the tokens a request for a given text will use up, see acquire_for().
+    """
+
+    def __init__(self, requests_per_minute: float = 0, tokens_per_minute: float = 0,
+                 count_tokens: Optional[Callable[[str], int]] = None):
+        self.requests = TokenBucket(requests_per_minute, requests_per_minute / 60) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute, tokens_per_minute / 60) if tokens_per_minute else None
+        self.count_tokens = count_tokens
+
+    def acquire(self, tokens: int = 0):
+        """Wait until one more request with (about) this many tokens fits into the budget."""
+        if self.requests:
+            self.requests.acquire(1)
+        if self.tokens and tokens:
+            self.tokens.acquire(tokens)
+
+    def acquire_for(self, text: str):
+        """Wait until one more request for this text fits into the budget."""
+        tokens = self.count_tokens(text) if self.tokens and self.count_tokens else 0
+        self.acquire(tokens)
+
+
+def is_rate_limit_error(e: Exception) -> bool:
+    """Check if an exception (of openai, anthropic, deepl, httpx, ...) means HTTP 429 / too many requests."""
+    if getattr(e, "status_code", None) == 429:
+        return True
+    if getattr(getattr(e, "response", None), "status_code", None) == 429:
+        return True
+    name = type(e).__name__
+    return "RateLimit" in name or "TooManyRequests" in name
+
+
+def call_with_backoff(fn: Callable, *args, max_retries: int = 6, base_delay: float = 1.0, max_delay: float = 60.0, **kwargs):
+    """Call fn(*args, **kwargs), retry with exponential backoff (and jitter) as long as it fails with a rate limit error."""
+    for attempt in range(max_retries + 1):
+        try:
+            return fn(*args, **kwargs)
+        except Exception as e:
+            if attempt == max_retries or not is_rate_limit_error(e):
+                raise
+            delay = min(max_delay, base_delay * 2 ** attempt) * (0.5 + random.random() / 2)
+            logging.warning(f"Rate limited ({e}), retrying in {delay:.1f}s")
+            time.sleep(delay)
+    return None     # not reached
@@ -0,0 +1,120 @@
+"""Pre-translated titles and snippets of the content items.
+
+Translating the search results into the language of the query is the slowest and most expensive part
+of a search. The ingest therefore translates the title and a short snippet of every content item into
+the most common query languages (SNIPPET_LANGUAGES) and keeps them in a small SQLite side store,
+keyed by (uid, language) and stamped with the revision they were made of. The search serves from it
+and only translates live for the other languages. Both make the snippet out of the same text, the
+content column of the content item (see pick_original_text()).
+"""
+
+import logging
+import os
+import re
+import sqlite3
+import threading
+
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from app.misc import convert_html_to_text
+from app.vectorstore import DATA_DIR
+
+
+SNIPPET_STORE_PATH = os.getenv("SNIPPET_STORE_PATH", os.path.join(DATA_DIR, "snippets.db"))
+SNIPPET_LANGUAGES = [language.strip().lower() for language in os.getenv("SNIPPET_LANGUAGES", "de,en,fr,es,it,pl,hu,sl").split(",")
+                     if language.strip()]
+SNIPPET_MAX_CHARS = int(os.getenv("SNIPPET_MAX_CHARS", "600"))
+# the ingest translates the snippets of this many content items with one DeepL request per language
+SNIPPET_BATCH_ITEMS = int(os.getenv("SNIPPET_BATCH_ITEMS", "25"))
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def pick_original_text(content: dict, language: str) -> str:
+    """Pick the text in the given language out of a ContentItem content column (fall back to the first language)."""
+    # find out the language in the content dict (['de'], 'en', etc.), so that we can access ['value']
+    if not content:
+        return ""
+    if language not in content:
+        language = list(content.keys())[0]
+    return content[language].get('value', "")
+
+
+def make_snippet(text: str, max_chars: int = SNIPPET_MAX_CHARS) -> str:
+    """The plain text start of a (HTML) text, cut at a sentence or word boundary after at most max_chars characters."""
+    if not text:
+        return ""
+    text = " ".join(convert_html_to_text(text).split())
+    if len(text) <= max_chars:
+        return text
+    cut = text[:max_chars]
+    sentence_end = max(cut.rfind(". "), cut.rfind("! "), cut.rfind("? "))
+    if sentence_end > max_chars // 3:     # unless that throws away most of the snippet
+        return cut[:sentence_end + 1]
+    return re.sub(r"\s+\S*$", "", cut) + " …"
+
+
+class SnippetStore():
+    """SQLite table of the translated (title, snippet) per content item and language."""
+
+    def __init__(self, path: str = SNIPPET_STORE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS snippets (
+                uid TEXT NOT NULL,
+                language TEXT NOT NULL,
+                revision TEXT NOT NULL,
+                title TEXT NOT NULL,
+                snippet TEXT NOT NULL,
+                PRIMARY KEY (uid, language)
+            )""")
+
+    def put(self, uid: str, revision: str, snippets: Dict[str, Tuple[str, str]]):
+        """Store the snippets of one content item, {language: (title, snippet)}. They replace older revisions."""
+        with self._lock:
+            self.conn.execute("BEGIN")
+            self.conn.executemany("INSERT OR REPLACE INTO snippets (uid, language, revision, title, snippet) VALUES (?, ?, ?, ?, ?)",
+                                  [(uid, language, revision, title, snippet) for language, (title, snippet) in snippets.items()])
+            self.conn.execute("COMMIT")
+
+    def languages(self, uid: str, revision: str) -> List[str]:
+        """The languages which are already materialized for this revision of a content item."""
+        with self._lock:
+            rows = self.conn.execute("SELECT language FROM snippets WHERE uid = ? AND revision = ?", (uid, revision)).fetchall()
+        return [row[0] for row in rows]
+
+    def get_many(self, uids: Iterable[str], language: str) -> Dict[str, Tuple[str, str, str]]:
+        """{uid: (revision, title, snippet)} of the content items which have a snippet in this language."""
+        uids = list(dict.fromkeys(uids))
+        if not uids:
+            return {}
+        placeholders = ",".join("?" * len(uids))
+        with self._lock:
+            rows = self.conn.execute(f"SELECT uid, revision, title, snippet FROM snippets WHERE language = ? AND uid IN ({placeholders})",
+                                     [language.lower(), *uids]).fetchall()
+        return {row[0]: (row[1], row[2], row[3]) for row in rows}
+
+    def __len__(self):
+        with self._lock:
+            return self.conn.execute("SELECT COUNT(*) FROM snippets").fetchone()[0]
+
+    def close(self):
+        """Close the SQLite connection."""
+        self.conn.close()
+
+
+def get_snippet_store() -> Optional[SnippetStore]:
+    """Return the process wide SnippetStore (opened on first use), None if SNIPPET_STORE_PATH is empty or can't be opened."""
+    global _store       # pylint: disable=global-statement
+    with _store_lock:
+        if _store is None and SNIPPET_STORE_PATH:
+            try:
+                _store = SnippetStore(SNIPPET_STORE_PATH)
+            except sqlite3.Error as e:
+                logging.error(f"Could not open the snippet store {SNIPPET_STORE_PATH}: {e}")
+        return _store
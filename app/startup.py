@@ -0,0 +1,79 @@
+"""Background warm-up of the app and the readiness state for /readyz.
+
+Nothing heavy happens at import time or blocks the startup: the vector database, the embedding model,
+the language profiles and the translation engine are loaded on first use. The warm-up loads them right
+after the startup in the background, so the first searches don't pay for it, and records how long each
+step took. /healthz only tells that the process is alive, /readyz that the warm-up is done.
+"""
+
+import asyncio
+import logging
+import os
+import time
+
+from typing import Any, Callable, Dict, List, Sequence, Tuple
+
+
+# the fallback of process_age() where /proc is missing
+IMPORT_START = time.monotonic()
+
+
+def process_age() -> float:
+    """Seconds since the process started (on Linux, elsewhere since this module was imported)."""
+    try:
+        with open("/proc/self/stat", "r", encoding="utf-8") as f:
+            start_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime", "r", encoding="utf-8") as f:
+            uptime = float(f.read().split()[0])
+        return max(uptime - start_ticks / os.sysconf("SC_CLK_TCK"), 0.0)
+    except (OSError, ValueError, IndexError):
+        return time.monotonic() - IMPORT_START
+
+
+class Warmup():
+    """Runs named warm-up steps one after the other in a worker thread, and keeps their status and timing."""
+
+    def __init__(self, steps: Sequence[Tuple[str, Callable[[], Any]]], required: Sequence[str] = ()):
+        """
+        Args:
+          steps -- (name, blocking function) in the order they run
+          required -- the names of the steps which have to succeed for the app to be ready
+        """
+        self.steps = list(steps)
+        self.required = set(required)
+        self.status: Dict[str, dict] = {name: {"status": "pending"} for name, _step in self.steps}
+        self.started = None
+        self.finished = None
+
+    async def run(self):
+        """Run all steps, a failing step is logged and doesn't stop the others."""
+        self.started = process_age()
+        for name, step in self.steps:
+            self.status[name] = {"status": "running"}
+            start = time.monotonic()
+            try:
+                await asyncio.to_thread(step)
+                self.status[name] = {"status": "ok", "seconds": round(time.monotonic() - start, 3)}
+            except Exception as e:
+                logging.error(f"Warm-up step {name} failed: {e}")
+                self.status[name] = {"status": "failed", "seconds": round(time.monotonic() - start, 3), "error": str(e)}
+        self.finished = process_age()
+        logging.info(f"Warm-up done, ready {self.finished:.1f}s after the process start: {self.status}")
+
+    def start(self) -> asyncio.Task:
+        """Run the steps in the background."""
+        return asyncio.create_task(self.run())
+
+    @property
+    def ready(self) -> bool:
+        """The warm-up is done and the required steps succeeded."""
+        return self.finished is not None and all(self.status[name]["status"] == "ok" for name in self.required)
+
+    def failed(self) -> List[str]:
+        """The names of the failed steps."""
+        return [name for name, status in self.status.items() if status["status"] == "failed"]
+
+    def cold_start(self) -> dict:
+        """Seconds from the start of the process to the start of the warm-up (the app accepts requests) and to its end (None while it runs)."""
+        return {"startup_seconds": round(self.started, 3) if self.started is not None else None,
+                "ready_seconds": round(self.finished, 3) if self.finished is not None else None}
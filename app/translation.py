@@ -2,17 +2,45 @@
 
 
 # from pydantic import BaseModel, Field
+import asyncio
+import json
 import os
 import logging
+import re
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Tuple
 
 import deepl
+import httpx
 
-from langchain import hub
-from langchain_openai import ChatOpenAI
+from langchain_core.language_models.chat_models import BaseChatModel
 from langchain_core.pydantic_v1 import BaseModel, Field
 from langchain_core.output_parsers import JsonOutputParser
+from langchain_core.prompts import ChatPromptTemplate
+
+from app.cache import get_translation_cache, translation_cache_key
+from app.ratelimit import RateLimiter, call_with_backoff
+
+
+OPENAI_MODEL = 'gpt-3.5-turbo'
+ANTHROPIC_MODEL = 'claude-3-haiku-20240307'
+TRANSLATION_PROMPT_FILE = os.path.join(os.path.dirname(__file__), "prompts", "basic_translation.json")
+TRANSLATION_MAX_RETRIES = int(os.getenv("TRANSLATION_MAX_RETRIES", "6"))
+
+# DeepL accepts up to 50 texts per request
+DEEPL_BATCH_SIZE = int(os.getenv("DEEPL_BATCH_SIZE", "50"))
+DEEPL_MAX_WORKERS = int(os.getenv("DEEPL_MAX_WORKERS", "4"))
+DEEPL_TIMEOUT = float(os.getenv("DEEPL_TIMEOUT", "30"))
+
+# LLM_PROVIDER -> factory returning (model name, chat model), see register_backend()
+LLM_BACKENDS: Dict[str, Callable[[], Tuple[str, BaseChatModel]]] = {}
+_engine = None
+_engine_lock = threading.Lock()
 
-from langchain_anthropic import ChatAnthropic
+_deepl_translators = {}
+_async_http_client = None
 
 
 class Translation(BaseModel):
@@ -36,89 +64,350 @@ class Translation(BaseModel):
         return self.__str__()
 
 
-def translate(src_text: str, dst_language: str = 'english', _src_language: str = None) -> str:
-    """Translate a string to the reference language (english)
+def register_backend(name: str):
+    """Decorator to register an LLM backend for LLM_PROVIDER=name.
+
+    The decorated factory returns (model name, langchain chat model).
+    """
+    def _register(factory: Callable[[], Tuple[str, BaseChatModel]]):
+        LLM_BACKENDS[name] = factory
+        return factory
+    return _register
 
-    Args:
-      src_text -- the string to translate
-      dst_language -- the destination language (default 'english')
+
+@register_backend('openai')
+def _openai_backend() -> Tuple[str, BaseChatModel]:
+    # the provider SDKs take a while to import, only the configured one is loaded
+    from langchain_openai import ChatOpenAI     # pylint: disable=import-outside-toplevel
+    logging.info("Using OpenAI")
+    # model = model.with_structured_output(schema=Translation, method="json_mode")      # this is currently broken in langchain 0.1.13
+    return OPENAI_MODEL, ChatOpenAI(model=OPENAI_MODEL, temperature=0)
+
+
+@register_backend('anthropic')
+def _anthropic_backend() -> Tuple[str, BaseChatModel]:
+    from langchain_anthropic import ChatAnthropic     # pylint: disable=import-outside-toplevel
+    logging.info("Using Claude (Anthropic)")
+    return ANTHROPIC_MODEL, ChatAnthropic(model=ANTHROPIC_MODEL, temperature=0)
+
+
+def load_translation_prompt(path: str = TRANSLATION_PROMPT_FILE) -> Tuple[ChatPromptTemplate, str]:
+    """Load the vendored translation prompt (originally aaronkaplan/basic_translation on the LangChain Hub).
 
     Returns:
-      str -- the translated string
+      the prompt and its version (name@version, part of the translation cache key)
     """
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    prompt = ChatPromptTemplate.from_messages([tuple(message) for message in data['messages']])
+    return prompt, f"{data['name']}@{data['version']}"
 
-    # first initialize the connectoin to  the llm
-    if os.getenv('LLM_PROVIDER').lower() == 'openai':
-        logging.info("Using OpenAI")
-        model = ChatOpenAI(model='gpt-3.5-turbo', temperature=0)
-        # model = model.with_structured_output(schema=Translation, method="json_mode")      # this is currently broken in langchain 0.1.13
-    elif os.getenv('LLM_PROVIDER').lower() == 'anthropic':
-        logging.info("Using Claude (Anthropic)")
-        model = ChatAnthropic(model="claude-3-haiku-20240307", temperature=0)
-    else:
-        raise ValueError("Unknown LLM_PROVIDER")
-    output_parser = JsonOutputParser(pydantic_object=Translation)
-    # print(f"{output_parser.get_format_instructions()=}")
-    # first get the input language
-    # XXX detect the input language and set the input_language variable
-    # ... here we could make another prompt which detect the input language
-    # and then it might be safer to use the right language model. --> Later
-    #   example: input_language = "spanish"
-    # then we will also have to adjust the prompt again to contain {input_language}
-
-    # nowfirst get the right prompt
-    prompt = hub.pull("aaronkaplan/basic_translation")
-    data = {"src_text": src_text, "dst_language": dst_language}
-
-    # prompt = prompt.partial(format_instructions=output_parser.get_format_instructions())
-    chain = prompt | model | output_parser
-
-    # now use the llm with the prompt to translate the text
-    result = chain.invoke(data)
 
-    try:
-        translation = Translation({'src_text': src_text,
-                                   'dst_text': result['dst_text'],
-                                   'src_language': result['src_language'],
-                                   'dst_language': dst_language
-                                   })
-    except Exception as e:
-        logging.error("Translation failed: %s" % str(e))
-        logging.error("LLM result: %s" % result)
-        raise e
-    return translation.dst_text
+class TranslationEngine():
+    """Translates texts with an LLM. Build it once (see get_engine()), the model client, parser and prompt are reused."""
 
+    def __init__(self, provider: str = None):
+        self.provider = (provider or os.getenv('LLM_PROVIDER', '')).lower()
+        if self.provider not in LLM_BACKENDS:
+            raise ValueError("Unknown LLM_PROVIDER")
+        self.model_name, self.model = LLM_BACKENDS[self.provider]()
+        self.output_parser = JsonOutputParser(pydantic_object=Translation)
+        self.prompt, self.prompt_version = load_translation_prompt()
+        self.chain = self.prompt | self.model | self.output_parser
 
-def translate_via_deepl(src_text: str, dst_language: str = 'EN-US', _src_language: str = None) -> str:
-    """Translate a string to to the dst_language using DeepL
+    def cache_key(self, src_text: str, dst_language: str, src_language: str = None) -> str:
+        """The translation cache key for a text translated by this engine."""
+        return translation_cache_key(self.provider, src_text, src_language, dst_language, f"{self.model_name}|{self.prompt_version}")
+
+    def _result(self, src_text: str, dst_language: str, result: dict) -> str:
+        """Validate the parsed LLM output and return the translated text."""
+        try:
+            translation = Translation({'src_text': src_text,
+                                       'dst_text': result['dst_text'],
+                                       'src_language': result['src_language'],
+                                       'dst_language': dst_language
+                                       })
+        except Exception as e:
+            logging.error("Translation failed: %s" % str(e))
+            logging.error("LLM result: %s" % result)
+            raise e
+        return translation.dst_text
+
+    def translate(self, src_text: str, dst_language: str = 'english', _src_language: str = None, rate_limiter: RateLimiter = None) -> str:
+        """See translate()."""
+        # did we translate this text already?
+        cache = get_translation_cache()
+        cache_key = self.cache_key(src_text, dst_language, _src_language)
+        cached = cache.get(cache_key)
+        if cached is not None:
+            return cached
+
+        data = {"src_text": src_text, "dst_language": dst_language}
+        # now use the llm with the prompt to translate the text
+        if rate_limiter:
+            def _invoke():
+                rate_limiter.acquire_for(src_text)
+                return self.chain.invoke(data)
+            result = call_with_backoff(_invoke, max_retries=TRANSLATION_MAX_RETRIES)
+        else:
+            result = self.chain.invoke(data)
+        dst_text = self._result(src_text, dst_language, result)
+        cache.set(cache_key, dst_text)
+        return dst_text
+
+    async def atranslate(self, src_text: str, dst_language: str = 'english', _src_language: str = None) -> str:
+        """Async version of translate()."""
+        cache = get_translation_cache()
+        cache_key = self.cache_key(src_text, dst_language, _src_language)
+        cached = await cache.aget(cache_key)
+        if cached is not None:
+            return cached
+
+        result = await self.chain.ainvoke({"src_text": src_text, "dst_language": dst_language})
+        dst_text = self._result(src_text, dst_language, result)
+        await cache.aset(cache_key, dst_text)
+        return dst_text
+
+    async def atranslate_detect(self, src_text: str, dst_language: str = 'english') -> Tuple[str, str]:
+        """Like atranslate(), but also returns the source language the LLM reports (an ISO 639-1 code, "" if it reports none)."""
+        cache = get_translation_cache()
+        # cached apart from atranslate(), with the reported language
+        cache_key = self.cache_key(src_text, dst_language, "detect")
+        cached = await cache.aget(cache_key)
+        if cached is not None:
+            return cached[0], cached[1]
+
+        result = await self.chain.ainvoke({"src_text": src_text, "dst_language": dst_language})
+        dst_text = self._result(src_text, dst_language, result)
+        src_language = str(result.get('src_language') or "").split("-")[0].lower()
+        if not re.fullmatch(r"[a-z]{2}", src_language):
+            src_language = ""
+        await cache.aset(cache_key, [dst_text, src_language])
+        return dst_text, src_language
+
+
+def get_engine() -> TranslationEngine:
+    """Return the process wide translation engine for LLM_PROVIDER (built on first use)."""
+    global _engine      # pylint: disable=global-statement
+    with _engine_lock:
+        if _engine is None:
+            _engine = TranslationEngine()
+        return _engine
+
+
+def translate(src_text: str, dst_language: str = 'english', _src_language: str = None, rate_limiter: RateLimiter = None) -> str:
+    """Translate a string to the reference language (english)
 
     Args:
       src_text -- the string to translate
       dst_language -- the destination language (default 'english')
+      rate_limiter -- if set, wait for the request/token budget before calling the LLM
+        and retry with backoff if we get rate limited anyway
 
     Returns:
       str -- the translated string
     """
+    return get_engine().translate(src_text, dst_language, _src_language, rate_limiter)
+
+
+async def atranslate(src_text: str, dst_language: str = 'english', _src_language: str = None) -> str:
+    """Async version of translate()."""
+    return await get_engine().atranslate(src_text, dst_language, _src_language)
+
+
+async def atranslate_detect(src_text: str, dst_language: str = 'english') -> Tuple[str, str]:
+    """Translate a string whose language is unknown, returns (the translated string, the source language the LLM reports or "")."""
+    return await get_engine().atranslate_detect(src_text, dst_language)
+
+
+def get_deepl_translator() -> deepl.Translator:
+    """Return a (shared) DeepL translator for the configured DEEPL_API_KEY."""
     deepl_api_key = os.getenv("DEEPL_API_KEY", '')
     if not deepl_api_key:
         raise ValueError("DEEPL_API_KEY not set")
+    if deepl_api_key not in _deepl_translators:
+        _deepl_translators[deepl_api_key] = deepl.Translator(deepl_api_key)
+    return _deepl_translators[deepl_api_key]
+
 
+def deepl_target_language(dst_language: str) -> str:
+    """Map a language name or code to a target_lang value accepted by DeepL."""
     # XXX FIXME: DeepL is a bit picky w.r.t to the target_lang parameter.
     #  It seems to require the language code in uppercase
     # and in addition, only certain values for target_lang are accepted.
     # see https://www.deepl.com/docs-api/translating-text/?utm_source=github&utm_medium=github-python-readme
     # so we will have to make a mapping here.
     if dst_language.lower() == 'english' or dst_language.upper() == 'EN':
-        dst_language = 'EN-US'
+        return 'EN-US'
+    return dst_language.upper()
+
+
+def translate_via_deepl(src_text: str, dst_language: str = 'EN-US', _src_language: str = None) -> str:
+    """Translate a string to to the dst_language using DeepL
+
+    Args:
+      src_text -- the string to translate
+      dst_language -- the destination language (default 'english')
+
+    Returns:
+      str -- the translated string
+    """
+    dst_language = deepl_target_language(dst_language)
+    cache = get_translation_cache()
+    cache_key = translation_cache_key("deepl", src_text, _src_language, dst_language)
+    cached = cache.get(cache_key)
+    if cached is not None:
+        return cached
+    translator = get_deepl_translator()
     try:
-        translator = deepl.Translator(deepl_api_key)
-        result = translator.translate_text(src_text, target_lang=dst_language.upper())
+        result = translator.translate_text(src_text, target_lang=dst_language)
+        cache.set(cache_key, result.text)
         return result.text
     except Exception as e:
         logging.error("Translation failed (dst_language: %s): %s" % (dst_language, str(e)))
         return ""
 
 
+def _lookup_deepl_cache(src_texts: List[str], dst_language: str) -> Tuple[List[str], Dict[str, List[int]]]:
+    """Fill in the cached translations.
+
+    Returns:
+      the results list ("" where nothing was cached) and the missing texts, each one only once, with their positions.
+    """
+    cache = get_translation_cache()
+    results = [""] * len(src_texts)
+    missing = {}
+    for i, src_text in enumerate(src_texts):
+        if not src_text:
+            continue
+        cached = cache.get(translation_cache_key("deepl", src_text, None, dst_language))
+        if cached is not None:
+            results[i] = cached
+        else:
+            missing.setdefault(src_text, []).append(i)
+    return results, missing
+
+
+def _store_deepl_results(results: List[str], missing: Dict[str, List[int]], dst_language: str, src_texts: List[str], dst_texts: List[str]):
+    """Put fresh translations into the results list and the cache."""
+    cache = get_translation_cache()
+    for src_text, dst_text in zip(src_texts, dst_texts):
+        if dst_text:
+            cache.set(translation_cache_key("deepl", src_text, None, dst_language), dst_text)
+        for i in missing[src_text]:
+            results[i] = dst_text
+
+
+def translate_batch_via_deepl(src_texts: List[str], dst_language: str = 'EN-US') -> List[str]:
+    """Translate a list of strings to the dst_language using DeepL, with as few requests as possible.
+
+    Cached texts are not sent again, the remaining ones are sent in batches of DEEPL_BATCH_SIZE.
+    If a batch fails, its texts are translated one by one by a pool of DEEPL_MAX_WORKERS threads.
+
+    Args:
+      src_texts -- the strings to translate
+      dst_language -- the destination language (default 'english')
+
+    Returns:
+      list[str] -- the translated strings, in the same order. Failed translations are ""
+    """
+    dst_language = deepl_target_language(dst_language)
+    results, missing = _lookup_deepl_cache(src_texts, dst_language)
+
+    texts = list(missing.keys())
+    if not texts:
+        return results
+    translator = get_deepl_translator()
+    failed = []
+    for start in range(0, len(texts), DEEPL_BATCH_SIZE):
+        batch = texts[start:start + DEEPL_BATCH_SIZE]
+        try:
+            translated = translator.translate_text(batch, target_lang=dst_language)
+        except Exception as e:
+            logging.warning("Batch translation failed (dst_language: %s): %s, retrying one by one" % (dst_language, str(e)))
+            failed.extend(batch)
+            continue
+        _store_deepl_results(results, missing, dst_language, batch, [r.text for r in translated])
+
+    if failed:
+        with ThreadPoolExecutor(max_workers=DEEPL_MAX_WORKERS) as executor:
+            dst_texts = list(executor.map(lambda t: translate_via_deepl(t, dst_language), failed))
+        _store_deepl_results(results, missing, dst_language, failed, dst_texts)
+    return results
+
+
+def deepl_api_url() -> str:
+    """Return the URL of the DeepL translate endpoint (free API keys end in ':fx')."""
+    deepl_api_key = os.getenv("DEEPL_API_KEY", '')
+    if deepl_api_key.endswith(":fx"):
+        return "https://api-free.deepl.com/v2/translate"
+    return "https://api.deepl.com/v2/translate"
+
+
+def get_async_http_client() -> httpx.AsyncClient:
+    """Return the (shared) async HTTP client for talking to DeepL."""
+    global _async_http_client       # pylint: disable=global-statement
+    if _async_http_client is None or _async_http_client.is_closed:
+        _async_http_client = httpx.AsyncClient(timeout=DEEPL_TIMEOUT)
+    return _async_http_client
+
+
+async def close_async_http_client():
+    """Close the shared async HTTP client (call this on shutdown)."""
+    if _async_http_client is not None:
+        await _async_http_client.aclose()
+
+
+async def _deepl_request(src_texts: List[str], dst_language: str) -> List[str]:
+    """Send one translate request with a list of texts to the DeepL REST API."""
+    deepl_api_key = os.getenv("DEEPL_API_KEY", '')
+    if not deepl_api_key:
+        raise ValueError("DEEPL_API_KEY not set")
+    response = await get_async_http_client().post(deepl_api_url(),
+                                                  headers={"Authorization": f"DeepL-Auth-Key {deepl_api_key}"},
+                                                  json={"text": src_texts, "target_lang": dst_language})
+    response.raise_for_status()
+    return [t["text"] for t in response.json()["translations"]]
+
+
+async def atranslate_via_deepl(src_text: str, dst_language: str = 'EN-US', _src_language: str = None) -> str:
+    """Async version of translate_via_deepl()."""
+    result = await atranslate_batch_via_deepl([src_text], dst_language)
+    return result[0]
+
+
+async def atranslate_batch_via_deepl(src_texts: List[str], dst_language: str = 'EN-US') -> List[str]:
+    """Async version of translate_batch_via_deepl().
+
+    The batches are sent concurrently. If a batch fails, its texts are sent one by one,
+    with at most DEEPL_MAX_WORKERS requests in flight.
+    """
+    dst_language = deepl_target_language(dst_language)
+    # the disk tier of the cache is SQLite, it must not block the event loop
+    results, missing = await asyncio.to_thread(_lookup_deepl_cache, src_texts, dst_language)
+    texts = list(missing.keys())
+    if not texts:
+        return results
+    semaphore = asyncio.Semaphore(DEEPL_MAX_WORKERS)
+
+    async def _send(batch: List[str]) -> List[str]:
+        async with semaphore:
+            try:
+                return await _deepl_request(batch, dst_language)
+            except Exception as e:
+                if len(batch) == 1:
+                    logging.error("Translation failed (dst_language: %s): %s" % (dst_language, str(e)))
+                    return [""]
+                logging.warning("Batch translation failed (dst_language: %s): %s, retrying one by one" % (dst_language, str(e)))
+        translated = await asyncio.gather(*(_send([t]) for t in batch))
+        return [t[0] for t in translated]
+
+    batches = [texts[start:start + DEEPL_BATCH_SIZE] for start in range(0, len(texts), DEEPL_BATCH_SIZE)]
+    for batch, dst_texts in zip(batches, await asyncio.gather(*(_send(b) for b in batches))):
+        await asyncio.to_thread(_store_deepl_results, results, missing, dst_language, batch, dst_texts)
+    return results
+
+
 if __name__ == "__main__":
     print(translate("Esto es una prueba 1", dst_language="english"))
     print("Using DeepL...")
@@ -0,0 +1,214 @@
+"""Batched writes to the chromaDB vector database.
+
+Every chunk of a content item gets its own, stable id (uid, revision and chunk index), so
+re-running the ingest overwrites the chunks instead of adding them again.
+"""
+
+import json
+import logging
+import os
+import time
+
+from datetime import date, datetime, timedelta, timezone
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+
+# the directory of the local stores (databases, caches, checkpoints, the export), the default of their paths
+DATA_DIR = os.getenv("DATA_DIR", ".")
+# the chromaDB of the ingest, the search and the lexical rebuild
+CHROMA_DB_PATH = os.getenv("CHROMA_DB_PATH", os.path.join(DATA_DIR, "chroma.db"))
+VECTORSTORE_BATCH_SIZE = int(os.getenv("VECTORSTORE_BATCH_SIZE", "256"))
+# a content item can have many chunks among the nearest neighbours, so a search asks for this many times more hits
+SEARCH_OVERFETCH = int(os.getenv("SEARCH_OVERFETCH", "4"))
+# a stamp which changes with every write to the vector database, e.g. to invalidate cached search responses
+INDEX_GENERATION_FILE = os.getenv("INDEX_GENERATION_FILE", os.path.join(DATA_DIR, "chroma.db.generation"))
+
+
+def chunk_id(uid: str, revision: str, index: int) -> str:
+    """Return the id of a chunk in the vector database."""
+    return f"{uid}:{revision}:{index}"
+
+
+def epoch(timestamp: datetime) -> int:
+    """Seconds since 1970 of a (naive, UTC) timestamp out of the repco DB."""
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    return int(timestamp.timestamp())
+
+
+def typed_metadata(pub_date: Optional[datetime], grouping_uid: Optional[str]) -> Dict[str, Any]:
+    """The metadata of a chunk which search filters work on (see build_where()): pubDate (epoch int) and grouping_uid.
+
+    Missing values are left out, chromaDB doesn't store None.
+    """
+    metadata = {}
+    if pub_date:
+        metadata["pubDate"] = epoch(pub_date)
+    if grouping_uid:
+        metadata["grouping_uid"] = grouping_uid
+    return metadata
+
+
+def build_where(date_from: Optional[date] = None, date_to: Optional[date] = None, languages: Optional[List[str]] = None,
+                series: Optional[List[str]] = None) -> Optional[Dict[str, Any]]:
+    """The chromaDB where filter for the search filters (None if there are none).
+
+    Args:
+      date_from -- only items published on this day or later
+      date_to -- only items published on this day or earlier
+      languages -- only items in one of these (source) languages
+      series -- only items of one of these series (primary grouping uids)
+    """
+    conditions = []
+    if date_from:
+        conditions.append({"pubDate": {"$gte": epoch(datetime.combine(date_from, datetime.min.time()))}})
+    if date_to:
+        conditions.append({"pubDate": {"$lt": epoch(datetime.combine(date_to + timedelta(days=1), datetime.min.time()))}})
+    if languages:
+        conditions.append({"language": {"$in": [language.lower() for language in languages]}})
+    if series:
+        conditions.append({"grouping_uid": {"$in": list(series)}})
+    if not conditions:
+        return None
+    return conditions[0] if len(conditions) == 1 else {"$and": conditions}
+
+
+def where_key(where: Optional[Dict[str, Any]]) -> str:
+    """A stable string of a where filter, for cache keys."""
+    return json.dumps(where, sort_keys=True) if where else ""
+
+
+def index_generation(path: str = INDEX_GENERATION_FILE) -> str:
+    """Return the current generation stamp of the vector database ("" if it was never written)."""
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return ""
+
+
+def bump_index_generation(path: str = INDEX_GENERATION_FILE):
+    """Start a new generation of the vector database (call it after writing to it)."""
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(str(time.time_ns()))
+    os.replace(tmp, path)
+
+
+class ChunkWriter():
+    """Buffers chunks and writes them to a chromaDB collection with one upsert per batch.
+
+    Example:
+        with ChunkWriter(collection, batch_size=256) as writer:
+            writer.add_item(uid, revision, chunks, {"title": title, "url": url})
+    """
+
+    def __init__(self, collection, batch_size: int = VECTORSTORE_BATCH_SIZE,
+                 embedding_function: Optional[Callable] = None,
+                 on_flush: Optional[Callable[[List[Any]], None]] = None, lexical_index=None):
+        """
+        Args:
+          collection -- the chromaDB collection
+          batch_size -- the number of chunks per upsert
+          embedding_function -- if set, the embeddings are computed with it (one call per batch),
+            otherwise the collection embeds the documents of the batch itself
+          on_flush -- called with the markers (see mark()) of everything which was written by a flush
+          lexical_index -- if set, the chunks are written to this app.lexical.LexicalIndex, too
+        """
+        self.collection = collection
+        self.lexical_index = lexical_index
+        self.batch_size = batch_size
+        self.embedding_function = embedding_function
+        self.on_flush = on_flush
+        self.ids = []
+        self.documents = []
+        self.metadatas = []
+        self.item_ids = {}          # uid -> ids of the chunks written (or buffered) in this run
+        self.complete_uids = []     # items whose chunks were all added
+        self.markers = []
+        self.chunks_written = 0
+
+    def add_item(self, uid: str, revision: str, chunks: Iterable[str], metadata: Dict[str, Any]):
+        """Add all chunks of one item. They share the metadata, plus uid, revision and chunk index."""
+        item_ids = self.item_ids.setdefault(uid, set())
+        for index, chunk in enumerate(chunks):
+            item_ids.add(chunk_id(uid, revision, index))
+            self.ids.append(chunk_id(uid, revision, index))
+            self.documents.append(chunk)
+            self.metadatas.append({**metadata, "uid": uid, "revision": revision, "chunk": index})
+            if len(self.ids) >= self.batch_size:
+                self.flush()
+        self.complete_uids.append(uid)
+
+    def mark(self, marker: Any):
+        """Remember a marker (e.g. a checkpoint key), which is handed to on_flush once everything added so far is written."""
+        self.markers.append(marker)
+        if not self.ids:
+            self.flush()
+
+    def flush(self):
+        """Write the buffered chunks and remove chunks of older revisions of the same items."""
+        if self.ids:
+            embeddings = self.embedding_function(self.documents) if self.embedding_function else None
+            self.collection.upsert(ids=self.ids, documents=self.documents, metadatas=self.metadatas, embeddings=embeddings)
+            if self.lexical_index is not None:
+                self.lexical_index.upsert(self.ids, self.documents, self.metadatas)
+            self.chunks_written += len(self.ids)
+            logging.info(f"Wrote {len(self.ids)} chunks to the vector database")
+            self.ids, self.documents, self.metadatas = [], [], []
+        if self.complete_uids:
+            self._delete_stale_chunks()
+        if self.markers and self.on_flush:
+            self.on_flush(self.markers)
+        self.markers = []
+
+    def _delete_stale_chunks(self):
+        """Delete the chunks of the written items which were not written in this run (older revisions, fewer chunks)."""
+        # an item might be split across two flushes, so only look at items which were added completely
+        uids = self.complete_uids
+        existing = self.collection.get(where={"uid": {"$in": uids}}, include=[])["ids"]
+        current = set().union(*(self.item_ids[uid] for uid in uids))
+        stale = [i for i in existing if i not in current]
+        if stale:
+            logging.info(f"Deleting {len(stale)} stale chunks")
+            self.collection.delete(ids=stale)
+            if self.lexical_index is not None:
+                self.lexical_index.delete(stale)
+        for uid in uids:
+            self.item_ids.pop(uid, None)
+        self.complete_uids = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()
+
+
+def hit_uid(chunk_id_: str, metadata: Dict[str, Any]) -> str:
+    """The content item a hit belongs to (transcript chunks point to the content item of their media asset).
+
+    Older DBs have no uid in the metadata, their ids are the uids.
+    """
+    metadata = metadata or {}
+    return metadata.get("content_item_uid") or metadata.get("uid") or chunk_id_
+
+
+def group_hits(results: Dict[str, Any], count: int) -> List[Tuple[str, float, Dict[str, Any], str]]:
+    """Collapse the hits of a chromaDB query to the best (nearest) chunk per content item.
+
+    Args:
+      results -- the result of collection.query() for a single query text
+      count -- the maximum number of content items to return, -1 means all
+
+    Returns:
+      list -- (uid, distance, metadata, document) of the distinct content items, nearest first
+    """
+    best = {}
+    for chunk_id_, distance, metadata, document in zip(results["ids"][0], results["distances"][0],
+                                                       results["metadatas"][0], results["documents"][0]):
+        uid = hit_uid(chunk_id_, metadata)
+        if uid not in best or distance < best[uid][1]:
+            best[uid] = (uid, distance, metadata or {}, document or "")
+    hits = sorted(best.values(), key=lambda hit: hit[1])
+    return hits if count < 0 else hits[:count]
@@ -0,0 +1 @@
+"""Offline benchmarks of the search and the ingest, see benchmarks/run.py."""
@@ -0,0 +1,294 @@
+"""Local stand-ins for the external services, so the benchmarks run offline and repeatably.
+
+  - EchoChatModel: an LLM "translation" provider (LLM_PROVIDER=fake) with a configurable latency
+  - FakeDeepL: the DeepL API (sync client and async REST requests) with a configurable latency
+  - FakeRepcoDB / FakeAsyncRepcoDB: the repco postgresql DB, a SQLite "ContentItem" table with a seeded synthetic corpus
+  - HashingEmbeddingFunction: a bag of words embedding model (EMBEDDING_BACKEND=hashing) for a synthetic chromaDB collection
+
+Import this module only after the environment of the benchmark is set up, it imports the app.
+"""
+
+import asyncio
+import hashlib
+import json
+import math
+import random
+import re
+import sqlite3
+import threading
+import time
+
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import app.db       # noqa: the sqlite3 hack for chromaDB
+import chromadb
+
+from chromadb import Documents, EmbeddingFunction, Embeddings
+from langchain_core.language_models import SimpleChatModel
+
+import app.translation
+from app.db import CONTENTITEM_FIELDS, content_item_key
+from app.embeddings import register_embedding_backend
+from app.translation import register_backend
+
+
+# a small vocabulary, german words (with umlauts) make the language identification and the translations kick in
+WORDS_EN = ["climate", "energy", "radio", "music", "community", "city", "election", "festival", "refugees", "school",
+            "health", "housing", "culture", "history", "women", "workers", "farmers", "river", "forest", "europe",
+            "interview", "report", "podcast", "concert", "theatre", "migration", "solar", "heat", "transport", "youth"]
+WORDS_DE = ["Klimawandel", "Energiewende", "Gemeinde", "Wahlen", "Flüchtlinge", "Gesundheit", "Wohnungen", "Kultur",
+            "Geschichte", "Frauen", "Arbeiter", "Bäuerinnen", "Fluss", "Wälder", "Europa", "Gespräch", "Bericht",
+            "Sendung", "Konzert", "Jugend", "Verkehr", "Wärmepumpe", "Straßenbahn", "Bürgermeisterin", "Förderung"]
+NAMES = ["Radio Helsinki", "Radio Orange", "FRO", "Radio FRO", "Graz", "Linz", "Wien", "Salzburg", "Radio Proton", "Okto"]
+LANGUAGES = ["de", "de", "de", "en", "fr", "it", "sl", "hu"]
+
+
+def sentence(rng: random.Random, words: List[str], length: int) -> str:
+    """A random sentence out of words."""
+    return " ".join(rng.choice(words) for _ in range(length)).capitalize() + "."
+
+
+def make_content_items(count: int, seed: int = 42) -> List[tuple]:
+    """A seeded synthetic "ContentItem" table, as rows of app.db.CONTENTITEM_FIELDS."""
+    rng = random.Random(seed)
+    start = datetime(2015, 1, 1)
+    rows = []
+    for i in range(count):
+        language = rng.choice(LANGUAGES)
+        words = WORDS_DE if language == "de" else WORDS_EN
+        body = " ".join(sentence(rng, words + NAMES, rng.randint(6, 18)) for _ in range(rng.randint(2, 40)))
+        title = sentence(rng, words + NAMES, rng.randint(3, 7))
+        rows.append((f"ci{i:07d}", f"rev{rng.randint(1, 3)}", None, start + timedelta(hours=rng.randint(0, 24 * 365 * 9)), "AUDIO",
+                     f"series{rng.randint(0, 49):02d}", None, None, {language: {"value": title}},
+                     {language: {"value": f"<p>{sentence(rng, words, 10)}</p>"}}, {language: {"value": f"<p>{body}</p>"}},
+                     f"https://cba.media/{i}", {}))
+    return rows
+
+
+def make_queries(count: int, seed: int = 7) -> List[str]:
+    """Seeded synthetic search queries: english and german free text, names and keyword queries."""
+    rng = random.Random(seed)
+    queries = []
+    for i in range(count):
+        kind = i % 4
+        if kind == 0:
+            queries.append("what about " + " ".join(rng.sample(WORDS_EN, rng.randint(1, 3))))
+        elif kind == 1:
+            queries.append(" ".join(rng.sample(WORDS_DE, rng.randint(2, 4))))
+        elif kind == 2:
+            queries.append(rng.choice(NAMES))
+        else:
+            queries.append(" ".join(rng.sample(WORDS_EN + WORDS_DE, rng.randint(3, 6))))
+    return queries
+
+
+# the columns of app.db.CONTENTITEM_FIELDS, the json ones are stored as JSON text and pubDate as sortable text
+CONTENTITEM_COLUMNS = [column.strip().strip('"') for column in CONTENTITEM_FIELDS.split(",")]
+JSON_COLUMNS = (8, 9, 10, 12)
+# the sort key of the repco DB (see app.db.CONTENTITEM_KEY), rows without a pubDate first
+CONTENTITEM_KEY = "COALESCE(pubDate, '0001-01-01 00:00:00.000000'), uid"
+
+
+def _pubdate(value: datetime) -> str:
+    """A pubDate as text which sorts like the dates (strftime() drops the leading zeros of the year 1)."""
+    return value.isoformat(sep=" ", timespec="microseconds")
+
+
+class ContentItemTable():
+    """A "ContentItem" table in SQLite (in memory, or in a file) with the queries of the repco DB: keyset pages and uid lookups."""
+
+    def __init__(self, rows: List[tuple], path: str = ":memory:"):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self.conn:
+            self.conn.execute("DROP TABLE IF EXISTS ContentItem")
+            self.conn.execute(f"CREATE TABLE ContentItem ({', '.join(CONTENTITEM_COLUMNS)}, PRIMARY KEY (uid))")
+            self.conn.execute(f"CREATE INDEX ContentItem_key ON ContentItem ({CONTENTITEM_KEY})")
+            self.conn.executemany(f"INSERT INTO ContentItem VALUES ({', '.join('?' * len(CONTENTITEM_COLUMNS))})",
+                                  [self._encode(row) for row in rows])
+
+    @staticmethod
+    def _encode(row: tuple) -> tuple:
+        row = list(row)
+        row[3] = _pubdate(row[3]) if row[3] else None
+        for i in JSON_COLUMNS:
+            row[i] = json.dumps(row[i]) if row[i] is not None else None
+        return tuple(row)
+
+    @staticmethod
+    def _decode(row: tuple) -> tuple:
+        row = list(row)
+        row[3] = datetime.fromisoformat(row[3]) if row[3] else None
+        for i in JSON_COLUMNS:
+            row[i] = json.loads(row[i]) if row[i] is not None else None
+        return tuple(row)
+
+    def page(self, after: Optional[Tuple[datetime, str]], page_size: int) -> List[tuple]:
+        """The page_size rows after the (pubDate, uid) key after, ordered by it."""
+        if after is None:
+            sql, params = f"SELECT * FROM ContentItem ORDER BY {CONTENTITEM_KEY} LIMIT ?", (page_size,)
+        else:
+            sql = f"SELECT * FROM ContentItem WHERE ({CONTENTITEM_KEY}) > (?, ?) ORDER BY {CONTENTITEM_KEY} LIMIT ?"
+            params = (_pubdate(after[0]), after[1], page_size)
+        with self._lock:
+            return [self._decode(row) for row in self.conn.execute(sql, params).fetchall()]
+
+    def all(self) -> List[tuple]:
+        """All rows, ordered by uid."""
+        with self._lock:
+            return [self._decode(row) for row in self.conn.execute("SELECT * FROM ContentItem ORDER BY uid").fetchall()]
+
+    def contents(self, uids: List[str]) -> Dict[str, dict]:
+        """uid -> the content column, of the uids which are there."""
+        if not uids:
+            return {}
+        with self._lock:
+            result = self.conn.execute(f"SELECT uid, content FROM ContentItem WHERE uid IN ({', '.join('?' * len(uids))})", list(uids)).fetchall()
+        return {uid: json.loads(content) if content is not None else None for uid, content in result}
+
+    def close(self):
+        """Close the database."""
+        with self._lock:
+            self.conn.close()
+
+
+class FakeRepcoDB():
+    """Stands in for app.db.DB, serving a synthetic corpus (see make_content_items()) out of SQLite with a latency per page."""
+
+    def __init__(self, rows: List[tuple], latency: float = 0.0, path: str = ":memory:"):
+        self.table = ContentItemTable(rows, path)
+        self.latency = latency
+
+    def iter_content_items(self, after: Optional[Tuple[datetime, str]] = None, page_size: int = 1000) -> Iterator[tuple]:
+        """Like DB.iter_content_items(): keyset pagination over (pubDate, uid)."""
+        while True:
+            time.sleep(self.latency)
+            page = self.table.page(after, page_size)
+            yield from page
+            if len(page) < page_size:
+                return
+            after = content_item_key(page[-1])
+
+    def fetch_random_content_items(self, limit: int = 0, seed: Optional[float] = None) -> List[tuple]:
+        """Like DB.fetch_random_content_items() (shuffled in python, SQLite's RANDOM() can't be seeded)."""
+        rows = self.table.all()
+        random.Random(seed).shuffle(rows)
+        return rows[:limit] if limit else rows
+
+    def close(self):
+        """Close the database."""
+        self.table.close()
+
+
+class FakeAsyncRepcoDB():
+    """Stands in for app.db.AsyncDB (the parts the search needs), out of SQLite with a latency per query."""
+
+    def __init__(self, rows: List[tuple], latency: float = 0.0, path: str = ":memory:"):
+        self.table = ContentItemTable(rows, path)
+        self.latency = latency
+        self.queries = 0
+
+    async def fetch_content_items_by_uids(self, uids: List[str]) -> Dict[str, dict]:
+        """Like AsyncDB.fetch_content_items_by_uids(): one query for all uids."""
+        self.queries += 1
+        await asyncio.sleep(self.latency)
+        return await asyncio.to_thread(self.table.contents, uids)
+
+    async def close(self):
+        """Close the database."""
+        self.table.close()
+
+
+class EchoChatModel(SimpleChatModel):
+    """A chat model which "translates" by echoing the text (prefixed with the target language), after latency seconds."""
+
+    latency: float = 0.0
+    calls: int = 0
+
+    @property
+    def _llm_type(self) -> str:
+        return "echo"
+
+    def _call(self, messages, stop=None, run_manager=None, **kwargs) -> str:
+        self.calls += 1
+        time.sleep(self.latency)
+        system, human = messages[0].content, messages[-1].content
+        language = re.search(r"to (\w[\w-]*)\. ", system)
+        return json.dumps({"src_language": "de", "dst_text": f"[{language.group(1) if language else '?'}] {human}"})
+
+
+def register_fake_llm(latency: float = 0.0):
+    """Register the LLM_PROVIDER=fake backend (an EchoChatModel with the given latency)."""
+    @register_backend('fake')
+    def _fake_backend():
+        return "echo", EchoChatModel(latency=latency)
+
+
+class FakeDeepL():
+    """Stands in for the DeepL API: the sync client (deepl.Translator) and the async REST requests."""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.requests = 0
+
+    def translate_text(self, text, target_lang):
+        """Like deepl.Translator.translate_text()."""
+        self.requests += 1
+        time.sleep(self.latency)
+        if isinstance(text, list):
+            return [SimpleNamespace(text=f"[{target_lang}] {t}") for t in text]
+        return SimpleNamespace(text=f"[{target_lang}] {text}")
+
+    async def request(self, src_texts: List[str], dst_language: str) -> List[str]:
+        """Like app.translation._deepl_request()."""
+        self.requests += 1
+        await asyncio.sleep(self.latency)
+        return [f"[{dst_language}] {t}" for t in src_texts]
+
+    def install(self):
+        """Route all DeepL calls of app.translation to this fake."""
+        app.translation.get_deepl_translator = lambda: self
+        app.translation._deepl_request = self.request     # pylint: disable=protected-access
+
+
+class HashingEmbeddingFunction(EmbeddingFunction):
+    """Bag of words embedding (hashed into dim buckets), with latency seconds per call like a small local model."""
+
+    def __init__(self, dim: int = 384, latency: float = 0.0):      # pylint: disable=super-init-not-called
+        self.dim = dim
+        self.latency = latency
+
+    def __call__(self, input: Documents) -> Embeddings:     # pylint: disable=redefined-builtin
+        time.sleep(self.latency)
+        embeddings = []
+        for text in input:
+            vector = [0.0] * self.dim
+            for word in re.findall(r"\w+", text.lower()):
+                vector[int(hashlib.md5(word.encode("utf-8")).hexdigest()[:8], 16) % self.dim] += 1.0
+            norm = math.sqrt(sum(v * v for v in vector)) or 1.0
+            embeddings.append([v / norm for v in vector])
+        return embeddings
+
+    @staticmethod
+    def name() -> str:
+        """The name chromaDB stores with the collection."""
+        return "hashing"
+
+
+def register_fake_embeddings(latency: float = 0.0):
+    """Register the EMBEDDING_BACKEND=hashing backend (a HashingEmbeddingFunction with the given latency)."""
+    @register_embedding_backend('hashing')
+    def _hashing_backend():
+        return "hashing", HashingEmbeddingFunction(latency=latency)
+
+
+def make_collection(path: str, embedding_function: HashingEmbeddingFunction, name: str = "ContentItems"):
+    """An empty chromaDB collection in path, which embeds with embedding_function."""
+    client = chromadb.PersistentClient(path=path)
+    try:
+        client.delete_collection(name)
+    except Exception:       # pylint: disable=broad-except
+        pass
+    return client.create_collection(name, embedding_function=embedding_function)
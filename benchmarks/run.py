@@ -0,0 +1,302 @@
+"""Offline benchmarks of the search and the ingest.
+
+All external services are replaced by local fakes with configurable latencies (see benchmarks/fakes.py):
+the LLM and DeepL translations, the repco DB (a seeded synthetic corpus) and the embedding model
+(a synthetic chromaDB collection). The results are written as JSON to benchmarks/results/, so runs
+can be compared over time:
+
+    python -m benchmarks.run                                    # search and ingest, default latencies
+    python -m benchmarks.run --skip-ingest --concurrency 1 16 64
+    python -m benchmarks.run --llm-latency 0 --deepl-latency 0   # only our own overhead
+    python -m benchmarks.run --compare benchmarks/results/20240501-120000-abc1234.json
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+from datetime import datetime
+from typing import List, Optional
+
+
+# the settings of the app which are recorded with the results (API keys are left out)
+TUNABLE_PREFIXES = ("SEARCH_", "VECTOR_", "EMBEDDING_", "TRANSLATION_", "DEEPL_", "LANGID_", "RRF_", "SNIPPET_", "DB_POOL_", "WARMUP_")
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(REPO_DIR, "benchmarks", "results")
+
+# the app logs every request, which would be measured too: only the benchmark logs at INFO level
+logger = logging.getLogger("benchmark")
+
+# runs in a fresh process: import the app, start it and wait for the end of the warm-up (see app.startup)
+COLD_START_SCRIPT = """
+import json, time
+start = time.perf_counter()
+import app.main
+import_seconds = time.perf_counter() - start
+from benchmarks.fakes import register_fake_embeddings, register_fake_llm
+from fastapi.testclient import TestClient
+register_fake_llm()
+register_fake_embeddings()
+with TestClient(app.main.app) as client:
+    while app.main.warmup.finished is None:
+        time.sleep(0.01)
+    print(json.dumps({"import_seconds": round(import_seconds, 3), "ready": client.get("/readyz").status_code == 200,
+                      **app.main.warmup.cold_start(), "steps": app.main.warmup.status}))
+"""
+
+
+def setup_environment(workdir: str):
+    """Point the app at the fakes and at a scratch directory. This has to happen before the app is imported."""
+    os.environ.update({
+        "LLM_PROVIDER": "fake",
+        "EMBEDDING_BACKEND": "hashing",
+        "EMBEDDING_CACHE_PATH": os.path.join(workdir, "embedding_cache.db"),
+        "DEEPL_API_KEY": "fake",
+        "TRANSLATION_CACHE_PATH": "",
+        "SEARCH_CACHE_PATH": "",
+        "SNIPPET_STORE_PATH": os.path.join(workdir, "snippets.db"),
+        "LEXICAL_INDEX_PATH": os.path.join(workdir, "lexical.db"),
+        "INDEX_GENERATION_FILE": os.path.join(workdir, "generation"),
+    })
+    # app.main loads ./chroma.db, ./static and ./templates
+    for name in ("static", "templates"):
+        os.symlink(os.path.join(REPO_DIR, name), os.path.join(workdir, name))
+    os.chdir(workdir)
+    sys.path.insert(0, REPO_DIR)
+
+
+def git_commit() -> str:
+    """The current commit of the repository (with a + if there are uncommitted changes)."""
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=REPO_DIR, capture_output=True, text=True, check=True).stdout
+        return commit + ("+" if dirty.strip() else "")
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def summarize(latencies: List[float], errors: int, elapsed: float) -> dict:
+    """p50/p95/p99/mean/max latency (in ms) and the throughput of a load run."""
+    from tokens import percentile       # pylint: disable=import-outside-toplevel
+    values = sorted(latency * 1000 for latency in latencies)
+    if not values:
+        return {"requests": 0, "errors": errors}
+    return {"requests": len(values), "errors": errors,
+            "p50_ms": round(percentile(values, 50), 2), "p95_ms": round(percentile(values, 95), 2),
+            "p99_ms": round(percentile(values, 99), 2), "mean_ms": round(sum(values) / len(values), 2),
+            "max_ms": round(values[-1], 2), "throughput_rps": round(len(values) / elapsed, 2) if elapsed else 0.0}
+
+
+async def run_load(client, queries: List[str], concurrency: int, path: str = "/search") -> dict:
+    """Send all queries with concurrency requests in flight, measure the latency of each."""
+    pending = list(reversed(queries))
+    latencies = []
+    errors = 0
+
+    async def _worker():
+        nonlocal errors
+        while pending:
+            query = pending.pop()
+            start = time.perf_counter()
+            response = await client.get(path, params={"query": query})
+            latencies.append(time.perf_counter() - start)
+            if response.status_code != 200:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(_worker() for _ in range(concurrency)))
+    return summarize(latencies, errors, time.perf_counter() - start)
+
+
+def index_corpus(rows: List[tuple], collection, lexical_index) -> float:
+    """Write the corpus into the vector database (and the lexical index) as if it was ingested, without translating. Returns the seconds it took."""
+    from app.ingest import prepare_content_item, write_content_item       # pylint: disable=import-outside-toplevel
+    from app.embeddings import get_embedder      # pylint: disable=import-outside-toplevel
+    from app.vectorstore import ChunkWriter       # pylint: disable=import-outside-toplevel
+    start = time.perf_counter()
+    with ChunkWriter(collection, embedding_function=get_embedder(), lexical_index=lexical_index) as writer:
+        for row in rows:
+            item = prepare_content_item(row)
+            if item:
+                write_content_item({**item, "dst_text": item["text"]}, writer)
+    return time.perf_counter() - start
+
+
+def bench_cold_start(workdir: str) -> dict:
+    """The seconds from the start of a fresh app process until it accepts requests and until its warm-up is done."""
+    env = {**os.environ, "PYTHONPATH": os.pathsep.join(filter(None, [REPO_DIR, os.getenv("PYTHONPATH")]))}
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, "-c", COLD_START_SCRIPT], cwd=workdir, env=env, capture_output=True, text=True, timeout=600,
+                            check=False)
+    elapsed = time.perf_counter() - start
+    if result.returncode != 0:
+        logger.error(f"cold start failed: {result.stderr[-2000:]}")
+        return {"error": result.stderr.strip().splitlines()[-1] if result.stderr.strip() else f"exit code {result.returncode}"}
+    summary = {**json.loads(result.stdout.strip().splitlines()[-1]), "process_seconds": round(elapsed, 3)}
+    logger.info(f"cold start: {summary}")
+    return summary
+
+
+def bench_search(args, rows: List[tuple], workdir: str) -> dict:
+    """p50/p95/p99 latency of /search, with cold and warm caches, for every concurrency level."""
+    import httpx        # pylint: disable=import-outside-toplevel
+    import app.main     # pylint: disable=import-outside-toplevel
+    from app.cache import get_search_cache, get_translation_cache       # pylint: disable=import-outside-toplevel
+    from app.lexical import get_lexical_index       # pylint: disable=import-outside-toplevel
+    from app.translation import get_engine      # pylint: disable=import-outside-toplevel
+    from benchmarks.fakes import FakeAsyncRepcoDB, HashingEmbeddingFunction, make_collection, make_queries  # pylint: disable=import-outside-toplevel
+
+    embedding_function = HashingEmbeddingFunction(latency=args.embed_latency)
+    collection = make_collection(os.path.join(workdir, "search_chroma.db"), embedding_function)
+    index_seconds = index_corpus(rows, collection, get_lexical_index())
+    logger.info(f"Indexed {len(rows)} items ({collection.count()} chunks) in {index_seconds:.1f}s")
+    app.main.collection = collection
+    app.main.adb = FakeAsyncRepcoDB(rows, latency=args.db_latency, path=os.path.join(workdir, "search_repco.db"))
+    queries = make_queries(args.queries, seed=args.seed)
+
+    async def _run() -> dict:
+        results = {}
+        transport = httpx.ASGITransport(app=app.main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://benchmark", timeout=None) as client:
+            for concurrency in args.concurrency:
+                results[str(concurrency)] = {}
+                for phase in ("cold", "warm"):
+                    if phase == "cold":
+                        get_search_cache().clear()
+                        get_translation_cache().clear()
+                    llm_calls, deepl_requests, db_queries = get_engine().model.calls, args.deepl.requests, app.main.adb.queries
+                    summary = await run_load(client, queries, concurrency)
+                    summary.update({"llm_calls": get_engine().model.calls - llm_calls, "deepl_requests": args.deepl.requests - deepl_requests,
+                                    "db_queries": app.main.adb.queries - db_queries})
+                    logger.info(f"search concurrency={concurrency} {phase}: {summary}")
+                    results[str(concurrency)][phase] = summary
+        return results
+
+    return {"items": len(rows), "chunks": collection.count(), "index_seconds": round(index_seconds, 2), "queries": len(queries),
+            "levels": asyncio.run(_run())}
+
+
+def bench_ingest(args, rows: List[tuple], workdir: str) -> dict:
+    """Items per second of the ingest pipeline: repco DB -> translation -> chunking -> vector database (and snippets, the JSONL export)."""
+    from app.db import content_item_key       # pylint: disable=import-outside-toplevel
+    from app.embeddings import get_embedder      # pylint: disable=import-outside-toplevel
+    from app.export import open_export      # pylint: disable=import-outside-toplevel
+    from app.ingest import translate_in_parallel, write_content_item       # pylint: disable=import-outside-toplevel
+    from app.lexical import LexicalIndex      # pylint: disable=import-outside-toplevel
+    from app.snippets import SnippetStore     # pylint: disable=import-outside-toplevel
+    from app.translation import get_engine      # pylint: disable=import-outside-toplevel
+    from app.vectorstore import ChunkWriter       # pylint: disable=import-outside-toplevel
+    from benchmarks.fakes import FakeRepcoDB, HashingEmbeddingFunction, make_collection     # pylint: disable=import-outside-toplevel
+
+    collection = make_collection(os.path.join(workdir, "ingest_chroma.db"), HashingEmbeddingFunction(latency=args.embed_latency))
+    db = FakeRepcoDB(rows, latency=args.db_latency, path=os.path.join(workdir, "ingest_repco.db"))
+    snippet_store = SnippetStore(os.path.join(workdir, "ingest_snippets.db")) if args.snippets else None
+    llm_calls, deepl_requests = get_engine().model.calls, args.deepl.requests
+    items = 0
+    start = time.perf_counter()
+    export = open_export(os.path.join(workdir, "content_items.jsonl"), resume=False)
+    with ChunkWriter(collection, embedding_function=get_embedder(), lexical_index=LexicalIndex(os.path.join(workdir, "ingest_lexical.db")),
+                     on_flush=lambda _keys: export.flush(force=False)) as writer:
+        for row, item in translate_in_parallel(db.iter_content_items(), args.workers, None, snippet_store):
+            if item:
+                export.write(write_content_item(item, writer))
+                if item.get("snippets"):
+                    snippet_store.put(item['id'], item['revision'], item['snippets'])
+                items += 1
+            writer.mark(content_item_key(row))
+    export.close()
+    elapsed = time.perf_counter() - start
+    summary = {"items": items, "chunks": writer.chunks_written, "seconds": round(elapsed, 2),
+               "items_per_second": round(items / elapsed, 2), "chunks_per_second": round(writer.chunks_written / elapsed, 2),
+               "llm_calls": get_engine().model.calls - llm_calls, "deepl_requests": args.deepl.requests - deepl_requests}
+    logger.info(f"ingest: {summary}")
+    return summary
+
+
+def compare(old: dict, new: dict):
+    """Print the changes of the main metrics between two result files."""
+    def _line(name: str, before: Optional[float], after: Optional[float]):
+        if before is None or after is None:
+            return
+        change = f"{(after - before) / before * 100:+.1f}%" if before else ""
+        print(f"  {name:<40}{before:>12.2f}{after:>12.2f}  {change}")
+
+    print(f"Comparing {old.get('git_commit')} ({old.get('timestamp')}) with {new.get('git_commit')} ({new.get('timestamp')})")
+    for level, phases in new.get("search", {}).get("levels", {}).items():
+        for phase, summary in phases.items():
+            before = old.get("search", {}).get("levels", {}).get(level, {}).get(phase, {})
+            for metric in ("p50_ms", "p95_ms", "p99_ms", "throughput_rps"):
+                _line(f"search c={level} {phase} {metric}", before.get(metric), summary.get(metric))
+    for metric in ("import_seconds", "startup_seconds", "ready_seconds"):
+        _line(f"cold start {metric}", old.get("cold_start", {}).get(metric), new.get("cold_start", {}).get(metric))
+    for metric in ("items_per_second", "chunks_per_second"):
+        _line(f"ingest {metric}", old.get("ingest", {}).get(metric), new.get("ingest", {}).get(metric))
+
+
+def main():
+    """Command line entry point."""
+    parser = argparse.ArgumentParser(description="Offline benchmarks of the search and the ingest, with local fakes of the external services")
+    parser.add_argument("--items", type=int, default=2000, help="the number of content items in the synthetic search corpus")
+    parser.add_argument("--queries", type=int, default=200, help="the number of (distinct) search queries per run")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32], help="the numbers of concurrent /search requests")
+    parser.add_argument("--ingest-items", type=int, default=300, help="the number of content items to ingest")
+    parser.add_argument("--workers", type=int, default=8, help="the number of translation workers of the ingest")
+    parser.add_argument("--snippets", action=argparse.BooleanOptionalAction, default=True, help="pre-translate the snippets during the ingest")
+    parser.add_argument("--llm-latency", type=float, default=0.5, help="seconds per LLM translation")
+    parser.add_argument("--deepl-latency", type=float, default=0.15, help="seconds per DeepL request")
+    parser.add_argument("--db-latency", type=float, default=0.005, help="seconds per repco DB query / page")
+    parser.add_argument("--embed-latency", type=float, default=0.01, help="seconds per embedding call")
+    parser.add_argument("--tokenizer", choices=["tiktoken", "word"], default="tiktoken",
+                        help="the token counter of the chunking (word: no tiktoken download needed)")
+    parser.add_argument("--seed", type=int, default=42, help="the seed of the synthetic corpus and queries")
+    parser.add_argument("--skip-search", action="store_true")
+    parser.add_argument("--skip-ingest", action="store_true")
+    parser.add_argument("--skip-cold-start", action="store_true")
+    parser.add_argument("--output", help="the result file (default: benchmarks/results/<time>-<commit>.json)")
+    parser.add_argument("--compare", help="a previous result file to compare the results with")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING, format="%(asctime)s %(message)s")
+    logger.setLevel(logging.INFO)
+
+    with tempfile.TemporaryDirectory(prefix="benchmark-") as workdir:
+        setup_environment(workdir)
+        from benchmarks.fakes import FakeDeepL, make_content_items, register_fake_embeddings, register_fake_llm     # pylint: disable=import-outside-toplevel
+        register_fake_llm(args.llm_latency)
+        register_fake_embeddings(args.embed_latency)
+        args.deepl = FakeDeepL(args.deepl_latency)
+        args.deepl.install()
+        if args.tokenizer == "word":
+            import app.chunking     # pylint: disable=import-outside-toplevel
+            app.chunking.count_tokens = lambda text: int(len(text.split()) * 1.3)
+
+        results = {"timestamp": datetime.now().isoformat(timespec="seconds"), "git_commit": git_commit(),
+                   "python": platform.python_version(), "config": {k: v for k, v in vars(args).items() if k not in ("deepl", "compare", "output")},
+                   "env": {k: v for k, v in sorted(os.environ.items()) if k.startswith(TUNABLE_PREFIXES) and "KEY" not in k}}
+        if not args.skip_cold_start:
+            results["cold_start"] = bench_cold_start(workdir)
+        rows = make_content_items(max(args.items, args.ingest_items), seed=args.seed)
+        if not args.skip_search:
+            results["search"] = bench_search(args, rows[:args.items], workdir)
+        if not args.skip_ingest:
+            results["ingest"] = bench_ingest(args, rows[:args.ingest_items], workdir)
+        os.chdir(REPO_DIR)
+
+    output = args.output or os.path.join(RESULTS_DIR, f"{datetime.now():%Y%m%d-%H%M%S}-{results['git_commit'].rstrip('+')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {output}")
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            compare(json.load(f), results)
+
+
+if __name__ == "__main__":
+    main()
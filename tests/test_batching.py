@@ -0,0 +1,81 @@
+"""Unittests with pytest for the batching module."""
+
+import asyncio
+import contextvars
+
+import pytest
+
+from app.batching import QueryCoalescer
+
+
+def fake_query(calls):
+    """A run_batch which records its calls and returns n_results hits per text (named after the text)."""
+    def run_batch(texts, n_results, where):
+        calls.append((list(texts), n_results, where))
+        if "FAIL" in texts:
+            raise RuntimeError("index gone")
+        return {"ids": [[f"{text}-{i}" for i in range(n_results)] for text in texts],
+                "distances": [[float(i) for i in range(n_results)] for _text in texts],
+                "metadatas": [[{} for _i in range(n_results)] for _text in texts],
+                "documents": [[text] * n_results for text in texts]}
+    return run_batch
+
+
+def test_coalescer():
+    """Test that concurrent queries with the same filter share one call, and every query gets its own hits."""
+    calls = []
+    coalescer = QueryCoalescer(fake_query(calls), window=0.05, max_batch=10)
+
+    async def _search():
+        return await asyncio.gather(coalescer.query("a", 2), coalescer.query("b", 3), coalescer.query("a", 1),
+                                    coalescer.query("c", 1, where={"language": "de"}))
+
+    a, b, a1, c = asyncio.run(_search())
+    assert sorted(calls, key=str) == [(["a", "b"], 3, None), (["c"], 1, {"language": "de"})]
+    assert a["ids"] == [["a-0", "a-1"]] and a["documents"] == [["a", "a"]]
+    assert b["ids"] == [["b-0", "b-1", "b-2"]]
+    assert a1["ids"] == [["a-0"]]
+    assert c["ids"] == [["c-0"]]
+
+
+def test_coalescer_max_batch_and_errors():
+    """Test that full batches are sent right away, and that a failing call fails all of its queries."""
+    calls = []
+    coalescer = QueryCoalescer(fake_query(calls), window=10.0, max_batch=2)
+
+    async def _search():
+        return await asyncio.wait_for(asyncio.gather(coalescer.query("a", 1), coalescer.query("b", 1)), timeout=5)
+
+    asyncio.run(_search())
+    assert calls == [(["a", "b"], 1, None)]
+
+    async def _fail():
+        return await asyncio.gather(coalescer.query("FAIL", 1), coalescer.query("b", 1), return_exceptions=True)
+
+    results = asyncio.run(_fail())
+    assert all(isinstance(result, RuntimeError) for result in results)
+
+    coalescer = QueryCoalescer(fake_query(calls), window=0)
+    with pytest.raises(RuntimeError):
+        asyncio.run(coalescer.query("FAIL", 1))
+
+
+def test_coalescer_context():
+    """Test that a batch runs outside of the context of the requests (timed out and full batches)."""
+    request = contextvars.ContextVar("request", default=None)
+    seen = []
+
+    def run_batch(texts, n_results, where):
+        seen.append(request.get())
+        return fake_query([])(texts, n_results, where)
+
+    async def _search(coalescer, text):
+        request.set(text)
+        return await coalescer.query(text, 1)
+
+    async def _both(coalescer):
+        return await asyncio.wait_for(asyncio.gather(_search(coalescer, "a"), _search(coalescer, "b")), timeout=5)
+
+    asyncio.run(_both(QueryCoalescer(run_batch, window=0.01, max_batch=10)))
+    asyncio.run(_both(QueryCoalescer(run_batch, window=10.0, max_batch=2)))
+    assert seen == [None, None]
@@ -0,0 +1,110 @@
+"""Unit tests for the cache module."""
+
+import asyncio
+import time
+
+from app.cache import DiskCache, MemoryCache, TieredCache, make_key, search_cache_key, translation_cache_key
+from app.vectorstore import bump_index_generation, index_generation
+
+
+def test_make_key():
+    """Test that keys are stable and depend on all parts."""
+    assert make_key("deepl", "text", "de", "EN-US") == make_key("deepl", "text", "de", "EN-US")
+    assert make_key("deepl", "text", "de", "EN-US") != make_key("openai", "text", "de", "EN-US")
+    assert translation_cache_key("deepl", "Hallo", None, "EN-US") == translation_cache_key("deepl", "Hallo", "", "en-us")
+    assert translation_cache_key("deepl", "Hallo", "de", "EN-US", "v1") != translation_cache_key("deepl", "Hallo", "de", "EN-US", "v2")
+
+
+def test_memory_cache_lru():
+    """Test the LRU eviction of the memory cache."""
+    cache = MemoryCache(max_entries=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1     # a is now the most recently used entry
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+
+
+def test_memory_cache_ttl():
+    """Test that expired entries are not returned."""
+    cache = MemoryCache(ttl=0.01)
+    cache.set("a", 1)
+    time.sleep(0.02)
+    assert cache.get("a") is None
+
+
+def test_disk_cache(tmp_path):
+    """Test persistence, namespaces and size eviction of the disk cache."""
+    path = str(tmp_path / "cache.db")
+    cache = DiskCache(path, namespace="translation", max_entries=2)
+    cache.set("a", "Hello")
+    cache.close()
+
+    cache = DiskCache(path, namespace="translation", max_entries=2)
+    assert cache.get("a") == "Hello"
+    assert DiskCache(path, namespace="other").get("a") is None
+    cache.set("b", "World")
+    cache.set("c", "!")
+    cache.evict()
+    assert len(cache) == 2
+
+
+def test_tiered_cache_stats(tmp_path):
+    """Test the hit/miss counters of the tiered cache."""
+    disk = DiskCache(str(tmp_path / "cache.db"))
+    disk.set("a", "from disk")
+    cache = TieredCache(disk)
+    assert cache.get("a") == "from disk"
+    assert cache.get("a") == "from disk"
+    assert cache.get("b") is None
+    stats = cache.stats()
+    assert stats["hits_disk"] == 1
+    assert stats["hits_memory"] == 1
+    assert stats["misses"] == 1
+
+
+def test_disk_cache_reads_dont_write(tmp_path):
+    """Test that a disk hit only reads, its access time is written with the eviction."""
+    cache = DiskCache(str(tmp_path / "cache.db"))
+    cache.set("a", "Hello")
+
+    def accessed():
+        return cache.conn.execute("SELECT accessed FROM cache WHERE key = 'a'").fetchone()[0]
+
+    before = accessed()
+    time.sleep(0.01)
+    assert not cache.conn.in_transaction
+    assert cache.get("a") == "Hello"
+    assert accessed() == before
+    cache.evict()
+    assert accessed() > before
+
+
+def test_tiered_cache_async(tmp_path):
+    """Test aget()/aset(), which run the disk tier in a worker thread."""
+    disk = DiskCache(str(tmp_path / "cache.db"))
+    cache = TieredCache(disk)
+
+    async def _run():
+        await cache.aset("a", "Hello")
+        cache.memory.clear()
+        return await cache.aget("a"), await cache.aget("a"), await cache.aget("b")
+
+    assert asyncio.run(_run()) == ("Hello", "Hello", None)
+    assert disk.get("a") == "Hello"
+    stats = cache.stats()
+    assert (stats["hits_disk"], stats["hits_memory"], stats["misses"]) == (1, 1, 1)
+
+
+def test_search_cache_key(tmp_path):
+    """Test that the search key ignores case and whitespace and changes with every write to the vector database."""
+    path = str(tmp_path / "generation")
+    assert index_generation(path) == ""
+    generation = index_generation(path)
+    assert search_cache_key(" Klima  Wandel", "de", 10, generation) == search_cache_key("klima wandel", "de", 10, generation)
+    assert search_cache_key("klima wandel", "de", 10, generation) != search_cache_key("klima wandel", "de", 20, generation)
+    bump_index_generation(path)
+    assert index_generation(path) != generation
+    assert search_cache_key("klima wandel", "de", 10, index_generation(path)) != search_cache_key("klima wandel", "de", 10, generation)
@@ -0,0 +1,58 @@
+"""Unit tests for the chunking module."""
+
+from app.chunking import chunk_text, split_units
+
+
+def count_words(text: str) -> int:
+    """Simple token counter for the tests."""
+    return len(text.split())
+
+
+def test_split_units():
+    """Test that a text is split into sentences and lines without losing anything."""
+    text = "Hello world. This is a test! Another line\nnext line? yes.\n\nLast paragraph"
+    units = split_units(text)
+    assert units == ["Hello world. ", "This is a test! ", "Another line\n", "next line? ", "yes.\n\n", "Last paragraph"]
+    assert "".join(units) == text
+
+
+def test_chunk_text_budget():
+    """Test that sentences are packed into chunks within the token budget."""
+    text = "One two three. Four five. Six seven eight nine. Ten."
+    chunks = list(chunk_text(text, max_tokens=5, count=count_words))
+    assert chunks == ["One two three. Four five.", "Six seven eight nine. Ten."]
+    assert all(count_words(chunk) <= 5 for chunk in chunks)
+
+
+def test_chunk_text_long_sentence():
+    """Test that a sentence which is longer than the budget is cut between words."""
+    chunks = list(chunk_text("a b c d e f g", max_tokens=3, count=count_words))
+    assert chunks == ["a b c", "d e f", "g"]
+
+
+def test_chunk_text_long_segment_linear():
+    """Test that a long unpunctuated segment (ASR output) is cut with a linear amount of counting, within the budget."""
+    counted = []
+
+    def counter(text: str) -> int:
+        counted.append(len(text))
+        return count_words(text)
+
+    text = " ".join(["word"] * 5000)
+    chunks = list(chunk_text(text, max_tokens=100, count=counter))
+    assert len(chunks) == 50
+    assert all(count_words(chunk) <= 100 for chunk in chunks)
+    assert sum(counted) < 4 * len(text)
+
+
+def test_chunk_text_overlap():
+    """Test that whole sentences of the end of a chunk are repeated in the next one."""
+    text = "One two. Three four. Five six. Seven eight."
+    chunks = list(chunk_text(text, max_tokens=4, overlap_tokens=2, count=count_words))
+    assert chunks == ["One two. Three four.", "Three four. Five six.", "Five six. Seven eight."]
+
+
+def test_chunk_text_empty():
+    """Test that empty and whitespace only texts give no chunks."""
+    assert not list(chunk_text("", max_tokens=10, count=count_words))
+    assert not list(chunk_text(" \n\n ", max_tokens=10, count=count_words))
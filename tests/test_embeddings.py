@@ -0,0 +1,45 @@
+"""Unittests with pytest for the embeddings module."""
+
+from app.cache import DiskCache, TieredCache, embedding_cache_key
+from app.embeddings import EMBEDDING_BACKENDS, Embedder, decode_vector, encode_vector
+
+
+def test_encode_vector():
+    """Test that vectors survive the round trip through the cache encoding (as float32)."""
+    assert decode_vector(encode_vector([0.5, -1.0, 0.25])) == [0.5, -1.0, 0.25]
+
+
+def test_embedder(monkeypatch):
+    """Test that only texts which are not cached are embedded, each of them once."""
+    calls = []
+
+    def embed(texts):
+        calls.append(list(texts))
+        return [[float(len(text)), 1.0] for text in texts]
+
+    monkeypatch.setitem(EMBEDDING_BACKENDS, "fake", lambda: ("fake-model", embed))
+    embedder = Embedder("fake", cache=TieredCache())
+    assert embedder.embed(["eins", "zwei", "eins"]) == [[4.0, 1.0], [4.0, 1.0], [4.0, 1.0]]
+    assert calls == [["eins", "zwei"]]
+
+    # a re-ingest of partly changed chunks only embeds the changed ones
+    assert embedder(["zwei", "drei!"]) == [[4.0, 1.0], [5.0, 1.0]]
+    assert calls[1:] == [["drei!"]]
+    assert (embedder.texts_embedded, embedder.texts_cached) == (3, 1)
+
+
+def test_embedder_persist(monkeypatch, tmp_path):
+    """Test that persist=False (search queries) neither reads nor writes the disk tier of the cache."""
+    monkeypatch.setitem(EMBEDDING_BACKENDS, "fake", lambda: ("fake-model", lambda texts: [[float(len(text))] for text in texts]))
+    disk = DiskCache(str(tmp_path / "embedding_cache.db"), namespace="embedding")
+    embedder = Embedder("fake", cache=TieredCache(disk))
+    embedder.embed(["chunk"])
+    embedder.embed(["query"], persist=False)
+    assert embedder.embed(["query"], persist=False) == [[5.0]]
+    assert disk.get(embedding_cache_key("fake-model", "chunk")) is not None
+    assert disk.get(embedding_cache_key("fake-model", "query")) is None
+
+    embedder = Embedder("fake", cache=TieredCache(disk))
+    embedder.embed(["chunk"], persist=False)
+    assert embedder.cache.stats()["hits_disk"] == 0
+    disk.close()
@@ -0,0 +1,88 @@
+"""Unit tests for the export module."""
+
+import pytest
+
+from app.export import EXPORT_COLUMNS, Export, JsonlExport, ParquetExport, iter_export, open_export, read_export
+
+
+def record(uid: str, text: str = "text") -> dict:
+    """A record like app.ingest.write_content_item returns it."""
+    return {"id": uid, "url": f"https://example.org/{uid}", "pubDate": "2024-01-02", "title": "title", "text": text, "dst_text": text.upper(),
+            "src_language": "de"}
+
+
+def test_export_is_abstract(tmp_path):
+    """Test that an export has to write its rows somewhere."""
+    class NoExport(Export):     # pylint: disable=abstract-method
+        pass
+
+    with pytest.raises(TypeError):
+        NoExport(str(tmp_path / "nothing"))
+
+    class ListExport(Export):
+        def _write_rows(self, rows):
+            self.written = list(rows)       # pylint: disable=attribute-defined-outside-init
+
+    export = ListExport(str(tmp_path / "list"))
+    export.write(record("a"))
+    export.close()
+    assert [row["id"] for row in export.written] == ["a"] and export.rows_written == 1
+
+
+def test_jsonl_export_resume(tmp_path):
+    """Test that a resumed export appends, a new one replaces the file, and only the export columns are written."""
+    path = str(tmp_path / "content_items.jsonl")
+    with open_export(path, resume=False) as export:
+        assert isinstance(export, JsonlExport)
+        export.write(record("a"))
+        assert export.flush(force=False)
+    with open_export(path, resume=True) as export:
+        export.write(record("b"))
+    rows = list(iter_export(path))
+    assert [row["id"] for row in rows] == ["a", "b"]
+    assert tuple(rows[0]) == EXPORT_COLUMNS
+
+    with open_export(path, resume=False) as export:
+        export.write(record("c"))
+    assert [row["id"] for row in iter_export(path)] == ["c"]
+
+
+def test_jsonl_export_drops_partial_line(tmp_path):
+    """Test that resuming after a killed run cuts off the unfinished last line."""
+    path = tmp_path / "content_items.jsonl"
+    with open_export(str(path), resume=False) as export:
+        export.write(record("a"))
+    with open(path, "a", encoding="utf-8") as f:
+        f.write('{"id": "b", "url')
+    with open_export(str(path), resume=True) as export:
+        export.write(record("c"))
+    assert [row["id"] for row in iter_export(str(path))] == ["a", "c"]
+
+
+def test_read_export_keeps_last_row(tmp_path):
+    """Test that an item which was exported twice (re-ingested after a crash) shows up once, with its last row."""
+    path = str(tmp_path / "content_items.jsonl")
+    with open_export(path, resume=False) as export:
+        for row in (record("a", "old"), record("b"), record("a", "new")):
+            export.write(row)
+    df = read_export(path)
+    assert list(df.columns) == list(EXPORT_COLUMNS)
+    assert list(df["id"]) == ["b", "a"]
+    assert df.set_index("id").loc["a", "dst_text"] == "NEW"
+
+
+def test_parquet_export_row_groups(tmp_path):
+    """Test that the Parquet export writes whole row groups and appends parts when resumed."""
+    pytest.importorskip("pyarrow")
+    path = str(tmp_path / "content_items.parquet")
+    export = ParquetExport(path, resume=False, row_group_size=2)
+    export.write(record("a"))
+    assert not export.flush(force=False)
+    export.write(record("b"))
+    assert export.flush(force=False)
+    export.write(record("c"))
+    export.close()
+    assert export.parts == 2
+    with open_export(path, resume=True) as export:
+        export.write(record("d"))
+    assert [row["id"] for row in iter_export(path)] == ["a", "b", "c", "d"]
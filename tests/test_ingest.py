@@ -0,0 +1,184 @@
+"""Unit tests for the ingest module."""
+
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import app.ingest
+from app.db import content_item_key
+from app.chunking import chunk_text
+from app.ingest import Checkpoint, content_items, ingest_content_items, ingest_transcripts, transcript_chunks, translate_in_parallel, translate_snippets
+from app.snippets import SnippetStore, make_snippet, pick_original_text
+from app.vectorstore import ChunkWriter
+
+
+def test_content_item_key():
+    """Test the (pubDate, uid) sort key, also for rows without a pubDate."""
+    row = ("uid1", "rev", None, datetime(2024, 1, 2, 3, 4, 5))
+    assert content_item_key(row) == (datetime(2024, 1, 2, 3, 4, 5), "uid1")
+    row = ("uid2", "rev", None, None)
+    assert content_item_key(row) == (datetime.min, "uid2")
+
+
+def test_checkpoint(tmp_path):
+    """Test that a checkpoint survives a restart and can be reset."""
+    path = str(tmp_path / "checkpoint.json")
+    checkpoint = Checkpoint(path)
+    assert checkpoint.load() is None
+    checkpoint.save((datetime.min, "uid1"))
+    checkpoint.save((datetime(2024, 1, 2), "uid2"))
+
+    checkpoint = Checkpoint(path)
+    assert checkpoint.load() == (datetime(2024, 1, 2), "uid2")
+    assert checkpoint.count == 2
+    checkpoint.reset()
+    assert checkpoint.load() is None
+
+
+def test_translate_in_parallel_keeps_order(monkeypatch):
+    """Test that the parallel translation stage yields the items in the order of the rows."""
+    def fake_translate(item, _rate_limiter=None):
+        time.sleep(0.01 * (5 - int(item["id"])))   # the first items take the longest
+        return {**item, "dst_text": item["text"].upper()}
+
+    monkeypatch.setattr(app.ingest, "translate_content_item", fake_translate)
+    title = {"de": {"value": "Titel"}}
+    content = {"de": {"value": "Inhalt"}}
+    rows = [(str(i), "rev", None, datetime(2024, 1, 1), None, None, None, None, title, content, content, "url", None) for i in range(5)]
+    rows.append(("skipped", "rev", None, None, None, None, None, None, {}, {}, {}, "url", None))
+    result = list(translate_in_parallel(rows, workers=3))
+    assert [row[0] for row, _item in result] == ["0", "1", "2", "3", "4", "skipped"]
+    assert result[0][1]["dst_text"].startswith("TITEL")
+    assert result[-1][1] is None
+
+
+def test_transcript_chunks(monkeypatch):
+    """Test that a transcript is translated chunk by chunk (in order) and split up into embedding chunks."""
+    def word_count(text):
+        return len(text.split())
+
+    translated = []
+
+    def fake_translate(src_text, dst_language, _src_language=None, rate_limiter=None):
+        translated.append(src_text)
+        return src_text.upper()
+
+    monkeypatch.setattr(app.ingest, "translate", fake_translate)
+    monkeypatch.setattr(app.ingest, "translation_chunks", lambda text: chunk_text(text, 6, count=word_count))
+    monkeypatch.setattr(app.ingest, "embedding_chunks", lambda text: chunk_text(text, 3, count=word_count))
+    row = ("t1", "rev", "de", "Eins zwei drei. Vier fünf sechs. Sieben acht neun.", "m1", "c1", None, {}, "url")
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        chunks = list(transcript_chunks(row, executor, window=2))
+    assert translated == ["Eins zwei drei. Vier fünf sechs.", "Sieben acht neun."]
+    assert chunks == ["EINS ZWEI DREI.", "VIER FÜNF SECHS.", "SIEBEN ACHT NEUN."]
+
+
+class FakeCollection():
+    """Just enough of a chromaDB collection for the ChunkWriter."""
+
+    def __init__(self):
+        self.documents = {}
+
+    def upsert(self, ids, documents, metadatas, embeddings=None):
+        """Store the chunks."""
+        self.documents.update(zip(ids, documents))
+
+    def get(self, where, include):
+        """The ids of the chunks of the uids in the where filter."""
+        uids = where["uid"]["$in"]
+        return {"ids": [i for i in self.documents if i.split(":")[0] in uids]}
+
+    def delete(self, ids):
+        """Delete chunks."""
+        for i in ids:
+            del self.documents[i]
+
+
+def test_ingest_transcripts_failure(monkeypatch):
+    """Test that a transcript whose translation fails midway is not written in part, and the checkpoint stays before it."""
+    def word_count(text):
+        return len(text.split())
+
+    def fake_translate(src_text, dst_language, _src_language=None, rate_limiter=None):
+        if "FEHLER" in src_text:
+            raise RuntimeError("translation failed")
+        return src_text.upper()
+
+    class FakeDB():
+        def iter_transcripts(self, after=None, page_size=10):
+            for uid, text in (("t1", "Hallo Welt."), ("t2", "Eins zwei. Drei vier. Fünf sechs. FEHLER hier."), ("t3", "Tschüss.")):
+                yield (uid, "rev", "de", text, "m1", "c1", None, {}, "url", None)
+
+    monkeypatch.setattr(app.ingest, "translate", fake_translate)
+    monkeypatch.setattr(app.ingest, "translation_chunks", lambda text: chunk_text(text, 6, count=word_count))
+    monkeypatch.setattr(app.ingest, "embedding_chunks", lambda text: chunk_text(text, 2, count=word_count))
+    collection = FakeCollection()
+    flushed = []
+    with ChunkWriter(collection, batch_size=2, on_flush=flushed.extend, embedding_function=lambda texts: [[0.0]] * len(texts)) as writer:
+        failed = ingest_transcripts(FakeDB(), writer, Checkpoint(""), workers=1)
+    assert failed == ["t2"]
+    assert sorted(collection.documents) == ["t1:rev:0", "t3:rev:0"]
+    assert flushed == [(datetime.min, "t1")]
+
+
+def test_ingest_content_items_resume(monkeypatch, tmp_path):
+    """Test that the checkpoint stays before a content item whose translation failed, and a resumed run ingests it."""
+    broken = {"1"}
+
+    def fake_translate(item, _rate_limiter=None):
+        return None if item["id"] in broken else {**item, "dst_text": item["text"].upper()}
+
+    class FakeDB():
+        def iter_content_items(self, after=None, page_size=1000):
+            title, content = {"de": {"value": "Titel"}}, {"de": {"value": "Inhalt"}}
+            rows = [(str(i), "rev", None, datetime(2024, 1, 1 + i), None, None, None, None, title, content, content, "url", None) for i in range(3)]
+            rows.insert(1, ("skipped", "rev", None, datetime(2024, 1, 1, 12), None, None, None, None, {}, {}, {}, "url", None))
+            return iter([row for row in rows if after is None or content_item_key(row) > after])
+
+    monkeypatch.setattr(app.ingest, "translate_content_item", fake_translate)
+    monkeypatch.setattr(app.ingest, "embedding_chunks", lambda text: [text])
+    collection = FakeCollection()
+    checkpoint = Checkpoint(str(tmp_path / "checkpoint.json"))
+
+    def ingest():
+        with ChunkWriter(collection, batch_size=1, on_flush=lambda keys: checkpoint.save(keys[-1], len(keys)),
+                         embedding_function=lambda texts: [[0.0]] * len(texts)) as writer:
+            return ingest_content_items(content_items(FakeDB(), "stream", 0, checkpoint), writer, workers=2)
+
+    assert ingest() == ["1"]
+    assert sorted(collection.documents) == ["0:rev:0", "2:rev:0"]
+    assert checkpoint.load() == (datetime(2024, 1, 1, 12), "skipped")
+    broken.clear()
+    assert ingest() == []
+    assert sorted(collection.documents) == ["0:rev:0", "1:rev:0", "2:rev:0"]
+    assert checkpoint.load() == (datetime(2024, 1, 3), "2")
+
+
+def test_translate_snippets(monkeypatch, tmp_path):
+    """Test that only the missing languages are translated, with one request per language for all items, the source language is kept."""
+    sent = []
+
+    def fake_translate_batch(src_texts, dst_language):
+        sent.append((dst_language, len(src_texts)))
+        return [f"{text} ({dst_language})" for text in src_texts]
+
+    monkeypatch.setattr(app.ingest, "translate_batch_via_deepl", fake_translate_batch)
+    store = SnippetStore(str(tmp_path / "snippets.db"))
+    store.put("a", "1", {"fr": ("Titre", "Texte")})
+    items = [{"id": "a", "revision": "1", "src_language": "de", "snippet_title": "Titel", "snippet": "Text"},
+             {"id": "b", "revision": "1", "src_language": "fr", "snippet_title": "Titre B", "snippet": "Texte B"}]
+    snippets = translate_snippets(items, ["de", "en", "fr"], store)
+    assert sent == [("de", 2), ("en", 4)]
+    assert snippets[0] == {"de": ("Titel", "Text"), "en": ("Titel (en)", "Text (en)")}
+    assert snippets[1] == {"de": ("Titre B (de)", "Texte B (de)"), "en": ("Titre B (en)", "Texte B (en)"), "fr": ("Titre B", "Texte B")}
+
+
+def test_snippet_source():
+    """Test that the pre-translated snippet is made of the content column, like the live translation of the search."""
+    title = {"de": {"value": "Titel"}}
+    summary = {"de": {"value": "Zusammenfassung"}}
+    content = {"de": {"value": "<p>Der Inhalt des Beitrags.</p>"}}
+    row = ("a", "rev", None, datetime(2024, 1, 1), None, None, None, None, title, summary, content, "url", None)
+    item = app.ingest.prepare_content_item(row)
+    assert item["snippet"] == make_snippet(pick_original_text(content, item["src_language"])) == "Der Inhalt des Beitrags."
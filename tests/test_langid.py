@@ -0,0 +1,62 @@
+"""Tests for the language identification."""
+
+from app.langid import LANGID_BACKENDS, LanguageIdentifier, register_langid_backend
+
+
+calls = []
+
+
+@register_langid_backend('fake')
+def _fake_backend():
+    def classify(texts):
+        calls.append(list(texts))
+        return [("de", 0.99) if "ä" in text else ("zh-cn", 0.5) for text in texts]
+    return classify
+
+
+def test_heuristic():
+    """Test that short ASCII queries with english stopwords are english, without asking the backend."""
+    assert LanguageIdentifier.heuristic("what is the energy transition") == ("en", 1.0)
+    assert LanguageIdentifier.heuristic("1234 !!") == ("", 0.0)
+    assert LanguageIdentifier.heuristic("Klimawandel und Energie") is None
+    assert LanguageIdentifier.heuristic("what's the Klimaänderung") is None
+    assert LanguageIdentifier.heuristic("Klimawandel") == ("", 0.0)
+
+
+def test_detect_batch():
+    """Test the confidence threshold, the default language and the memo cache."""
+    assert 'fake' in LANGID_BACKENDS
+    identifier = LanguageIdentifier(backend='fake', min_confidence=0.7)
+    calls.clear()
+    building, ni_hao = "Das Gebäude ist sehr alt", "ni hao ma wo hen hao"
+    assert identifier.detect_batch([building, "how does the heat pump work", ni_hao, "Gebäude"], default="xx") == ["de", "en", "xx", "xx"]
+    assert calls == [[building, ni_hao]]
+    assert identifier.detect_batch_with_confidence([ni_hao]) == [("zh", 0.5)]
+    assert identifier.detect(building) == "de"
+    assert calls == [[building, ni_hao]]     # memoized
+
+
+def test_langdetect_is_deterministic():
+    """Test that the (seeded) langdetect backend always gives the same answer."""
+    identifier = LanguageIdentifier(backend='langdetect')
+    text = "Die Energiewende ist ein großes Projekt, das uns alle betrifft."
+    assert identifier.detect(text) == "de"
+    assert len({LanguageIdentifier(backend='langdetect').detect(text[:20]) for _ in range(5)}) == 1
+
+
+def test_short_queries():
+    """Test that short queries, which langdetect gets wrong with a high confidence, get the default language."""
+    identifier = LanguageIdentifier(backend='langdetect')
+    assert identifier.detect("Klimawandel", default="") == ""       # langdetect: 'sw'
+    assert identifier.detect("Radio Helsinki", default="") == ""    # langdetect: 'fi'
+    assert identifier.detect("Radio Helsinki", default="de") == "de"
+    assert identifier.detect("Klimawandel in Österreich", default="") == "de"
+
+
+def test_stopwords_of_other_languages():
+    """Test that words which are english stopwords, but also common german / spanish words, don't make a query english."""
+    identifier = LanguageIdentifier(backend='langdetect')
+    for query in ("ich will frieden", "was will die regierung", "has visto la casa"):
+        assert LanguageIdentifier.heuristic(query) != ("en", 1.0)
+        assert identifier.detect(query, default="") != "en"
+    assert LanguageIdentifier.heuristic("who will win the election") == ("en", 1.0)
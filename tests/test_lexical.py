@@ -0,0 +1,61 @@
+"""Tests for the lexical index."""
+
+from app.lexical import LexicalIndex, fuse_rankings, is_keyword_query, match_expression, query_needs_translation
+from app.vectorstore import build_where, group_hits
+
+
+def test_is_keyword_query():
+    """Test which queries are searched without translating them."""
+    assert is_keyword_query("Radio Helsinki")
+    assert is_keyword_query("FM4")
+    assert is_keyword_query('"wir schaffen das"')
+    assert not is_keyword_query("klimawandel")
+    assert not is_keyword_query("What is the Energiewende")
+    assert not is_keyword_query("Graz Wien Linz Salzburg")
+
+
+def test_query_needs_translation(tmp_path):
+    """Test that capitalized german nouns are translated, names which are in the index are not."""
+    index = LexicalIndex(str(tmp_path / "lexical.db"))
+    index.upsert(["a:1:0"], ["Radio Helsinki talks about climate change"], [{"uid": "a", "language": "en"}])
+    assert index.has_terms(["radio", "helsinki"])
+    assert not index.has_terms(["klimawandel"])
+    assert query_needs_translation("Klimawandel", "de", index)
+    assert query_needs_translation("Energiewende Österreich", "de", index)
+    assert query_needs_translation("Die Grüne Partei", "de", index)
+    assert query_needs_translation("klimawandel", "de")
+    assert not query_needs_translation("Radio Helsinki", "de", index)
+    assert not query_needs_translation('"wir schaffen das"', "de", index)
+    assert not query_needs_translation("climate change", "en", index)
+    index.close()
+
+
+def test_match_expression():
+    """Test that queries become safe FTS5 expressions."""
+    assert match_expression('Graz "OR" graz*') == '"graz" OR "or"'
+    assert match_expression('"Radio Helsinki"') == '"radio helsinki"'
+    assert match_expression("!!") == ""
+
+
+def test_fuse_rankings():
+    """Test reciprocal rank fusion."""
+    fused = fuse_rankings([["a", "b", "c"], ["c", "d"]], k=60)
+    assert [uid for uid, _score in fused] == ["c", "a", "b", "d"]
+    assert fused[0][1] == 1 / 63 + 1 / 61
+
+
+def test_lexical_index(tmp_path):
+    """Test BM25 search with filters, upserts and deletes."""
+    index = LexicalIndex(str(tmp_path / "lexical.db"))
+    index.upsert(["a:1:0", "a:1:1", "b:1:0"],
+                 ["Radio Helsinki in Graz", "more about Graz and Graz", "a show from Wien"],
+                 [{"uid": "a", "language": "de"}, {"uid": "a", "language": "de"}, {"uid": "b", "language": "en"}])
+    results = index.query("graz", 10)
+    assert sorted(results["ids"][0]) == ["a:1:0", "a:1:1"]
+    assert sorted(hit[0] for hit in group_hits(index.query("Graz Wien", 10), -1)) == ["a", "b"]
+    assert index.query("wien", 10, build_where(languages=["de"]))["ids"] == [[]]
+    index.upsert(["a:1:1"], ["nothing left"], [{"uid": "a", "language": "de"}])
+    index.delete(["a:1:0"])
+    assert index.query("graz", 10)["ids"] == [[]]
+    assert len(index) == 2
+    index.close()
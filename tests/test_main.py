@@ -0,0 +1,184 @@
+"""Endpoint tests of the search, with the fakes of the benchmarks (see benchmarks/fakes.py) instead of the external services."""
+
+import asyncio
+import base64
+import json
+
+import pytest
+
+from fastapi import HTTPException
+from fastapi.testclient import TestClient
+
+import app.cache
+import app.chunking
+import app.main
+import app.translation
+from app.cache import open_cache
+from app.lexical import LexicalIndex
+from benchmarks.fakes import FakeAsyncRepcoDB, FakeDeepL, HashingEmbeddingFunction, make_collection, make_content_items
+from benchmarks.run import index_corpus
+
+
+class FakeEmbedder():
+    """Stands in for app.embeddings.Embedder, with the embedding function of the synthetic collection."""
+
+    def __init__(self, embedding_function):
+        self.embedding_function = embedding_function
+
+    def embed(self, texts, persist=True):
+        """Like Embedder.embed()."""
+        return self.embedding_function(texts)
+
+    __call__ = embed
+
+
+@pytest.fixture(name="search")
+def fixture_search(monkeypatch, tmp_path):
+    """app.main on a synthetic corpus of 60 content items, with in-memory caches, a fake repco DB, DeepL and query translation."""
+    embedding_function = HashingEmbeddingFunction()
+    collection = make_collection(str(tmp_path / "chroma.db"), embedding_function)
+    index = LexicalIndex(str(tmp_path / "lexical.db"))
+    rows = make_content_items(60, seed=3)
+    monkeypatch.setattr(app.chunking, "count_tokens", lambda text: len(text.split()))
+    monkeypatch.setattr(app.main, "get_embedder", lambda: FakeEmbedder(embedding_function))
+    monkeypatch.setattr("app.embeddings.get_embedder", lambda: FakeEmbedder(embedding_function))
+    index_corpus(rows, collection, index)
+
+    deepl = FakeDeepL()
+    translated_queries = []
+
+    async def fake_atranslate(text, dst_language="english", _src_language=None):
+        translated_queries.append(text)
+        return f"translated {text}"
+
+    async def fake_atranslate_detect(text, dst_language="english"):
+        translated_queries.append(text)
+        return f"translated {text}", "de"
+
+    monkeypatch.setattr(app.translation, "_deepl_request", deepl.request)
+    monkeypatch.setattr(app.main, "atranslate", fake_atranslate)
+    monkeypatch.setattr(app.main, "atranslate_detect", fake_atranslate_detect)
+    monkeypatch.setattr(app.main, "collection", collection)
+    monkeypatch.setattr(app.main, "adb", FakeAsyncRepcoDB(rows))
+    monkeypatch.setattr(app.main, "get_lexical_index", lambda: index)
+    monkeypatch.setattr(app.main, "get_snippet_store", lambda: None)
+    monkeypatch.setattr(app.main, "index_generation", lambda: "test")
+    monkeypatch.setattr(app.cache, "_search_cache", open_cache("", "search", 1000, 1000, 0))
+    monkeypatch.setattr(app.cache, "_translation_cache", open_cache("", "translation", 1000, 1000, 0))
+    yield {"client": TestClient(app.main.app), "deepl": deepl, "rows": rows, "translated_queries": translated_queries}
+    index.close()
+
+
+def stream_events(client, **params):
+    """The NDJSON events of /search/stream."""
+    response = client.get("/search/stream", params=params)
+    assert response.status_code == 200
+    return [json.loads(line) for line in response.text.splitlines()]
+
+
+def test_stream_search_events(search):
+    """Test the events of a page: the hits, every hit once with its translated text (one DeepL request), then done with the cursor."""
+    events = stream_events(search["client"], query="climate energy community", page_size=5)
+    assert [event["event"] for event in events] == ["hits"] + ["hit"] * 5 + ["done"]
+    assert events[0]["language"] == "en" and len(events[0]["hits"]) == 5
+    hits = [event for event in events if event["event"] == "hit"]
+    assert sorted(event["index"] for event in hits) == list(range(5))
+    assert all(event["hit"]["original_text"] for event in hits)
+    assert all(event["hit"]["dst_text"].startswith("[EN-US] ") for event in hits)
+    assert search["deepl"].requests == 1
+    assert events[-1]["next_cursor"]
+
+    # the next page, and the cached page again
+    events = stream_events(search["client"], query="climate energy community", page_size=5, cursor=events[-1]["next_cursor"])
+    assert events[-1]["event"] == "done"
+    requests = search["deepl"].requests
+    cached = stream_events(search["client"], query="climate energy community", page_size=5)
+    assert [event["event"] for event in cached] == ["hits", "done"]
+    assert all(hit["dst_text"].startswith("[EN-US] ") for hit in cached[0]["hits"])
+    assert search["deepl"].requests == requests
+
+
+def test_short_query_language(search):
+    """Test that the hits of a query too short for the language identification are shown in the language the translator reports."""
+    events = stream_events(search["client"], query="Solarstrom", page_size=3)
+    assert search["translated_queries"] == ["Solarstrom"]
+    assert events[0]["language"] == "de"
+    assert all(event["hit"]["dst_text"].startswith("[DE] ") for event in events if event["event"] == "hit")
+    response = search["client"].get("/search", params={"query": "Solarstrom", "page_size": 3})
+    assert all(hit["dst_text"].startswith("[DE] ") for hit in response.json())
+    assert search["translated_queries"] == ["Solarstrom"]
+
+
+def test_stream_search_error(search, monkeypatch):
+    """Test that a broken cursor and a failing search end the stream with an error event."""
+    events = stream_events(search["client"], query="climate", cursor="not a cursor")
+    assert events == [{"event": "error", "detail": "Invalid cursor"}]
+
+    async def broken(*args, **kwargs):
+        raise RuntimeError("index gone")
+
+    monkeypatch.setattr(app.main, "ranked_hits", broken)
+    events = stream_events(search["client"], query="something else entirely")
+    assert events == [{"event": "error", "detail": "Search failed"}]
+
+
+def test_cursor():
+    """Test that a cursor only fits its query and filters, and that broken ones are rejected with HTTP 400."""
+    where = app.main.build_where(languages=["de"])
+    cursor = app.main.encode_cursor("climate", "en", 20, where)
+    assert app.main.decode_cursor(cursor, "climate", "en", where) == 20
+    for text, query_lang, filters in (("climate crisis", "en", where), ("climate", "de", where), ("climate", "en", None)):
+        with pytest.raises(HTTPException) as e:
+            app.main.decode_cursor(cursor, text, query_lang, filters)
+        assert e.value.status_code == 400
+    data = json.loads(base64.urlsafe_b64decode(cursor))
+    for broken in ("not a cursor", "", base64.urlsafe_b64encode(b"[1, 2]").decode("ascii"),
+                   base64.urlsafe_b64encode(json.dumps({**data, "o": -10}).encode("utf-8")).decode("ascii"),
+                   base64.urlsafe_b64encode(json.dumps({**data, "o": "x"}).encode("utf-8")).decode("ascii"),
+                   base64.urlsafe_b64encode(json.dumps({"o": 20}).encode("utf-8")).decode("ascii")):
+        with pytest.raises(HTTPException):
+            app.main.decode_cursor(broken, "climate", "en", where)
+
+
+def test_ranked_hits_extends(search, monkeypatch):
+    """Test that a page beyond the cached ranking ranks deeper, and keeps the hits which were served already."""
+    depths = []
+    vector_hits = app.main.vector_hits
+
+    async def counting_vector_hits(query, count_answers=10, where=None):
+        depths.append(count_answers)
+        return await vector_hits(query, count_answers, where)
+
+    monkeypatch.setattr(app.main, "vector_hits", counting_vector_hits)
+    monkeypatch.setattr(app.main, "SEARCH_INITIAL_DEPTH", 5)
+    first, complete, _language = asyncio.run(app.main.ranked_hits("what about energy and housing", "en", None, 3))
+    assert len(first) == 5 and not complete
+    again, _complete, _language = asyncio.run(app.main.ranked_hits("what about energy and housing", "en", None, 5))
+    assert again == first and depths == [5]
+    deeper, _complete, _language = asyncio.run(app.main.ranked_hits("what about energy and housing", "en", None, 8))
+    assert depths == [5, 10]
+    assert deeper[:5] == first and len(deeper) == 10
+    assert len({hit["id"] for hit in deeper}) == 10
+
+
+def test_pages_until_the_end(search):
+    """Test that the pages of /search cover all results once, and the last page has no next cursor."""
+    seen = []
+    cursor = None
+    pages = 0
+    for pages in range(1, 20):
+        params = {"query": "what about radio and music", "page_size": 5, "language": "de"}
+        if cursor:
+            params["cursor"] = cursor
+        response = search["client"].get("/search", params=params)
+        assert response.status_code == 200
+        seen.extend(hit["id"] for hit in response.json())
+        cursor = response.headers.get("X-Next-Cursor")
+        if cursor is None:
+            break
+    german = [row[0] for row in search["rows"] if "de" in row[9]]
+    assert sorted(seen) == sorted(german)
+    assert cursor is None and pages == (len(german) + 4) // 5
+
+    response = search["client"].get("/search", params={"query": "what about radio and music", "cursor": "broken"})
+    assert response.status_code == 400
@@ -0,0 +1,35 @@
+"""Unittests with pytest for the metrics module."""
+
+import time
+
+from app.metrics import Histogram, STAGE_SECONDS, server_timing, span, start_request
+
+
+def test_histogram():
+    """Test that the buckets are cumulative and the series are labeled in the Prometheus text format."""
+    histogram = Histogram("test_seconds", "A test histogram", ["stage"], buckets=[0.1, 1.0])
+    histogram.observe(0.05, stage="a")
+    histogram.observe(0.5, stage="a")
+    histogram.observe(5.0, stage="a")
+    lines = histogram.render()
+    assert lines[:2] == ["# HELP test_seconds A test histogram", "# TYPE test_seconds histogram"]
+    assert 'test_seconds_bucket{stage="a",le="0.1"} 1' in lines
+    assert 'test_seconds_bucket{stage="a",le="1.0"} 2' in lines
+    assert 'test_seconds_bucket{stage="a",le="+Inf"} 3' in lines
+    assert 'test_seconds_count{stage="a"} 3' in lines
+
+
+def test_span():
+    """Test that spans are recorded for the current request and summed up per stage in the Server-Timing header."""
+    STAGE_SECONDS.clear()
+    spans = start_request()
+    with span("translate_hits"):
+        time.sleep(0.01)
+    with span("translate_hits"):
+        pass
+    with span("db_fetch"):
+        pass
+    assert [stage for stage, _seconds in spans] == ["translate_hits", "translate_hits", "db_fetch"]
+    assert 'search_stage_duration_seconds_count{stage="translate_hits"} 2' in STAGE_SECONDS.render()
+    header = server_timing(spans)
+    assert header.startswith("translate_hits;dur=1") and ", db_fetch;dur=0." in header
@@ -0,0 +1,63 @@
+"""Unit tests for the ratelimit module."""
+
+import time
+
+import pytest
+
+from app.ratelimit import RateLimiter, TokenBucket, call_with_backoff, is_rate_limit_error
+
+
+class RateLimitError(Exception):
+    """Looks like the rate limit errors of the openai / anthropic clients."""
+    status_code = 429
+
+
+def test_token_bucket():
+    """Test that the bucket hands out its capacity at once and then refills at its rate."""
+    bucket = TokenBucket(capacity=5, rate=100)
+    start = time.monotonic()
+    for _ in range(5):
+        bucket.acquire()
+    assert time.monotonic() - start < 0.05
+    bucket.acquire(5)
+    assert time.monotonic() - start >= 0.04
+
+
+def test_rate_limiter_counts_tokens():
+    """Test that the token budget is charged with the estimated tokens of a text."""
+    limiter = RateLimiter(requests_per_minute=6000, tokens_per_minute=6000, count_tokens=len)
+    limiter.acquire_for("x" * 100)
+    assert limiter.tokens.tokens < 5901
+    assert limiter.requests.tokens < 5999.1
+
+
+def test_is_rate_limit_error():
+    """Test the detection of HTTP 429 errors."""
+    assert is_rate_limit_error(RateLimitError())
+    assert not is_rate_limit_error(ValueError("nope"))
+
+
+def test_call_with_backoff():
+    """Test that rate limit errors are retried and other errors are not."""
+    calls = []
+
+    def flaky():
+        calls.append(1)
+        if len(calls) < 3:
+            raise RateLimitError()
+        return "ok"
+
+    assert call_with_backoff(flaky, base_delay=0.001) == "ok"
+    assert len(calls) == 3
+
+    with pytest.raises(RateLimitError):
+        call_with_backoff(lambda: (_ for _ in ()).throw(RateLimitError()), max_retries=2, base_delay=0.001)
+
+    def broken():
+        calls.append(1)
+        raise ValueError("broken")
+
+    calls.clear()
+    with pytest.raises(ValueError):
+        call_with_backoff(broken, base_delay=0.001)
+    assert len(calls) == 1
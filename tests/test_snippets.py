@@ -0,0 +1,26 @@
+"""Tests for the pre-translated snippets."""
+
+from app.snippets import SnippetStore, make_snippet
+
+
+def test_make_snippet():
+    """Test that snippets are plain text and cut at sentence or word boundaries."""
+    assert make_snippet("<p>Ein  kurzer Text.</p>") == "Ein kurzer Text."
+    text = "Erster Satz ist hier. Zweiter Satz ist deutlich länger als der erste."
+    assert make_snippet(text, max_chars=40) == "Erster Satz ist hier."
+    assert make_snippet("eins zwei drei vier fünf sechs", max_chars=20) == "eins zwei drei vier …"
+    assert make_snippet("") == ""
+
+
+def test_snippet_store(tmp_path):
+    """Test that snippets are stored per uid and language and replaced by newer revisions."""
+    store = SnippetStore(str(tmp_path / "snippets.db"))
+    store.put("a", "1", {"de": ("Titel", "Text"), "en": ("Title", "Text (en)")})
+    store.put("b", "1", {"de": ("Titel B", "Text B")})
+    assert sorted(store.languages("a", "1")) == ["de", "en"]
+    assert store.get_many(["a", "b", "c"], "en") == {"a": ("1", "Title", "Text (en)")}
+    store.put("a", "2", {"en": ("New title", "New text")})
+    assert store.get_many(["a"], "EN") == {"a": ("2", "New title", "New text")}
+    assert store.languages("a", "2") == ["en"]
+    assert len(store) == 3
+    store.close()
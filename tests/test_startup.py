@@ -0,0 +1,30 @@
+"""Unittests with pytest for the startup module."""
+
+import asyncio
+
+from app.startup import Warmup, process_age
+
+
+def test_warmup():
+    """Test that the steps run in order, failures are recorded and only the required steps decide the readiness."""
+    calls = []
+
+    def fail():
+        calls.append("fail")
+        raise RuntimeError("no model")
+
+    warmup = Warmup([("first", lambda: calls.append("first")), ("broken", fail), ("last", lambda: calls.append("last"))],
+                    required=["first", "last"])
+    assert not warmup.ready
+    assert warmup.cold_start() == {"startup_seconds": None, "ready_seconds": None}
+    asyncio.run(warmup.run())
+    assert calls == ["first", "fail", "last"]
+    assert warmup.ready
+    assert warmup.failed() == ["broken"]
+    assert warmup.status["broken"]["error"] == "no model"
+    cold_start = warmup.cold_start()
+    assert 0 <= cold_start["startup_seconds"] <= cold_start["ready_seconds"] <= round(process_age(), 3) + 0.01
+
+    warmup = Warmup([("broken", fail)], required=["broken"])
+    asyncio.run(warmup.run())
+    assert not warmup.ready
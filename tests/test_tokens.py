@@ -0,0 +1,30 @@
+"""Unit tests for the tokens module."""
+
+from tokens import TokenStats, calc_tokens, count_tokens_parallel, percentile
+
+
+def test_calc_tokens_word():
+    """Test the word tokenization method."""
+    assert calc_tokens("This is a test", method='word') == 4
+    assert calc_tokens("", method='word') == 0
+
+
+def test_count_tokens_parallel_keeps_order():
+    """Test that the counts of the worker processes come back in the order of the texts."""
+    texts = (" ".join(["word"] * i) for i in range(200))
+    counts = list(count_tokens_parallel(texts, method='word', workers=2, batch_size=7))
+    assert counts == list(range(200))
+
+
+def test_token_stats():
+    """Test the incremental statistics against known values."""
+    stats = TokenStats()
+    for tokens in [1, 2, 3, 4, 5]:
+        stats.add(tokens)
+    described = stats.describe()
+    assert described['count'] == 5
+    assert described['mean'] == 3
+    assert abs(described['std'] - 1.5811388) < 1e-6
+    assert described['50%'] == 3
+    assert described['total'] == 15
+    assert percentile([1, 2, 3, 4], 25) == 1.75
@@ -1,8 +1,21 @@
 """Unittests with pytest for the translation module."""
 
-from app.translation import translate
+import asyncio
+import os
 
+from types import SimpleNamespace
 
+import pytest
+
+from langchain_core.language_models import FakeListChatModel
+
+import app.translation
+from app.cache import TieredCache
+from app.translation import (LLM_BACKENDS, TranslationEngine, atranslate_batch_via_deepl, load_translation_prompt, translate, translate_batch_via_deepl,
+                             translate_via_deepl)
+
+
+@pytest.mark.skipif(not os.getenv("LLM_PROVIDER"), reason="needs a configured LLM_PROVIDER (calls the real API)")
 def test_translate():
     """Test the translate function."""
     text = "Esto es una prueba"
@@ -10,3 +23,127 @@ def test_translate():
     assert result == "This is a test"
     result = translate(text, dst_language="deutsch")
     assert result != "This is a test"
+
+
+class FakeTranslator():
+    """Stands in for deepl.Translator, fails on batches containing 'FAIL'."""
+
+    def __init__(self):
+        self.calls = []
+
+    def translate_text(self, text, target_lang):
+        self.calls.append(text)
+        if isinstance(text, list):
+            if "FAIL" in text:
+                raise RuntimeError("batch rejected")
+            return [SimpleNamespace(text=f"{t} ({target_lang})") for t in text]
+        if text == "FAIL":
+            raise RuntimeError("text rejected")
+        return SimpleNamespace(text=f"{text} ({target_lang})")
+
+
+def test_translate_batch_via_deepl(monkeypatch):
+    """Test that translate_batch_via_deepl batches, keeps the order and survives failures."""
+    translator = FakeTranslator()
+    monkeypatch.setattr(app.translation, "get_deepl_translator", lambda: translator)
+    monkeypatch.setattr(app.translation, "get_translation_cache", TieredCache)
+
+    result = translate_batch_via_deepl(["eins", "", "zwei", "eins"], dst_language="en")
+    assert result == ["eins (EN-US)", "", "zwei (EN-US)", "eins (EN-US)"]
+    assert translator.calls == [["eins", "zwei"]]
+
+    translator.calls = []
+    result = translate_batch_via_deepl(["drei", "FAIL", "vier"], dst_language="de")
+    assert result == ["drei (DE)", "", "vier (DE)"]
+    assert translator.calls[0] == ["drei", "FAIL", "vier"]
+    assert len(translator.calls) == 4
+
+
+def test_translate_via_deepl_cached(monkeypatch):
+    """Test that a cached translation needs no DeepL translator (and no DEEPL_API_KEY)."""
+    translator = FakeTranslator()
+    cache = TieredCache()
+    monkeypatch.setattr(app.translation, "get_deepl_translator", lambda: translator)
+    monkeypatch.setattr(app.translation, "get_translation_cache", lambda: cache)
+    assert translate_via_deepl("eins", dst_language="en") == "eins (EN-US)"
+
+    def no_translator():
+        raise ValueError("DEEPL_API_KEY not set")
+
+    monkeypatch.setattr(app.translation, "get_deepl_translator", no_translator)
+    assert translate_via_deepl("eins", dst_language="en") == "eins (EN-US)"
+    assert translate_batch_via_deepl(["eins", "", "eins"], dst_language="en") == ["eins (EN-US)", "", "eins (EN-US)"]
+    assert translator.calls == ["eins"]
+
+
+class FakeDeepLRequest():
+    """Stands in for app.translation._deepl_request, fails on batches containing 'FAIL'."""
+
+    def __init__(self):
+        self.calls = []
+
+    async def __call__(self, src_texts, dst_language):
+        self.calls.append(src_texts)
+        if "FAIL" in src_texts:
+            raise RuntimeError("rejected")
+        return [f"{t} ({dst_language})" for t in src_texts]
+
+
+def test_atranslate_batch_via_deepl(monkeypatch):
+    """Test that atranslate_batch_via_deepl sends every text once, skips empty and cached ones, and retries a failed batch one by one."""
+    request = FakeDeepLRequest()
+    cache = TieredCache()
+    monkeypatch.setattr(app.translation, "_deepl_request", request)
+    monkeypatch.setattr(app.translation, "get_translation_cache", lambda: cache)
+
+    result = asyncio.run(atranslate_batch_via_deepl(["eins", "", "zwei", "eins"], dst_language="en"))
+    assert result == ["eins (EN-US)", "", "zwei (EN-US)", "eins (EN-US)"]
+    assert request.calls == [["eins", "zwei"]]
+
+    request.calls = []
+    assert asyncio.run(atranslate_batch_via_deepl(["zwei", "", "eins"], dst_language="en")) == ["zwei (EN-US)", "", "eins (EN-US)"]
+    assert asyncio.run(atranslate_batch_via_deepl(["", ""], dst_language="en")) == ["", ""]
+    assert not request.calls
+
+    result = asyncio.run(atranslate_batch_via_deepl(["drei", "FAIL", "vier", "drei"], dst_language="de"))
+    assert result == ["drei (DE)", "", "vier (DE)", "drei (DE)"]
+    assert request.calls[0] == ["drei", "FAIL", "vier"]
+    assert sorted(request.calls[1:]) == [["FAIL"], ["drei"], ["vier"]]
+
+    # the failed text is not cached, the others are
+    request.calls = []
+    assert asyncio.run(atranslate_batch_via_deepl(["vier", "FAIL"], dst_language="de")) == ["vier (DE)", ""]
+    assert request.calls == [["FAIL"]]
+
+
+def test_load_translation_prompt():
+    """Test that the vendored prompt loads and has the variables translate() fills in."""
+    prompt, version = load_translation_prompt()
+    assert set(prompt.input_variables) == {"src_text", "dst_language"}
+    assert version == "basic_translation@1"
+
+
+def test_translation_engine(monkeypatch):
+    """Test the engine with a registered fake backend (no network access)."""
+    cache = TieredCache()
+    monkeypatch.setattr(app.translation, "get_translation_cache", lambda: cache)
+    responses = ['{"src_language": "es", "dst_text": "This is a test"}']
+    monkeypatch.setitem(LLM_BACKENDS, "fake", lambda: ("fake-model", FakeListChatModel(responses=responses)))
+
+    engine = TranslationEngine("fake")
+    assert engine.translate("Esto es una prueba", dst_language="english") == "This is a test"
+    assert engine.translate("Esto es una prueba", dst_language="english") == "This is a test"
+    assert cache.stats()["hits_memory"] == 1
+
+
+def test_translation_engine_detect(monkeypatch):
+    """Test that atranslate_detect() returns (and caches) the source language the LLM reports, "" if it is no language code."""
+    cache = TieredCache()
+    monkeypatch.setattr(app.translation, "get_translation_cache", lambda: cache)
+    responses = ['{"src_language": "de-AT", "dst_text": "climate change"}', '{"src_language": "German", "dst_text": "peace"}']
+    monkeypatch.setitem(LLM_BACKENDS, "fake", lambda: ("fake-model", FakeListChatModel(responses=responses)))
+
+    engine = TranslationEngine("fake")
+    assert asyncio.run(engine.atranslate_detect("Klimawandel", dst_language="EN-US")) == ("climate change", "de")
+    assert asyncio.run(engine.atranslate_detect("Klimawandel", dst_language="EN-US")) == ("climate change", "de")
+    assert asyncio.run(engine.atranslate_detect("Frieden", dst_language="EN-US")) == ("peace", "")
@@ -0,0 +1,88 @@
+"""Unit tests for the vectorstore module."""
+
+from datetime import date, datetime
+
+import app.db     # noqa: sets up sqlite3 for chromaDB
+import chromadb
+
+from app.vectorstore import ChunkWriter, build_where, chunk_id, group_hits, typed_metadata
+
+
+def fake_embeddings(texts):
+    """Cheap, deterministic stand-in for an embedding model."""
+    return [[float(len(t)), float(sum(map(ord, t)) % 97), 1.0] for t in texts]
+
+
+def make_collection(name: str):
+    """Return an empty in-memory collection."""
+    client = chromadb.EphemeralClient()
+    try:
+        client.delete_collection(name)
+    except Exception:
+        pass
+    return client.create_collection(name)
+
+
+def test_chunk_writer_batches_and_ids():
+    """Test that chunks get unique ids and are written in batches."""
+    collection = make_collection("test_batches")
+    flushed = []
+    with ChunkWriter(collection, batch_size=3, embedding_function=fake_embeddings, on_flush=flushed.extend) as writer:
+        writer.add_item("uid1", "rev1", ["a", "b"], {"title": "one"})
+        writer.mark("uid1")
+        writer.add_item("uid2", "rev1", ["c", "d", "e"], {"title": "two"})
+        writer.mark("uid2")
+        assert flushed == ["uid1"]
+    assert flushed == ["uid1", "uid2"]
+    assert collection.count() == 5
+    chunk = collection.get(ids=[chunk_id("uid2", "rev1", 2)])
+    assert chunk["documents"] == ["e"]
+    assert chunk["metadatas"][0] == {"title": "two", "uid": "uid2", "revision": "rev1", "chunk": 2}
+
+
+def test_chunk_writer_is_idempotent():
+    """Test that re-runs overwrite the chunks and drop chunks of older revisions."""
+    collection = make_collection("test_idempotent")
+    with ChunkWriter(collection, batch_size=2, embedding_function=fake_embeddings) as writer:
+        writer.add_item("uid1", "rev1", ["a", "b", "c"], {})
+    with ChunkWriter(collection, batch_size=2, embedding_function=fake_embeddings) as writer:
+        writer.add_item("uid1", "rev1", ["a", "b", "c"], {})
+    assert collection.count() == 3
+    with ChunkWriter(collection, batch_size=2, embedding_function=fake_embeddings) as writer:
+        writer.add_item("uid1", "rev2", ["x", "y", "z"], {})
+        writer.add_item("uid2", "rev1", ["q"], {})
+    assert sorted(collection.get()["ids"]) == ["uid1:rev2:0", "uid1:rev2:1", "uid1:rev2:2", "uid2:rev1:0"]
+
+
+def test_group_hits():
+    """Test that the hits are collapsed to the nearest chunk per content item."""
+    results = {
+        "ids": [["a:1:0", "a:1:1", "b:1:0", "t:1:0", "old"]],
+        "distances": [[0.3, 0.1, 0.2, 0.05, 0.4]],
+        "metadatas": [[{"uid": "a"}, {"uid": "a"}, {"uid": "b"}, {"uid": "t", "content_item_uid": "b"}, None]],
+        "documents": [["a0", "a1", "b0", "t0", "old"]],
+    }
+    hits = group_hits(results, -1)
+    assert [(uid, distance, document) for uid, distance, _metadata, document in hits] == \
+        [("b", 0.05, "t0"), ("a", 0.1, "a1"), ("old", 0.4, "old")]
+    assert [hit[0] for hit in group_hits(results, 2)] == ["b", "a"]
+
+
+def test_where_filters():
+    """Test that the search filters are pushed down into the chromaDB query on the typed metadata."""
+    collection = make_collection("test_where_filters")
+    with ChunkWriter(collection, batch_size=10, embedding_function=fake_embeddings) as writer:
+        writer.add_item("a", "1", ["alpha"], {"language": "de", **typed_metadata(datetime(2023, 5, 1, 12), "s1")})
+        writer.add_item("b", "1", ["beta"], {"language": "en", **typed_metadata(datetime(2024, 1, 31, 23, 59), "s2")})
+        writer.add_item("c", "1", ["gamma"], {"language": "de", **typed_metadata(None, None)})
+    assert build_where() is None
+
+    def uids(where):
+        results = collection.query(query_embeddings=fake_embeddings(["alpha"]), n_results=3, where=where)
+        return sorted(metadata["uid"] for metadata in results["metadatas"][0])
+
+    assert uids(build_where(date_from=date(2024, 1, 1))) == ["b"]
+    assert uids(build_where(date_to=date(2024, 1, 31))) == ["a", "b"]
+    assert uids(build_where(date_to=date(2024, 1, 30))) == ["a"]
+    assert uids(build_where(languages=["DE"])) == ["a", "c"]
+    assert uids(build_where(languages=["de"], series=["s1", "s2"])) == ["a"]
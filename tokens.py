@@ -2,17 +2,47 @@
 A helper library for calculating the number of tokens in a text (string),
 for different LLM providers and tokenization methods.
 Also, this library provides helper functions for tokenizing a text (string)
+
+It can also be used as a command line tool, to estimate the number of tokens (and the
+cost of translating them) of a directory of .txt files or of the repco DB tables:
+
+    python tokens.py ./data                             # all .txt files in a directory
+    python tokens.py --source transcripts --workers 8   # the "Transcript" table
+    python tokens.py --source contentitems --limit 10000 --report-every 1000
 """
 
+import argparse
 import os
-import sys
 import re
+import sys
+
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from itertools import islice
+from typing import Iterable, Iterator, List
+
 import tiktoken
-import voyageai
 
-import pandas as pd
 
-from pprint import pprint
+# USD per 1M tokens (input, output), see https://openai.com/pricing and https://www.anthropic.com/api
+PRICING = {
+    'gpt-3.5-turbo': (0.50, 1.50),
+    'claude-3-haiku': (0.25, 1.25),
+}
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model: str) -> tiktoken.Encoding:
+    """Return the (cached) tiktoken encoding of a model."""
+    return tiktoken.encoding_for_model(model)
+
+
+@lru_cache(maxsize=None)
+def get_voyage_client():
+    """Return the (cached) voyageai client, for counting anthropic tokens."""
+    import voyageai     # pylint: disable=import-outside-toplevel
+    return voyageai.Client()
 
 
 # Tokenization methods
@@ -26,11 +56,9 @@ def calc_tokens(text: str, method='tiktoken', model='gpt-3.5-turbo'):
     if not text:
         return 0
     if method == 'tiktoken':
-        encoding = tiktoken.encoding_for_model(model)
-        return len(encoding.encode(text))
+        return len(get_encoding(model).encode(text))
     if method == 'anthropic':
-        vo = voyageai.Client()
-        return vo.count_tokens([text])
+        return get_voyage_client().count_tokens([text])
     if method == 'word':
         return len(re.findall(r'\b\w+\b', text))
     if method == 'char':
@@ -39,19 +67,129 @@ def calc_tokens(text: str, method='tiktoken', model='gpt-3.5-turbo'):
         raise ValueError('Unknown tokenization method')
 
 
+def iter_texts(directory: str) -> Iterator[str]:
+    """
+    Read the .txt files in a directory (recursively), one at a time
+    :param directory: a string, the directory path
+    :return: an iterator of strings, the texts
+    """
+    for root, _dirs, filenames in os.walk(directory):
+        for filename in sorted(filenames):
+            if filename.endswith('.txt'):
+                with open(os.path.join(root, filename), 'r', encoding='utf-8') as f:
+                    yield f.read()
+
+
 def fetch_texts(directory: str) -> list[str]:
     """
     Fetch texts from a directory
     :param directory: a string, the directory path
     :return: a list of strings, the texts
     """
-    texts = []
-    for filename in os.listdir(directory):
-        print(f"Reading file: {filename}")
-        if filename.endswith('.txt'):
-            with open(os.path.join(directory, filename), 'r', encoding='utf-8') as f:
-                texts.append(f.read())
-    return texts
+    return list(iter_texts(directory))
+
+
+def iter_db_texts(source: str, limit: int = 0) -> Iterator[str]:
+    """
+    Stream texts out of the repco DB
+    :param source: 'contentitems' (the content column of "ContentItem") or 'transcripts' (the text column of "Transcript")
+    :param limit: the maximum number of rows (0: all)
+    :return: an iterator of strings, the texts
+    """
+    from app.db import DB      # pylint: disable=import-outside-toplevel
+    if source == 'transcripts':
+        sql = 'SELECT text FROM "Transcript"'
+    elif source == 'contentitems':
+        sql = 'SELECT content FROM "ContentItem"'
+    else:
+        raise ValueError(f'Unknown source {source}')
+    if limit > 0:
+        sql += f' LIMIT {int(limit)}'
+    db = DB()
+    try:
+        for (value,) in db.stream_query(sql):
+            if isinstance(value, dict):     # content: {'de': {'value': '...'}, ...}
+                value = " ".join(v.get('value', '') for v in value.values() if isinstance(v, dict))
+            yield value or ""
+    finally:
+        db.close()
+
+
+def _count_batch(texts: List[str], method: str, model: str) -> List[int]:
+    """Count the tokens of a batch of texts (runs in a worker process)."""
+    return [calc_tokens(text, method, model) for text in texts]
+
+
+def count_tokens_parallel(texts: Iterable[str], method='tiktoken', model='gpt-3.5-turbo',
+                          workers: int = 0, batch_size: int = 64) -> Iterator[int]:
+    """
+    Count the tokens of many texts in a pool of worker processes
+    Only a few batches per worker are in flight, so the texts can be streamed from a DB or a directory.
+    :param workers: the number of processes (0: one per CPU)
+    :return: an iterator of integers, the number of tokens of each text (in order)
+    """
+    workers = workers or os.cpu_count() or 1
+    texts = iter(texts)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = []
+        while True:
+            batch = list(islice(texts, batch_size))
+            if batch:
+                pending.append(executor.submit(_count_batch, batch, method, model))
+            if pending and (len(pending) >= 2 * workers or not batch):
+                yield from pending.pop(0).result()
+            if not batch and not pending:
+                return
+
+
+class TokenStats():
+    """Incrementally collected statistics of token counts (like pandas' describe())."""
+
+    def __init__(self):
+        self.counts = array('q')
+        self.total = 0
+        self._mean = 0.0
+        self._m2 = 0.0      # Welford's online variance
+
+    def add(self, tokens: int):
+        """Add the token count of one text."""
+        self.counts.append(tokens)
+        self.total += tokens
+        delta = tokens - self._mean
+        self._mean += delta / len(self.counts)
+        self._m2 += delta * (tokens - self._mean)
+
+    def describe(self) -> dict:
+        """count, mean, std, min, percentiles and max of the token counts."""
+        n = len(self.counts)
+        if not n:
+            return {'count': 0}
+        values = sorted(self.counts)
+        return {'count': n, 'mean': self._mean, 'std': (self._m2 / (n - 1)) ** 0.5 if n > 1 else 0.0,
+                'min': values[0], '25%': percentile(values, 25), '50%': percentile(values, 50),
+                '75%': percentile(values, 75), '95%': percentile(values, 95), '99%': percentile(values, 99),
+                'max': values[-1], 'total': self.total}
+
+    def cost(self) -> dict:
+        """Estimated USD for translating all texts, per model (the output is about as long as the input)."""
+        return {model: self.total * (price_in + price_out) / 10**6 for model, (price_in, price_out) in PRICING.items()}
+
+    def report(self) -> str:
+        """A printable report of the statistics and the costs."""
+        lines = ["            Tokens"]
+        lines += [f"{key:<8}{value:>18.6f}" for key, value in self.describe().items()]
+        lines += ["", "Estimated translation cost (input + output):"]
+        lines += [f"  {model:<16}{usd:>12.2f} USD" for model, usd in self.cost().items()]
+        return "\n".join(lines)
+
+
+def percentile(values: List[int], q: float) -> float:
+    """The q-th percentile of sorted values (linear interpolation, like pandas)."""
+    pos = (len(values) - 1) * q / 100
+    lower = int(pos)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (pos - lower)
+
 
 def calculate_tokens(directory: str, method='tiktoken', model='gpt-3.5-turbo') -> dict[str, int]:
     """
@@ -60,16 +198,38 @@ def calculate_tokens(directory: str, method='tiktoken', model='gpt-3.5-turbo') -
     :param method: a string, the tokenization method
     :return: a dictionary, the number of tokens in each text
     """
-    texts = fetch_texts(directory)
     tokens = {}
-    for i, text in enumerate(texts):
+    for i, text in enumerate(iter_texts(directory)):
         tokens[f'text_{i}'] = calc_tokens(text, method, model)
     return tokens
 
 
-if __name__ == "__main__":
-    token_stats = calculate_tokens(sys.argv[1], method='tiktoken', model='gpt-3.5-turbo')
+def main():
+    """Command line entry point."""
+    parser = argparse.ArgumentParser(description="Estimate the number of tokens (and translation costs) of texts")
+    parser.add_argument("directory", nargs="?", help="a directory with .txt files (for --source dir)")
+    parser.add_argument("--source", choices=["dir", "contentitems", "transcripts"], default="dir")
+    parser.add_argument("--limit", type=int, default=0, help="the maximum number of DB rows (0: all)")
+    parser.add_argument("--method", choices=["tiktoken", "anthropic", "word", "char"], default="tiktoken")
+    parser.add_argument("--model", default="gpt-3.5-turbo", help="the model for tiktoken")
+    parser.add_argument("--workers", type=int, default=0, help="the number of processes (0: one per CPU)")
+    parser.add_argument("--report-every", type=int, default=0, help="print the statistics every N texts (0: only at the end)")
+    args = parser.parse_args()
 
-    pprint(token_stats)
-    df = pd.DataFrame(token_stats.items(), columns=['Text', 'Tokens'])
-    print(df.describe())
\ No newline at end of file
+    if args.source == "dir":
+        if not args.directory:
+            parser.error("a directory is needed for --source dir")
+        texts = iter_texts(args.directory)
+    else:
+        texts = iter_db_texts(args.source, args.limit)
+
+    stats = TokenStats()
+    for i, tokens in enumerate(count_tokens_parallel(texts, args.method, args.model, args.workers), start=1):
+        stats.add(tokens)
+        if args.report_every and i % args.report_every == 0:
+            print(stats.report(), end="\n\n", flush=True)
+    print(stats.report())
+
+
+if __name__ == "__main__":
+    sys.exit(main())